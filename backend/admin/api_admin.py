@@ -0,0 +1,83 @@
+import io
+import tempfile
+from typing import Any
+
+from admin import utils
+from chats.importer import FORMATS, MessageImporter, read_rows
+from chats.models import db_room
+from db import database, replicas
+from fastapi import APIRouter, Depends, Query, Request, status
+from fastapi.responses import JSONResponse
+from looplag import loop_monitor
+from settings import (DRAIN_WINDOW, IMPORT_BATCH, IMPORT_SPOOL_SIZE,
+                      TRACE_RING_SIZE)
+from tracing import tracer
+
+router = APIRouter(
+    prefix='/admin', tags=["admin"], dependencies=[Depends(utils.admin_required)]
+)
+
+
+@router.post("/drain", status_code=status.HTTP_202_ACCEPTED)
+async def drain(window: float = Query(DRAIN_WINDOW, ge=0)) -> JSONResponse:
+    """
+    Stops accepting websockets, sends "reconnect" to the connected clients
+    spread over the window, flushes their queues and shuts the worker down.
+    """
+    utils.start_drain(window)
+    return JSONResponse(
+        {"detail": "Draining", "connections": len(utils.manager.connections)},
+        status.HTTP_202_ACCEPTED,
+    )
+
+
+@router.get("/pool", status_code=status.HTTP_200_OK)
+async def pool() -> dict[str, Any]:
+    """ Connections of this worker: in use, waiting for a connection, acquire latency. """
+    return {"primary": database.pool_stats(), "replicas": replicas.stats()}
+
+
+@router.get("/purge", status_code=status.HTTP_200_OK)
+async def purge() -> list[dict]:
+    """ Deleted rooms whose messages and members are still being removed. """
+    return [dict(room) for room in await db_room.purges() if room]
+
+
+@router.post("/import", status_code=status.HTTP_200_OK)
+async def import_messages(
+    request: Request,
+    format: str = Query("ndjson", regex=f"^({'|'.join(FORMATS)})$"),
+    batch: int = Query(IMPORT_BATCH, ge=1),
+) -> dict[str, Any]:
+    """
+    Loads messages from the NDJSON or CSV request body with COPY.
+    The body is spooled first, larger than IMPORT_SPOOL_SIZE goes to disk.
+    """
+    with tempfile.SpooledTemporaryFile(IMPORT_SPOOL_SIZE) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        file = io.TextIOWrapper(spool, encoding="utf-8", newline="")  # type: ignore[arg-type]
+        return await MessageImporter(batch).run(read_rows(file, format))
+
+
+@router.get("/traces", status_code=status.HTTP_200_OK)
+async def traces(
+    limit: int = Query(20, ge=1, le=TRACE_RING_SIZE),
+    min_ms: float = Query(0, ge=0),
+    name: str = Query(""),
+) -> list[dict[str, Any]]:
+    """
+    Recent traces of this worker, newest first: spans with start and duration
+    in ms from the start of the trace. name filters by a part of the route.
+    """
+    return tracer.traces(limit, min_ms, name)
+
+
+@router.get("/loop", status_code=status.HTTP_200_OK)
+async def loop() -> dict[str, Any]:
+    """
+    Event loop lag of this worker over the last minute and the recent blocks
+    with the stack of the call that held the loop.
+    """
+    return loop_monitor.stats()
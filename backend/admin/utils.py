@@ -0,0 +1,46 @@
+import asyncio
+import secrets
+import signal
+import threading
+
+from chats.api_chats import manager
+from chats.sharding import sharding
+from fastapi import Depends, HTTPException, status
+from fastapi.security import APIKeyHeader
+from settings import ADMIN_TOKEN, DRAIN_SIGNAL, DRAIN_WINDOW
+
+admin_token_header = APIKeyHeader(name="X-Admin-Token", auto_error=False)
+drain_task: asyncio.Task | None = None
+
+
+async def admin_required(token: str | None = Depends(admin_token_header)) -> None:
+    """ Admin routes are open only when ADMIN_TOKEN is set and matches. """
+    if not ADMIN_TOKEN or not token or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status.HTTP_403_FORBIDDEN, "Forbidden")
+
+
+async def drain_and_exit(window: float = DRAIN_WINDOW) -> None:
+    """ Sends clients elsewhere over the window, then stops the server as SIGINT does. """
+    await sharding.stop()
+    await manager.drain(window)
+    signal.raise_signal(signal.SIGINT)
+
+
+def start_drain(window: float = DRAIN_WINDOW) -> asyncio.Task:
+    global drain_task
+    if drain_task is None or drain_task.done():
+        drain_task = asyncio.create_task(drain_and_exit(window))
+    return drain_task
+
+
+def install_drain_signal() -> None:
+    """
+    Replaces the server's handler of DRAIN_SIGNAL with the drain.
+    Signals can be handled only in the main thread, the test client runs elsewhere.
+    """
+    if not DRAIN_SIGNAL or threading.current_thread() is not threading.main_thread():
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(getattr(signal, DRAIN_SIGNAL), start_drain)
+    except (NotImplementedError, RuntimeError, ValueError):
+        pass
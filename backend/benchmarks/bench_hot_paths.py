@@ -0,0 +1,263 @@
+"""
+Microbenchmarks of the functions called on every request or frame, with history.
+
+    cd backend && python -m benchmarks.bench_hot_paths
+    cd backend && python -m benchmarks.bench_hot_paths --filter broadcast --no-save
+    cd backend && python -m benchmarks.bench_hot_paths --check --threshold 0.15
+
+Every case is called in a loop sized to take --min-time, the best of
+--repeat loops is the result in microseconds per call. No services are
+needed: check_token gets its user from memory, broadcast writes to fake
+sockets and includes the writers draining the queues, base64_image writes
+to a temporary directory. Statement cases bind values to the compiled
+query, "compile" ones build the SQL from scratch.
+
+Each run is appended to --history as a JSON line. A case is flagged when it
+is slower than the median of the last --window runs on the same machine and
+Python by more than --threshold; with --check flagged cases fail the run.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable
+
+from benchmarks.bench_registry import FakeWebSocket, NoDatabase
+from chats import utils as chat_utils
+from chats.models import Member, Message, Room
+from db import Record, Statement
+from PIL import Image
+from settings import JWT_ACCESS_SECRET_KEY, LIMIT
+from starlette.requests import Request
+from users import utils as user_utils
+from users.models import User
+
+Cases = dict[str, Callable[[], Any]]
+
+USER_COLUMNS = [column.name for column in User._by_username.query.selected_columns]
+USER_ROW = (
+    1, "loaduser", "Load", "User", "5c7a0b0e.jpg", "70000000001", "load@load.test",
+    datetime(2023, 1, 1, tzinfo=timezone.utc), True, 1,
+)
+SCOPE = {
+    "type": "http", "scheme": "http", "server": ("testserver", 80), "path": "/",
+    "root_path": "", "query_string": b"", "headers": [(b"host", b"testserver")],
+}
+ROOM_SIZES = (10, 100, 1000)
+IMAGES = {"png 128": ("png", 128), "jpeg 800": ("jpeg", 800), "jpeg 2000": ("jpeg", 2000)}
+UUID = "0f8c2e6a4b3d4c1e9a7f5b2d8e6c4a10"
+
+
+def user_record() -> Record:
+    # A dict stands in for the asyncpg record, both are read by column name.
+    return Record(dict(zip(USER_COLUMNS, USER_ROW)))
+
+
+class MemoryUsers:
+    async def by_username(self, name: str) -> Any:
+        return user_record()
+
+
+def image_data(format: str, size: int) -> str:
+    """ A textured image, flat colors would compress unrealistically well. """
+    image = Image.effect_mandelbrot((size, size * 3 // 4), (-2.0, -1.2, 1.0, 1.2), 64)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format=format)
+    return f"data:image/{format};base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+async def auth_cases() -> Cases:
+    user_utils.db_user = MemoryUsers()  # type: ignore[assignment]
+    token = await user_utils.create_access_token("loaduser")
+    request = Request(SCOPE)
+    records = {size: [user_record() for _ in range(size)] for size in (LIMIT, 100)}
+    cases: Cases = {
+        "check_token": partial(user_utils.check_token, token, JWT_ACCESS_SECRET_KEY),
+        "path_image": partial(user_utils.path_image, request, records[LIMIT][0]),
+    }
+    for size, users in records.items():
+        cases[f"list_path_image[{size}]"] = partial(user_utils.list_path_image, request, users)
+    cases["is_valid_uuid"] = partial(chat_utils.is_valid_uuid, UUID)
+    cases["is_valid_uuid[invalid]"] = partial(chat_utils.is_valid_uuid, "not a key")
+    return cases
+
+
+async def broadcast_cases() -> Cases:
+    chat_utils.db_room = NoDatabase()  # type: ignore[assignment]
+    cases: Cases = {}
+    for size in ROOM_SIZES:
+        manager = chat_utils.ConnectionManager()
+        for n in range(size):
+            await manager.connect(FakeWebSocket(), size, n, f"user{n}")  # type: ignore[arg-type]
+        message = {
+            "accepted": True, "key": UUID, "room_id": size, "user_id": 1,
+            "content": "Сообщение средней длины " * 4,
+        }
+
+        async def broadcast(manager: Any = manager, message: dict = message) -> None:
+            await manager.broadcast(message, message["room_id"])
+            # Fake sockets never suspend, every writer empties its queue in one step.
+            await asyncio.sleep(0)
+
+        cases[f"broadcast[{size}]"] = broadcast
+    return cases
+
+
+async def image_cases(directory: str) -> Cases:
+    user_utils.AVATAR_ROOT = directory  # type: ignore[attr-defined]
+    cases: Cases = {}
+    for name, (format, size) in IMAGES.items():
+        data = image_data(format, size)
+        cases[f"base64_image[{name}]"] = partial(user_utils.base64_image, data)
+    return cases
+
+
+def compile_statement(statement: Statement) -> None:
+    Statement(statement.query).compile()
+
+
+def statement_cases() -> Cases:
+    binds: dict[Statement, dict[str, Any]] = {
+        Room._by_name: {"room_name": "room"},
+        Room._version: {"room_name": "room"},
+        Member._user_in_room: {"room_name": "room", "uid": 1},
+        Member._read: {"rid": 1, "uid": 1, "message_key": UUID},
+        Member._my_rooms: {"uid": 1, "limit": LIMIT, "offset": 0},
+        Message._create: {"message_key": UUID, "uid": 1, "rid": 1, "text": "content"},
+        Message._get_all: {"rid": 1, "limit": LIMIT, "offset": LIMIT},
+    }
+    cases: Cases = {}
+    for statement, values in binds.items():
+        cases[statement.name] = partial(statement.args, values)
+    for statement in (Member._my_rooms, Message._create):
+        cases[f"{statement.name}[compile]"] = partial(compile_statement, statement)
+    return cases
+
+
+async def measure(call: Callable[[], Any], min_time: float, repeat: int) -> float:
+    """ Microseconds per call, the best of repeat loops of at least min_time. """
+    # The first call is a warmup and tells whether the case returns a coroutine.
+    first = call()
+    is_async = asyncio.iscoroutine(first)
+    if is_async:
+        await first
+
+    async def loop(number: int) -> float:
+        started = time.perf_counter()
+        if is_async:
+            for _ in range(number):
+                await call()
+        else:
+            for _ in range(number):
+                call()
+        return time.perf_counter() - started
+
+    number = 1
+    while await loop(number) < min_time:
+        number *= 2
+    return min([await loop(number) / number for _ in range(repeat)]) * 1e6
+
+
+async def run(args: argparse.Namespace) -> dict[str, float]:
+    directory = tempfile.mkdtemp()
+    try:
+        cases = {
+            **await auth_cases(),
+            **await broadcast_cases(),
+            **await image_cases(directory),
+            **statement_cases(),
+        }
+        results = {}
+        for name, call in cases.items():
+            if args.filter in name:
+                results[name] = round(await measure(call, args.min_time, args.repeat), 3)
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def machine() -> str:
+    return f"{platform.node()} {platform.machine()} Python {platform.python_version()}"
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return out.stdout.strip()
+
+
+def baselines(path: str, window: int) -> dict[str, float]:
+    """ Median of the last window runs of every case on this machine. """
+    history: dict[str, list[float]] = {}
+    try:
+        with open(path) as file:
+            runs = [json.loads(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        return {}
+    for entry in runs:
+        if entry["machine"] == machine():
+            for name, value in entry["results"].items():
+                history.setdefault(name, []).append(value)
+    return {name: statistics.median(values[-window:]) for name, values in history.items()}
+
+
+def report(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    print(f"{'case':<36}{'us/call':>12}{'baseline':>12}{'change':>9}")
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<36}{value:>12.2f}{'-':>12}{'':>9}")
+            continue
+        change = value / base - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<36}{value:>12.2f}{base:>12.2f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--filter", default="", help="run the cases containing the text")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per loop")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--history", default="bench_hot_paths.jsonl")
+    parser.add_argument("--window", type=int, default=5, help="runs in the baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="0.1 is 10%% slower")
+    parser.add_argument("--no-save", action="store_true", help="do not append to the history")
+    parser.add_argument("--check", action="store_true", help="exit with 1 on a regression")
+    args = parser.parse_args()
+
+    baseline = baselines(args.history, args.window)
+    results = asyncio.run(run(args))
+    regressions = report(results, baseline, args.threshold)
+    if not args.no_save:
+        line = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "machine": machine(),
+            "results": results,
+        }
+        with open(args.history, "a") as file:
+            file.write(json.dumps(line) + "\n")
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        if args.check:
+            raise SystemExit(1)
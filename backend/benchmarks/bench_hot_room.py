@@ -0,0 +1,111 @@
+"""
+Message.create throughput when many clients write into one busy room.
+
+    cd backend && python -m benchmarks.bench_hot_room --writers 32 --messages 200
+
+Message.create inserts the message and updates the room summary
+(message_count, last message) in one statement, so concurrent messages of
+one room wait for each other's row lock on rooms. "hot" sends every message
+into one room, "spread" gives every writer a room of its own; "insert only"
+is the bare INSERT without the summary, the cost of the counter is the
+difference. The database from settings must be running, the benchmark
+creates its own user and rooms and removes them at the end.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+import sqlalchemy as sa
+from chats.models import db_member, db_message, db_room, member, message, room
+from db import Statement, database
+from users.models import user
+
+INSERT_ONLY = Statement(
+    sa.insert(message).values(
+        key=sa.bindparam("message_key"),
+        user_id=sa.bindparam("uid"),
+        room_id=sa.bindparam("rid"),
+        content=sa.bindparam("text"),
+    ),
+    name="Message.insert_only",
+)
+Send = Callable[[int, int], Awaitable[None]]
+
+
+async def create_message(room_id: int, user_id: int) -> None:
+    # The key arrives from the websocket as a string, the same as here.
+    key: Any = str(uuid.uuid4())
+    await db_message.create(key, room_id, user_id, "benchmark")
+
+
+async def insert_message(room_id: int, user_id: int) -> None:
+    await db_message.execute(
+        INSERT_ONLY, message_key=str(uuid.uuid4()), uid=user_id, rid=room_id, text="benchmark"
+    )
+
+
+async def writer(send: Send, room_id: int, user_id: int, messages: int) -> list[float]:
+    latency: list[float] = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        await send(room_id, user_id)
+        latency.append(time.perf_counter() - started)
+    return latency
+
+
+async def run_case(
+    send: Send, rooms: list[int], user_id: int, writers: int, messages: int
+) -> tuple[float, float, float]:
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *[writer(send, rooms[i % len(rooms)], user_id, messages) for i in range(writers)]
+    )
+    elapsed = time.perf_counter() - started
+    latency = sorted(i * 1000 for i in sum(results, []))
+    p99 = latency[int(len(latency) * 0.99) - 1]
+    return elapsed, statistics.median(latency), p99
+
+
+async def main(writers: int, messages: int) -> None:
+    await database.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await database.execute(
+        sa.insert(user).values(
+            username=name[:25], firstname=name, lastname=name, password="-",
+            email=f"{name}@bench.local", phone=name[-14:],
+        )
+    )
+    rooms: list[int] = []
+    for i in range(writers):
+        new_room = await db_room.create(f"{name}-{i}", False)
+        assert new_room is not None
+        await db_member.create(new_room.id, user_id)
+        rooms.append(new_room.id)
+    try:
+        print(f"{'case':<22}{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for case, send, targets in (
+            ("hot, create", create_message, rooms[:1]),
+            ("hot, insert only", insert_message, rooms[:1]),
+            ("spread, create", create_message, rooms),
+            ("spread, insert only", insert_message, rooms),
+        ):
+            elapsed, p50, p99 = await run_case(send, targets, user_id, writers, messages)
+            rate = writers * messages / elapsed
+            print(f"{case:<22}{rate:>10.0f}{p50:>10.2f}{p99:>10.2f}")
+    finally:
+        await database.execute(sa.delete(message).where(message.c.room_id.in_(rooms)))
+        await database.execute(sa.delete(member).where(member.c.room_id.in_(rooms)))
+        await database.execute(sa.delete(room).where(room.c.id.in_(rooms)))
+        await database.execute(sa.delete(user).where(user.c.id == user_id))
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--writers", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--messages", type=int, default=200, help="messages per client")
+    args = parser.parse_args()
+    asyncio.run(main(args.writers, args.messages))
@@ -0,0 +1,85 @@
+"""
+Import throughput of chats.importer and the event loop lag it causes.
+
+    cd backend && python -m benchmarks.bench_import --rows 200000 --batch 10000
+
+"thread" is MessageImporter as the admin endpoint runs it, each batch is
+read and parsed in a thread; "loop" parses on the event loop, the way the
+import worked before. Rows are NDJSON in a temporary file, lag is measured
+by a LoopMonitor heartbeat running next to the import. The database from
+settings must be running, the benchmark creates its own user and room and
+removes them at the end.
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import uuid
+from typing import Any, Iterable
+
+import sqlalchemy as sa
+from chats.importer import MessageImporter, read_rows
+from chats.models import db_room, member, message, room
+from db import database
+from looplag import LoopMonitor
+from users.models import user
+
+
+class LoopImporter(MessageImporter):
+    async def run(self, rows: Iterable[dict]) -> dict[str, Any]:
+        started = time.perf_counter()
+        rows = iter(rows)
+        while (parsed := self.parse(rows))[0]:
+            await self.import_batch(*parsed)
+        self.stats["seconds"] = round(time.perf_counter() - started, 3)
+        return self.stats
+
+
+async def run_case(importer: MessageImporter, path: str) -> None:
+    monitor = LoopMonitor(interval=0.005, threshold=0)
+    monitor.start()
+    with open(path, newline="") as file:
+        stats = await importer.run(read_rows(file))
+    await monitor.stop()
+    lag = monitor.stats()
+    print(
+        f"{type(importer).__name__:<18}{stats['imported'] / stats['seconds']:>10.0f}"
+        f"{lag['lag_ms_p99']:>12.1f}{lag['lag_ms_max']:>12.1f}"
+    )
+
+
+async def main(rows: int, batch: int) -> None:
+    await database.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await database.execute(
+        sa.insert(user).values(
+            username=name[:25], firstname=name, lastname=name, password="-",
+            email=f"{name}@bench.local", phone=name[-14:],
+        )
+    )
+    new_room = await db_room.create(name, False)
+    assert new_room is not None
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson") as file:
+            for i in range(rows):
+                row = {"room_id": new_room.id, "user_id": user_id, "content": f"message {i}"}
+                file.write(json.dumps(row) + "\n")
+            file.flush()
+            print(f"{'case':<18}{'rows/s':>10}{'lag p99 ms':>12}{'lag max ms':>12}")
+            for importer in (LoopImporter(batch), MessageImporter(batch)):
+                await run_case(importer, file.name)
+    finally:
+        await database.execute(sa.delete(message).where(message.c.room_id == new_room.id))
+        await database.execute(sa.delete(member).where(member.c.room_id == new_room.id))
+        await database.execute(sa.delete(room).where(room.c.id == new_room.id))
+        await database.execute(sa.delete(user).where(user.c.id == user_id))
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200000, help="rows per case")
+    parser.add_argument("--batch", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.batch))
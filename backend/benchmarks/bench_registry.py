@@ -0,0 +1,106 @@
+"""
+Memory and disconnect cost of the websocket registry.
+
+    cd backend && python -m benchmarks.bench_registry --sizes 10000 50000 100000
+
+Sockets are fake and the room presence updates go nowhere, only the registry
+itself is measured. The previous dict[int, list[WebSocket]] registry is
+included as the baseline.
+"""
+import argparse
+import asyncio
+import gc
+import random
+import time
+import tracemalloc
+from typing import Any
+
+from chats import utils
+
+
+class FakeWebSocket:
+    __slots__ = ("sent",)
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def accept(self) -> None:
+        pass
+
+    async def send_text(self, data: str) -> None:
+        self.sent += 1
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        pass
+
+
+class NoDatabase:
+    async def update_is_active(self, room_id: int, bool_value: bool) -> None:
+        pass
+
+
+class ListRegistry:
+    """ The registry before sessions: a list of sockets per room. """
+
+    def __init__(self) -> None:
+        self.active_connections: dict[int, list[Any]] = {}
+
+    async def connect(self, websocket: Any, room_id: int, user_id: int, username: str) -> None:
+        self.active_connections.setdefault(room_id, []).append(websocket)
+
+    async def disconnect(self, websocket: Any, room_id: int) -> None:
+        self.active_connections[room_id].remove(websocket)
+
+
+def rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096
+
+
+async def run(registry: Any, size: int, room_size: int) -> dict[str, float]:
+    sockets = [(FakeWebSocket(), n // room_size) for n in range(size)]
+    gc.collect()
+    rss_before = rss()
+    tracemalloc.start()
+    for n, (websocket, room_id) in enumerate(sockets):
+        await registry.connect(websocket, room_id, n, f"user{n}")
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss()
+    estimate = registry.memory_per_connection() if hasattr(registry, "memory_per_connection") else 0
+
+    random.Random(0).shuffle(sockets)
+    start = time.perf_counter()
+    for websocket, room_id in sockets:
+        await registry.disconnect(websocket, room_id)
+    elapsed = time.perf_counter() - start
+    return {
+        "bytes_per_connection": traced / size,
+        "reported": estimate,
+        "rss_mb": (rss_after - rss_before) / 2 ** 20,
+        "disconnect_us": elapsed / size * 1e6,
+    }
+
+
+async def main(sizes: list[int], room_size: int) -> None:
+    utils.db_room = NoDatabase()  # type: ignore[assignment]
+    print(
+        f"{'registry':<10}{'sockets':>10}{'bytes/conn':>12}{'reported':>10}"
+        f"{'rss MB':>10}{'disconnect us':>15}"
+    )
+    for size in sizes:
+        for name, registry in (("list", ListRegistry()), ("sessions", utils.ConnectionManager())):
+            result = await run(registry, size, room_size)
+            print(
+                f"{name:<10}{size:>10}{result['bytes_per_connection']:>12.0f}"
+                f"{result['reported']:>10.0f}{result['rss_mb']:>10.1f}"
+                f"{result['disconnect_us']:>15.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000, 100_000])
+    parser.add_argument("--room-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.room_size))
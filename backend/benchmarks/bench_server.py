@@ -0,0 +1,104 @@
+"""
+HTTP throughput of the production launcher against the development command.
+
+    cd backend && python -m benchmarks.bench_server --concurrency 64 --duration 10
+
+Each launcher is started on a free port, warmed up and loaded with GET
+requests from one process. Startup connects to Postgres, so the services
+from settings must be running. The client shares the CPU with the server,
+use --path to point at a route that hits the database.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+LAUNCHERS = {
+    "uvicorn --reload": ["{python}", "-m", "uvicorn", "main:app", "--reload", "--port", "{port}"],
+    "server.py": ["{python}", "server.py"],
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str, timeout: float) -> None:
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(url)
+
+
+async def load(url: str, concurrency: int, duration: float) -> tuple[list[float], int]:
+    latencies: list[float] = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=10) as client:
+        deadline = time.perf_counter() + duration
+
+        async def user() -> None:
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def run(name: str, args: argparse.Namespace) -> None:
+    port = free_port()
+    command = [i.format(python=sys.executable, port=port) for i in LAUNCHERS[name]]
+    env = {**os.environ, "SERVER_PORT": str(port), "SERVER_HOST": "127.0.0.1"}
+    if args.workers:
+        env["SERVER_WORKERS"] = str(args.workers)
+    server = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}{args.path}"
+    try:
+        asyncio.run(wait_ready(url, args.timeout))
+        asyncio.run(load(url, args.concurrency, 1))
+        latencies, errors = asyncio.run(load(url, args.concurrency, args.duration))
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    p99 = latencies[len(latencies) * 99 // 100] if latencies else 0
+    print(
+        f"{name:<20}{len(latencies) / args.duration:>10.0f}"
+        f"{statistics.median(latencies) * 1000 if latencies else 0:>10.2f}"
+        f"{p99 * 1000:>10.2f}{errors:>8}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--path", default="/")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=0, help="SERVER_WORKERS for server.py")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    print(f"{'launcher':<20}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name in LAUNCHERS:
+        run(name, args)
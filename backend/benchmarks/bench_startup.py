@@ -0,0 +1,85 @@
+"""
+Worker cold start: import time of main and boot-to-ready time of uvicorn.
+
+    cd backend && python -m benchmarks.bench_startup --runs 5
+
+"import" runs "import main" in a fresh interpreter, no services are needed.
+"boot" starts uvicorn and polls GET / until the worker answers, startup
+connects to Postgres, so the database from settings must be running.
+Both are measured with DB_CREATE_TABLES=True and False.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+IMPORT = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_time(env: dict[str, str]) -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT], env=env, capture_output=True, text=True, check=True
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def boot_time(env: dict[str, str], timeout: float) -> float | None:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "error"],
+        env=env,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                return None
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.02)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(name: str, samples: list[float | None]) -> None:
+    done = [i * 1000 for i in samples if i is not None]
+    if not done:
+        print(f"{name:<28}{'failed':>10}")
+        return
+    print(
+        f"{name:<28}{min(done):>10.1f}{statistics.median(done):>10.1f}"
+        f"{len(samples) - len(done):>8}"
+    )
+
+
+def main(runs: int, timeout: float, boot: bool) -> None:
+    print(f"{'case':<28}{'min ms':>10}{'median ms':>10}{'failed':>8}")
+    for create in ("False", "True"):
+        env = {**os.environ, "DB_CREATE_TABLES": create}
+        report(f"import, create={create}", [import_time(env) for _ in range(runs)])
+        if boot:
+            report(f"boot, create={create}", [boot_time(env, timeout) for _ in range(runs)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--no-boot", dest="boot", action="store_false")
+    args = parser.parse_args()
+    main(args.runs, args.timeout, args.boot)
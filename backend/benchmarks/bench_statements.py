@@ -0,0 +1,83 @@
+"""
+CPU spent in Python per query before it reaches asyncpg.
+
+    cd backend && python -m benchmarks.bench_statements
+
+"databases" builds the SQLAlchemy query and compiles it on every call, the
+way the models did before Statement; "statement" binds values to the query
+compiled once. No database is needed, network time is not included.
+"""
+import argparse
+import timeit
+from typing import Any, Callable
+
+import sqlalchemy as sa
+from chats.models import Member, Message, Room, member, message, room
+from databases.backends.postgres import PostgresBackend
+from settings import DATABASE_URL
+from sqlalchemy.sql import func
+from users.models import User, user
+
+compile_query = PostgresBackend(DATABASE_URL).connection()._compile
+
+CASES: dict[str, tuple[Callable[[], Any], Callable[[], Any]]] = {
+    "Room.by_name": (
+        lambda: compile_query(
+            sa.select(room, func.count(member.c.user_id).label("is_count"))
+            .join(member, member.c.room_id == room.c.id, isouter=True)
+            .where(room.c.name == "room")
+            .group_by(room.c.id)
+        ),
+        lambda: Room._by_name.args({"room_name": "room"}),
+    ),
+    "Member.user_in_room": (
+        lambda: compile_query(
+            sa.select(room.c.id)
+            .join(room, room.c.id == member.c.room_id)
+            .where(room.c.name == "room", member.c.user_id == 1)
+        ),
+        lambda: Member._user_in_room.args({"room_name": "room", "uid": 1}),
+    ),
+    "User.by_username": (
+        lambda: compile_query(
+            sa.select(
+                user.c.id, user.c.username, user.c.firstname, user.c.lastname, user.c.image,
+                user.c.phone, user.c.email, user.c.timestamp, user.c.is_active,
+            ).where(user.c.username == "username")
+        ),
+        lambda: User._by_username.args({"name": "username"}),
+    ),
+    "Message.create": (
+        lambda: compile_query(
+            sa.insert(message).values(key="key", user_id=1, room_id=1, content="content")
+        ),
+        lambda: Message._create.args(
+            {"message_key": "key", "uid": 1, "rid": 1, "text": "content"}
+        ),
+    ),
+    "Message.get_all": (
+        lambda: compile_query(
+            sa.select(message)
+            .where(message.c.room_id == 1)
+            .limit(15)
+            .offset(15)
+            .order_by(message.c.create.desc())
+        ),
+        lambda: Message._get_all.args({"rid": 1, "limit": 15, "offset": 15}),
+    ),
+}
+
+
+def main(number: int) -> None:
+    print(f"{'query':<22}{'databases us':>14}{'statement us':>14}{'saved':>8}")
+    for name, (before, after) in CASES.items():
+        after()
+        old = min(timeit.repeat(before, number=number, repeat=5)) / number * 1e6
+        new = min(timeit.repeat(after, number=number, repeat=5)) / number * 1e6
+        print(f"{name:<22}{old:>14.1f}{new:>14.2f}{1 - new / old:>8.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=2000)
+    main(parser.parse_args().number)
@@ -0,0 +1,326 @@
+"""
+Websocket load: many authenticated clients in many rooms sending at a set rate.
+
+    cd backend && python -m benchmarks.bench_ws_load --clients 2000 --rooms 50 --rate 0.2
+    cd backend && python -m benchmarks.bench_ws_load --url http://127.0.0.1:8000 --clients 500
+
+Without --url server.py is started on a free port with the rate limits
+turned off (--env adds other settings). Users "loaduser..." and rooms
+"loadroom..." are created on the first run and reused later, clients share
+the users round robin. Every client sends "content" frames at --rate per
+second (Poisson arrivals); the send time is carried in the content, so each
+copy a client receives gives the send to broadcast receipt latency.
+Messages sent within --duration are counted, late copies are waited for
+--drain seconds. Expected deliveries are sent messages times the room size
+at send time, the ratio shows frames lost to queue policies.
+
+Results are written as JSON to --output: connect times, latency
+percentiles, throughput, closes by code and RSS of the server workers
+(local server on Linux only). Clients run in one process and share the CPU
+with the server, for thousands of clients raise "ulimit -n" first.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any
+
+import httpx
+from benchmarks.bench_server import free_port, wait_ready
+from seed import letters
+from websockets.client import connect
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+PASSWORD = "loadpassword"
+RATE_LIMITS_OFF = {
+    "RATE_LIMIT_LOGIN_IP": "",
+    "RATE_LIMIT_LOGIN_USER": "",
+    "RATE_LIMIT_REFRESH_IP": "",
+    "RATE_LIMIT_SIGNUP_IP": "",
+    "RATE_LIMIT_WS_CONTENT": "",
+    "RATE_LIMIT_WS_PAGE": "",
+}
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {
+        f"p{name}": round(values[min(int(len(values) * q), len(values) - 1)] * 1000, 3)
+        for name, q in (("50", 0.5), ("90", 0.9), ("99", 0.99), ("999", 0.999))
+    }
+    result["max"] = round(values[-1] * 1000, 3)
+    return result
+
+
+def rss_mb(pid: int) -> dict[int, float]:
+    """ RSS of the process and its children from /proc, empty elsewhere. """
+    result = {}
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        result[current] = int(line.split()[1]) / 1024
+            with open(f"/proc/{current}/task/{current}/children") as file:
+                pids.extend(int(i) for i in file.read().split())
+        except OSError:
+            continue
+    return result
+
+
+async def prepare(url: str, users: int, rooms: int, concurrency: int) -> list[str]:
+    """ Signs up and logs in the users, creates the rooms, returns access tokens. """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+
+        async def token(number: int) -> str:
+            name = f"loaduser{letters(number)}"
+            user = {
+                "username": name,
+                "firstname": name,
+                "lastname": name,
+                "phone": f"7{number:010d}",
+                "email": f"{name}@load.test",
+                "password": PASSWORD,
+            }
+            async with semaphore:
+                response = await client.post("/api/users/signup", json=user)
+                if response.status_code not in (201, 400):
+                    response.raise_for_status()
+                response = await client.post(
+                    "/api/auth/login", data={"username": name, "password": PASSWORD}
+                )
+                response.raise_for_status()
+            return response.json()["access_token"]
+
+        tokens = await asyncio.gather(*(token(i) for i in range(users)))
+        headers = {"Authorization": f"Bearer {tokens[0]}"}
+        for number in range(rooms):
+            room = {"name": f"loadroom{number}", "privat": False}
+            response = await client.post("/api/chat/room", json=room, headers=headers)
+            if response.status_code not in (201, 403):
+                response.raise_for_status()
+    return list(tokens)
+
+
+class Load:
+    def __init__(self, args: argparse.Namespace, tokens: list[str]) -> None:
+        self.args = args
+        self.tokens = tokens
+        self.ws_url = args.url.replace("http", "ws", 1) + "/api/chat/ws/loadroom{}"
+        # Messages sent within the window are counted, whenever they arrive.
+        self.window = (float("inf"), float("inf"))
+        self.stopping = False
+        self.room_sizes: Counter[int] = Counter()
+        self.connected: set[int] = set()
+        self.connect_times: list[float] = []
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.received = 0
+        self.expected = 0
+        self.failed = 0
+        self.rejected = 0
+        self.closes: Counter[str] = Counter()
+
+    async def client(self, number: int) -> None:
+        room = number % self.args.rooms
+        headers = {"Authorization": f"Bearer {self.tokens[number % len(self.tokens)]}"}
+        while not self.stopping:
+            started = time.perf_counter()
+            try:
+                websocket = await connect(
+                    self.ws_url.format(room), extra_headers=headers,
+                    open_timeout=self.args.timeout, max_queue=None,
+                )
+            except (OSError, asyncio.TimeoutError, WebSocketException):
+                self.failed += 1
+                await asyncio.sleep(1)
+                continue
+            self.connect_times.append(time.perf_counter() - started)
+            self.connected.add(number)
+            self.room_sizes[room] += 1
+            try:
+                await self.session(websocket, number, room)
+            finally:
+                self.room_sizes[room] -= 1
+            retry = self.closed(websocket)
+            if retry is None:
+                return
+            await asyncio.sleep(retry)
+
+    def closed(self, websocket: Any) -> float | None:
+        """ Seconds before reconnecting, None when the client is done. """
+        if self.stopping:
+            return None
+        code, reason = websocket.close_code, websocket.close_reason or ""
+        self.closes[str(code)] += 1
+        if reason.startswith("retry-after="):
+            self.rejected += 1
+            return float(reason.split("=", 1)[1])
+        return 1.0
+
+    async def session(self, websocket: Any, number: int, room: int) -> None:
+        sender = asyncio.create_task(self.send(websocket, number, room))
+        try:
+            async for raw in websocket:
+                message = json.loads(raw)
+                if message.get("type") == "ping":
+                    await websocket.send('{"type": "pong"}')
+                    continue
+                content = message.get("content")
+                if isinstance(content, str) and content.startswith("load "):
+                    sent_at = float(content.split()[2])
+                    if self.window[0] <= sent_at <= self.window[1]:
+                        self.latencies.append(time.perf_counter() - sent_at)
+                        self.received += 1
+        except ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+
+    async def send(self, websocket: Any, number: int, room: int) -> None:
+        if not self.args.rate:
+            return
+        while True:
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            sent_at = time.perf_counter()
+            await websocket.send(json.dumps({"content": f"load {number} {sent_at}"}))
+            if self.window[0] <= sent_at <= self.window[1]:
+                self.sent += 1
+                self.expected += self.room_sizes[room]
+
+    async def run(self, pid: int | None) -> dict[str, Any]:
+        args = self.args
+        started = time.perf_counter()
+        tasks = []
+        for number in range(args.clients):
+            tasks.append(asyncio.create_task(self.client(number)))
+            if args.connect_rate:
+                await asyncio.sleep(1 / args.connect_rate)
+        while len(self.connected) < args.clients and time.perf_counter() - started < 600:
+            await asyncio.sleep(0.1)
+        ramp_up = time.perf_counter() - started
+        await asyncio.sleep(args.warmup)
+
+        memory: dict[int, list[float]] = {}
+        measured = time.perf_counter()
+        self.window = (measured, float("inf"))
+        while time.perf_counter() - measured < args.duration:
+            if pid is not None:
+                for worker, mb in rss_mb(pid).items():
+                    memory.setdefault(worker, []).append(mb)
+            await asyncio.sleep(1)
+        duration = time.perf_counter() - measured
+        self.window = (measured, measured + duration)
+        # Messages still in flight are waited for.
+        await asyncio.sleep(args.drain)
+        self.stopping = True
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        return {
+            "connect": {
+                "clients": args.clients,
+                "connected": len(self.connected),
+                "ramp_up_seconds": round(ramp_up, 3),
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "ms": percentiles(self.connect_times),
+            },
+            "latency_ms": percentiles(self.latencies),
+            "sent": self.sent,
+            "received": self.received,
+            "expected": self.expected,
+            "delivery_ratio": round(self.received / self.expected, 4) if self.expected else None,
+            "sent_per_second": round(self.sent / duration, 1),
+            "received_per_second": round(self.received / duration, 1),
+            "closes": dict(self.closes),
+            "memory_mb": {
+                str(worker): {"max": round(max(values), 1), "last": round(values[-1], 1)}
+                for worker, values in memory.items()
+            },
+        }
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return out.stdout.strip()
+
+
+def main(args: argparse.Namespace) -> dict[str, Any]:
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    server = None
+    if not args.url:
+        port = free_port()
+        env = {
+            **os.environ,
+            **RATE_LIMITS_OFF,
+            **dict(i.split("=", 1) for i in args.env),
+            "SERVER_HOST": "127.0.0.1",
+            "SERVER_PORT": str(port),
+            "SERVER_WORKERS": str(args.workers),
+        }
+        server = subprocess.Popen([sys.executable, "server.py"], env=env, stderr=subprocess.DEVNULL)
+        args.url = f"http://127.0.0.1:{port}"
+    try:
+        if server is not None:
+            asyncio.run(wait_ready(f"{args.url}/", args.timeout))
+        tokens = asyncio.run(prepare(args.url, min(args.users, args.clients), args.rooms, 16))
+        results = asyncio.run(Load(args, tokens).run(server.pid if server else None))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return {
+        "benchmark": "ws_load",
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--url", default="", help="running server, by default server.py is started")
+    parser.add_argument("--workers", type=int, default=1, help="SERVER_WORKERS of server.py")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for server.py")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0.2, help="messages per second per client")
+    parser.add_argument("--connect-rate", type=float, default=200, help="new clients per second")
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain", type=float, default=5, help="wait for messages in flight")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    data = main(args)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    output = args.output or f"ws_load-{stamp}.json"
+    with open(output, "w") as file:
+        json.dump(data, file, indent=2)
+    print(json.dumps(data["results"], indent=2))
+    print(f"written to {output}")
@@ -1,28 +1,60 @@
+import json
 import uuid
-from typing import Any
+from typing import Any, AsyncIterator
 
 from asyncpg import Record
 from asyncpg.exceptions import UniqueViolationError
 from chats import utils
-from chats.models import Member, Message, Room
-from chats.schemas import Friend, RoomName, RoomOut, UserWeb
-from db import database
+from chats.models import db_member, db_message, db_room
+from chats.schemas import (Friend, ReadAck, RoomName, RoomOut, RoomSummary,
+                           UserWeb)
+from chats.sharding import HashRing, sharding
+from db import query_scope
+from etag import etag, not_modified
 from fastapi import APIRouter, Depends, Query, status
-from fastapi.responses import JSONResponse
-from settings import LIMIT, LIMIT_MAX, NOT_FOUND
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from metrics import registry
+from ratelimit import limiter
+from settings import (EXPORT_BATCH, EXPORT_BATCH_MAX, LIMIT, LIMIT_MAX,
+                      NOT_FOUND, SHARDING, WS_RATE_LIMIT_STRIKES,
+                      WS_SHARD_CLOSE_CODE)
 from starlette.requests import Request
 from starlette.websockets import WebSocket, WebSocketDisconnect
-from users.models import User
+from tracing import tracer
+from users.models import db_user
 from users.utils import get_current_user, list_path_image
 
 router = APIRouter(prefix='/chat', tags=["chat"])
-db_room = Room(database)
-db_user = User(database)
-db_member = Member(database)
-db_message = Message(database)
 manager = utils.ConnectionManager()
+admission = utils.Admission()
+purger = utils.RoomPurger()
 PROTECTED = Depends(get_current_user)
 
+registry.gauge(
+    "ws_connections", "Open websockets by room.",
+    lambda: [((room_id,), len(i)) for room_id, i in manager.active_connections.items()],
+    ("room",),
+)
+registry.gauge(
+    "ws_queued", "Messages waiting in the send queues by room.",
+    lambda: [((room_id,), i["queued"]) for room_id, i in manager.stats().items()],
+    ("room",),
+)
+registry.counter_callback(
+    "ws_dropped_total", "Messages dropped by full send queues.",
+    lambda: [((room_id,), count) for room_id, count in manager.dropped.items()],
+    ("room",),
+)
+registry.gauge(
+    "ws_admission", "Websocket handshakes admitted or waiting for a slot.",
+    lambda: [(("active",), admission.active), (("waiting",), admission.waiting)],
+    ("state",),
+)
+registry.counter_callback(
+    "ws_admission_rejected_total", "Websocket handshakes rejected.",
+    lambda: [((), admission.rejected)],
+)
+
 
 @router.post("/room", response_model=RoomOut, status_code=status.HTTP_201_CREATED)
 async def create(room_name: RoomName, user: UserWeb = PROTECTED) -> Any:
@@ -39,8 +71,62 @@ async def create(room_name: RoomName, user: UserWeb = PROTECTED) -> Any:
 
 
 @router.get("/room/{name}", response_model=RoomOut, status_code=status.HTTP_200_OK)
-async def get_room(name: str, user: UserWeb = PROTECTED) -> JSONResponse:
-    return await db_room.by_name(name) or NOT_FOUND
+async def get_room(
+    request: Request, response: Response, name: str, user: UserWeb = PROTECTED
+) -> Any:
+    """Сначала сверяется только версия, участники считаются, если комната изменилась."""
+    room = await db_room.version(name)
+    if not room:
+        return NOT_FOUND
+    return (
+        not_modified(request, response, etag("r", room.id, room.version))
+        or await db_room.by_name(name)
+        or NOT_FOUND
+    )
+
+
+@router.get("/room/{name}/shard", status_code=status.HTTP_200_OK)
+async def get_shard(name: str, user: UserWeb = PROTECTED) -> dict[str, str]:
+    """Воркер комнаты, передается в вебсокет как ?shard=<имя> для nginx."""
+    return {"shard": sharding.owner(name)}
+
+
+@router.get("/room/{name}/export", status_code=status.HTTP_200_OK)
+async def export_room(
+    name: str,
+    after: str | None = Query(None),
+    batch: int = Query(EXPORT_BATCH, ge=1, le=EXPORT_BATCH_MAX),
+    user: UserWeb = PROTECTED,
+) -> Response:
+    """
+    Вся история комнаты в NDJSON, от старых сообщений к новым, строка на сообщение.
+    after - ключ последнего полученного сообщения, чтобы продолжить прерванную выгрузку,
+    ключа нет в комнате - 404.
+    Доступна только для участников комнаты.
+    """
+    room = await db_member.user_in_room(name, user.id)
+    if not room:
+        return JSONResponse({"detail": "Need to join a group"}, status.HTTP_403_FORBIDDEN)
+    if after is not None and not await db_message.exists(room.id, after):
+        return JSONResponse({"detail": "Message not found"}, status.HTTP_404_NOT_FOUND)
+
+    async def lines() -> AsyncIterator[str]:
+        chunk = []
+        async for row in db_message.export(room.id, after, batch):
+            chunk.append(json.dumps({
+                "key": row.key,
+                "user_id": row.user_id,
+                "room_id": row.room_id,
+                "content": row.content,
+                "create": row.create.isoformat() if row.create else None,
+            }, ensure_ascii=False))
+            if len(chunk) >= batch:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @router.get("/room/{name}/member", response_model=list[UserWeb], status_code=status.HTTP_200_OK)
@@ -87,36 +173,87 @@ async def get_all_rooms(
     return await db_room.all_rooms(page, limit, is_active)
 
 
+@router.get("/my-rooms", response_model=list[RoomSummary], status_code=status.HTTP_200_OK)
+async def get_my_rooms(
+    page: int = Query(1, ge=1),
+    limit: int = Query(LIMIT, ge=LIMIT, lt=LIMIT_MAX),
+    user: UserWeb = PROTECTED,
+) -> list[Record] | list[None]:
+    """Комнаты пользователя с последним сообщением и числом непрочитанных, новые сверху."""
+    return await db_member.my_rooms(user.id, page, limit)
+
+
+@router.post("/room/{name}/read", status_code=status.HTTP_200_OK)
+async def read_room(name: str, ack: ReadAck, user: UserWeb = PROTECTED) -> JSONResponse:
+    """Отмечает прочитанным все до сообщения key, без key - до последнего."""
+    room = await db_member.user_in_room(name, user.id)
+    read = room and await db_member.read(room.id, user.id, ack.key)
+    if not read:
+        return JSONResponse({"detail": "Need to join a group"}, status.HTTP_403_FORBIDDEN)
+    return JSONResponse({"last_read_key": read.last_read_key, "unread": read.unread})
+
+
 @router.delete("/room/{name}", status_code=status.HTTP_200_OK)
 async def delete_room(name: str, user: UserWeb = PROTECTED) -> JSONResponse:
+    """Комната скрывается сразу, ее сообщения удаляются в фоне."""
     if not await db_room.delete(name):
         return NOT_FOUND
+    purger.wake()
     return JSONResponse({"detail": "OK"}, status.HTTP_200_OK)
 
 
+@sharding.on_rebalance
+async def rebalance(ring: HashRing) -> None:
+    """После изменения состава воркеров отдает чужие комнаты новым владельцам."""
+    if not SHARDING or not manager.active_connections:
+        return
+    for room in await db_room.names(list(manager.active_connections)):
+        if room and ring.owner(room.name) != sharding.name:
+            await manager.move(room.id, ring.owner(room.name))
+
+
 @router.websocket("/ws/{room_name}")
 async def websocket_endpoint(
     websocket: WebSocket,
     room_name: str,
     limit: int = Query(LIMIT, ge=LIMIT, lt=LIMIT_MAX),
-    user: UserWeb = Depends(utils.get_current_user)
+    token: str | None = Depends(utils.ws_oauth2_scheme),
 ) -> None:
     """
     Структура сообщений между пользователем и сервером: {
-        "type": "Отключает соединение - disconnect или удаляет пользователя из группы - delete",
+        "type": "Отключает соединение - disconnect или удаляет пользователя из группы - delete,
+            ответ на ping сервера - pong, проверка соединения клиентом - ping,
+            прочитано все до "key" (или до последнего) - read",
         "page": "Выдает список сообщений "messages". Лимит задается при подключении в limit.",
         "key": "uuid сообщения.",
         "content": "Текст сообщения.",
     }
+    При SHARDING=True комната обслуживается одним воркером, на чужом воркере
+    соединение закрывается с кодом WS_SHARD_CLOSE_CODE и "shard=<воркер>".
+    Проверка токена, запросы комнаты и добавление в участники выполняются
+    не более чем WS_HANDSHAKE_CONCURRENCY раз одновременно, при перегрузке
+    соединение закрывается с кодом 1013 и "retry-after=<секунды>".
     """
-    room = await db_room.by_name(room_name, privat=True)
-    if room and room.privat is True:
-        if not await db_member.user_in_room(room_name, user.id):
-            return
-
-    if user and room:
-        try:
-            await manager.connect(websocket, room.id)
+    if manager.draining:
+        await admission.reject(websocket, status.WS_1012_SERVICE_RESTART)
+        return
+    if SHARDING and not sharding.is_local(room_name):
+        await websocket.accept()
+        await websocket.close(WS_SHARD_CLOSE_CODE, f"shard={sharding.owner(room_name)}")
+        return
+    if not await admission.acquire():
+        await admission.reject(websocket)
+        return
+    try:
+        with query_scope("ws connect"), tracer.trace(f"ws connect {room_name}"):
+            user = await utils.get_current_user(token)
+            room = await db_room.by_name(room_name, privat=True)
+            if not user or not room:
+                return
+            if room.privat is True and not await db_member.user_in_room(room_name, user.id):
+                return
+
+            await manager.connect(websocket, room.id, user.id, user.username)
             if await db_member.create(room.id, user.id):
                 """
                 Добавляет пользователя в список участников группы.
@@ -128,10 +265,23 @@ async def websocket_endpoint(
                     "content": f"{user.username} has entered the chat",
                 }
                 await manager.broadcast(message, room.id)
+    finally:
+        admission.release()
 
-            while True:
-                message = await websocket.receive_json()
+    strikes = 0
+    try:
+        while True:
+            message = await websocket.receive_json()
+            manager.touch(websocket)
+
+            if message.get("type") == "pong":
+                continue
+            if message.get("type") == "ping":
+                await manager.send_personal_message({"type": "pong"}, websocket)
+                continue
 
+            frame = f"ws {utils.frame_kind(message)}"
+            with query_scope(frame), tracer.trace(frame):
                 if "type" in message and message["type"] in ["disconnect", "delete"]:
                     await manager.disconnect(websocket, room.id)
                     if message["type"] == "delete":
@@ -144,6 +294,43 @@ async def websocket_endpoint(
                         await manager.broadcast(message, room.id)
                     break
 
+                """
+                Лимит на "page" и "content" для пользователя. Отклоненный фрейм не сохраняется,
+                после WS_RATE_LIMIT_STRIKES отказов подряд соединение закрывается.
+                """
+                is_page = "page" in message or message.get("type") == "read"
+                kind = "ws.page" if is_page else "ws.content"
+                retry = await limiter.hit(kind, user.id)
+                if retry:
+                    strikes += 1
+                    if strikes >= WS_RATE_LIMIT_STRIKES:
+                        await websocket.close(status.WS_1008_POLICY_VIOLATION, "Too Many Requests")
+                        await manager.disconnect(websocket, room.id)
+                        break
+                    await manager.send_personal_message(
+                        {
+                            "detail": "Too Many Requests",
+                            "retry_after": retry,
+                            "key": message.get("key"),
+                        },
+                        websocket,
+                    )
+                    continue
+                strikes = 0
+
+                if message.get("type") == "read":
+                    read = await db_member.read(room.id, user.id, message.get("key"))
+                    await manager.send_personal_message(
+                        {
+                            "type": "read",
+                            "room_id": room.id,
+                            "key": read.last_read_key if read else None,
+                            "unread": read.unread if read else 0,
+                        },
+                        websocket,
+                    )
+                    continue
+
                 if "page" in message and int(message["page"]) > 0:
                     message_list = await db_message.get_all(room.id, int(message["page"]), limit)
                     all_messages = {
@@ -176,5 +363,5 @@ async def websocket_endpoint(
                         room.id,
                     )
 
-        except WebSocketDisconnect:
-            await manager.disconnect(websocket, room.id)
+    except WebSocketDisconnect:
+        await manager.disconnect(websocket, room.id)
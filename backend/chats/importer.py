@@ -0,0 +1,194 @@
+"""
+Импорт сообщений из NDJSON или CSV через COPY.
+
+    cd backend && python -m chats.importer messages.ndjson
+    cd backend && python -m chats.importer messages.csv --format csv --batch 50000
+
+Строка: room_id, user_id, content, необязательные key (uuid) и create (ISO 8601).
+В CSV первая строка - заголовок с этими именами. Без key генерируется uuid4,
+сообщения с уже существующим key пропускаются. Строки с несуществующими
+комнатой или пользователем, с неверным key или без content не импортируются.
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Iterable, Iterator, TextIO
+
+import sqlalchemy as sa
+from chats.models import member, message, not_deleted, room
+from db import Statement, database, raw_connection
+from settings import IMPORT_BATCH, SNIPPET_LENGTH
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func
+from users.models import user
+
+FORMATS = ("ndjson", "csv")
+COLUMNS = ["key", "user_id", "room_id", "content", "create"]
+CREATE_STAGE = (
+    "CREATE TEMPORARY TABLE messages_import (LIKE messages INCLUDING DEFAULTS) ON COMMIT DROP"
+)
+
+stage = sa.Table(
+    "messages_import", sa.MetaData(),
+    *[sa.Column(column.name, column.type) for column in message.columns],
+)
+# Комната и пользователь проверяются здесь же, без отдельных запросов на пачку.
+valid = (
+    sa.select(*[stage.c[name] for name in COLUMNS])
+    .where(
+        sa.exists().where(room.c.id == stage.c.room_id, not_deleted),
+        sa.exists().where(user.c.id == stage.c.user_id),
+    )
+    .cte("valid")
+)
+inserted = (
+    insert(message)
+    # По порядку key вставки идут в индекс первичного ключа подряд, а не вразброс.
+    .from_select(COLUMNS, sa.select(*[valid.c[name] for name in COLUMNS]).order_by(valid.c.key))
+    .on_conflict_do_nothing(index_elements=[message.c.key])
+    .returning(message.c.key, message.c.room_id, message.c.content, message.c.create)
+    .cte("inserted")
+)
+# Последнее сообщение и число новых сообщений каждой комнаты.
+last = (
+    sa.select(
+        inserted.c.room_id,
+        inserted.c.key,
+        inserted.c.content,
+        inserted.c.create,
+        func.count().over(partition_by=inserted.c.room_id).label("total"),
+    )
+    .distinct(inserted.c.room_id)
+    .order_by(inserted.c.room_id, inserted.c.create.desc(), inserted.c.key.desc())
+    .cte("last")
+)
+newer = sa.or_(room.c.last_activity.is_(None), last.c.create >= room.c.last_activity)
+# Импортируется история: участникам она засчитывается прочитанной.
+read = (
+    sa.update(member)
+    .where(member.c.room_id == last.c.room_id)
+    .values(read_count=member.c.read_count + last.c.total)
+    .returning(member.c.id)
+    .cte("read")
+)
+updated = (
+    sa.update(room)
+    .where(room.c.id == last.c.room_id)
+    .values(
+        message_count=room.c.message_count + last.c.total,
+        last_message_key=sa.case((newer, last.c.key), else_=room.c.last_message_key),
+        last_snippet=sa.case(
+            (newer, func.left(last.c.content, SNIPPET_LENGTH)), else_=room.c.last_snippet
+        ),
+        last_activity=func.greatest(room.c.last_activity, last.c.create),
+    )
+    .returning(last.c.total)
+    .cte("updated")
+)
+merge = Statement(
+    sa.select(
+        sa.select(func.count()).select_from(valid).scalar_subquery(),
+        func.coalesce(func.sum(updated.c.total), 0),
+    )
+    .add_cte(inserted)
+    .add_cte(read),
+    name="MessageImporter.merge",
+)
+
+
+def read_rows(file: TextIO, format: str = "ndjson") -> Iterator[dict]:
+    if format == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Неразобранная строка считается неверной, импорт продолжается.
+                yield {}
+
+
+def to_record(row: dict, now: datetime) -> tuple | None:
+    """ Кортеж в порядке COLUMNS или None, если строка неверна. """
+    try:
+        key = row.get("key") or uuid.uuid4().hex
+        uuid.UUID(str(key))
+        create = row.get("create")
+        return (
+            str(key),
+            int(row["user_id"]),
+            int(row["room_id"]),
+            str(row["content"]),
+            datetime.fromisoformat(create) if create else now,
+        )
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class MessageImporter:
+    def __init__(self, batch: int = IMPORT_BATCH) -> None:
+        self.batch = batch
+        self.stats = {"read": 0, "imported": 0, "duplicates": 0, "invalid": 0, "seconds": 0.0}
+
+    async def run(self, rows: Iterable[dict]) -> dict[str, Any]:
+        started = time.perf_counter()
+        rows = iter(rows)
+        # Чтение и разбор пачки идут в потоке, event loop в это время
+        # обслуживает остальные запросы и вебсокеты воркера.
+        while (parsed := await asyncio.to_thread(self.parse, rows))[0]:
+            await self.import_batch(*parsed)
+        self.stats["seconds"] = round(time.perf_counter() - started, 3)
+        return self.stats
+
+    def parse(self, rows: Iterator[dict]) -> tuple[int, list[tuple]]:
+        """ Следующая пачка: число прочитанных строк и верные из них в порядке COLUMNS. """
+        chunk = list(itertools.islice(rows, self.batch))
+        now = datetime.now(timezone.utc)
+        return len(chunk), [record for record in (to_record(row, now) for row in chunk) if record]
+
+    async def import_batch(self, read: int, records: list[tuple]) -> None:
+        self.stats["read"] += read
+        self.stats["invalid"] += read - len(records)
+        if not records:
+            return
+        # args() compiles the statement on the first call, before merge.sql is read.
+        args = merge.args({})
+        async with raw_connection(database) as connection:
+            async with connection.transaction():
+                await connection.execute(CREATE_STAGE)
+                await connection.copy_records_to_table(
+                    "messages_import", records=records, columns=COLUMNS
+                )
+                valid, imported = await connection.fetchrow(merge.sql, *args)
+        # sum() over bigint is numeric, asyncpg returns Decimal.
+        self.stats["invalid"] += len(records) - valid
+        self.stats["imported"] += int(imported)
+        self.stats["duplicates"] += valid - int(imported)
+
+
+async def main(path: str, format: str, batch: int) -> None:
+    await database.connect()
+    try:
+        with open(path, newline="") if path != "-" else sys.stdin as file:
+            stats = await MessageImporter(batch).run(read_rows(file, format))
+    finally:
+        await database.disconnect()
+    if stats["seconds"]:
+        stats["rows_per_second"] = round(stats["imported"] / stats["seconds"])
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="file or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--batch", type=int, default=IMPORT_BATCH)
+    args = parser.parse_args()
+    asyncio.run(main(args.path, args.format, args.batch))
@@ -1,10 +1,13 @@
+from datetime import timedelta
+from typing import AsyncIterator
 from uuid import UUID
 
 import sqlalchemy as sa
 from asyncpg import Record
 from asyncpg.exceptions import UniqueViolationError
-from db import Base, metadata
-from settings import LIMIT
+from db import Base, Statement, database, metadata
+from settings import LIMIT, SNIPPET_LENGTH
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql import func
 from users.models import user
 
@@ -13,10 +16,24 @@ ProjectType = list[Record] | list[None]
 room = sa.Table(
     "rooms", metadata,
     sa.Column("id", sa.Integer, primary_key=True),
-    sa.Column("name", sa.String(100), nullable=False, unique=True, index=True),
+    sa.Column("name", sa.String(100), nullable=False),
     sa.Column("timestamp", sa.DateTime(timezone=True), default=func.now()),
     sa.Column("privat", sa.Boolean, nullable=False, default=False),
     sa.Column("is_active", sa.Boolean, nullable=False, default=False),
+    # Удаленная комната скрыта сразу, сообщения и участники удаляются в фоне.
+    sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+    sa.Column("purged", sa.BigInteger, nullable=False, server_default="0"),
+    sa.Column("purge_lease", sa.DateTime(timezone=True), nullable=True),
+    # Сводка для списка чатов, обновляется при каждом сообщении.
+    sa.Column("last_message_key", sa.String, nullable=True),
+    sa.Column("last_snippet", sa.String(SNIPPET_LENGTH), nullable=True),
+    sa.Column("last_activity", sa.DateTime(timezone=True), nullable=True),
+    sa.Column("message_count", sa.BigInteger, nullable=False, server_default="0"),
+    # ETag комнаты: меняется вместе с is_active и составом участников.
+    sa.Column("version", sa.Integer, nullable=False, server_default="1"),
+    sa.Index(
+        "ix_rooms_name", "name", unique=True, postgresql_where=sa.text("deleted_at IS NULL")
+    ),
 )
 member = sa.Table(
     "members", metadata,
@@ -24,36 +41,198 @@ member = sa.Table(
     sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id", ondelete='CASCADE')),
     sa.Column("room_id", sa.Integer, sa.ForeignKey("rooms.id", ondelete='CASCADE')),
     sa.Column("create", sa.DateTime(timezone=True), default=func.now()),
+    # Непрочитанные: rooms.message_count - read_count.
+    sa.Column("last_read_key", sa.String, nullable=True),
+    sa.Column("read_count", sa.BigInteger, nullable=False, server_default="0"),
     sa.UniqueConstraint('user_id', 'room_id', name='unique_member'),
+    sa.Index("ix_members_room_id", "room_id"),
 )
 message = sa.Table(
     "messages", metadata,
-    sa.Column("key", sa.String, primary_key=True, unique=True, index=True),
+    sa.Column("key", sa.String, primary_key=True),
     sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id", ondelete='CASCADE')),
     sa.Column("room_id", sa.Integer, sa.ForeignKey("rooms.id", ondelete='CASCADE')),
     sa.Column("content", sa.Text, nullable=False),
     sa.Column("create", sa.DateTime(timezone=True), default=func.now()),
+    sa.Index("ix_messages_room_id_create", "room_id", "create", "key"),
 )
+not_deleted = room.c.deleted_at.is_(None)
+
+
+def purge_batch(table: sa.Table, key: sa.Column) -> Statement:
+    """
+    Удаляет до batch строк комнаты rid из table и продлевает аренду,
+    возвращает число удаленных строк.
+    """
+    deleted = (
+        sa.delete(table)
+        .where(key.in_(sa.select(key).where(table.c.room_id == sa.bindparam("rid"))
+                       .limit(sa.bindparam("batch"))))
+        .returning(key)
+        .cte("deleted")
+    )
+    count = sa.select(func.count()).select_from(deleted).scalar_subquery()
+    return Statement(
+        sa.update(room)
+        .where(room.c.id == sa.bindparam("rid"))
+        .values(
+            purged=room.c.purged + count,
+            purge_lease=func.now() + sa.cast(sa.bindparam("lease"), sa.Interval),
+        )
+        .returning(count.label("deleted"))
+        .add_cte(deleted)
+    )
+
+
+# Ключ сообщения из подтверждения прочтения, если оно есть в комнате.
+read_key = (
+    sa.select(message.c.key)
+    .where(message.c.key == sa.bindparam("message_key"), message.c.room_id == sa.bindparam("rid"))
+    .scalar_subquery()
+)
+# Прочитано: все сообщения комнаты, кроме более новых, чем read_key.
+read_count = room.c.message_count - sa.select(func.count()).where(
+    message.c.room_id == sa.bindparam("rid"),
+    message.c.create > sa.select(message.c.create)
+    .where(message.c.key == sa.bindparam("message_key"), message.c.room_id == sa.bindparam("rid"))
+    .scalar_subquery(),
+).scalar_subquery()
+inserted = (
+    sa.insert(message)
+    .values(
+        key=sa.bindparam("message_key"),
+        user_id=sa.bindparam("uid"),
+        room_id=sa.bindparam("rid"),
+        content=sa.bindparam("text"),
+    )
+    .returning(message.c.key, message.c.room_id, message.c.content, message.c.create)
+    .cte("inserted")
+)
+# Свои сообщения автор не читает: его read_count растет вместе с message_count.
+own_read = (
+    sa.update(member)
+    .where(
+        member.c.room_id == sa.bindparam("rid"),
+        member.c.user_id == sa.bindparam("uid"),
+        room.c.id == member.c.room_id,
+    )
+    .values(
+        read_count=member.c.read_count + 1,
+        last_read_key=sa.case(
+            (member.c.read_count >= room.c.message_count, sa.bindparam("message_key")),
+            else_=member.c.last_read_key,
+        ),
+    )
+    .returning(member.c.id)
+    .cte("own_read")
+)
+
+
+def bump_version(change: sa.sql.dml.UpdateBase) -> sa.sql.Update:
+    """
+    Добавление или удаление участника вместе с увеличением версии комнаты
+    одним запросом. change возвращает id и room_id, запрос - id.
+    """
+    changed = change.cte("changed")
+    return (
+        sa.update(room)
+        .where(room.c.id == changed.c.room_id)
+        .values(version=room.c.version + 1)
+        .returning(changed.c.id)
+        .add_cte(changed)
+    )
 
 
 class Room(Base):
-    async def create(self, name: str, privat: bool) -> Record | None:
-        return await self.database.fetch_one(
-            sa.insert(room)
-            .values(name=name, privat=privat, is_active=False)
-            .returning(room)
+    _create = Statement(
+        sa.insert(room)
+        .values(name=sa.bindparam("room_name"), privat=sa.bindparam("is_privat"), is_active=False)
+        .returning(room)
+    )
+    _by_name = Statement(
+        sa.select(room, func.count(member.c.user_id).label("is_count"))
+        .join(member, member.c.room_id == room.c.id, isouter=True)
+        .where(room.c.name == sa.bindparam("room_name"), not_deleted)
+        .group_by(room.c.id)
+    )
+    _all_rooms = Statement(
+        sa.select(room, func.count(member.c.user_id).label("is_count"))
+        .join(member, member.c.room_id == room.c.id, isouter=True)
+        .where(room.c.privat == False, room.c.is_active == sa.bindparam("active"), not_deleted)
+        .limit(sa.bindparam("limit"))
+        .offset(sa.bindparam("offset"))
+        .group_by(room.c.id)
+        .order_by(room.c.timestamp.desc()),
+        replica=True,
+    )
+    _version = Statement(
+        sa.select(room.c.id, room.c.version)
+        .where(room.c.name == sa.bindparam("room_name"), not_deleted)
+    )
+    # Без изменения строка не переписывается и версия остается прежней.
+    _update_is_active = Statement(
+        sa.update(room)
+        .where(room.c.id == sa.bindparam("room_id"), room.c.is_active != sa.bindparam("active"))
+        .values(is_active=sa.bindparam("active"), version=room.c.version + 1)
+        .returning(room)
+    )
+    _delete = Statement(
+        sa.update(room)
+        .where(room.c.name == sa.bindparam("room_name"), not_deleted)
+        .values(deleted_at=func.now(), is_active=False)
+        .returning(room.c.id)
+    )
+    _names = Statement(
+        sa.select(room.c.id, room.c.name).where(
+            room.c.id == sa.any_(sa.bindparam("ids", type_=ARRAY(sa.Integer))), not_deleted
+        )
+    )
+    _claim_purge = Statement(
+        sa.update(room)
+        .where(
+            room.c.id == sa.select(room.c.id)
+            .where(
+                room.c.deleted_at.isnot(None),
+                sa.or_(room.c.purge_lease.is_(None), room.c.purge_lease < func.now()),
+            )
+            .order_by(room.c.deleted_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        .values(purge_lease=func.now() + sa.cast(sa.bindparam("lease"), sa.Interval))
+        .returning(room.c.id)
+    )
+    _purge_messages = purge_batch(message, message.c.key)
+    _purge_members = purge_batch(member, member.c.id)
+    _purge_room = Statement(
+        sa.delete(room).where(room.c.id == sa.bindparam("rid"), room.c.deleted_at.isnot(None))
+    )
+    _purges = Statement(
+        sa.select(
+            room.c.id,
+            room.c.name,
+            room.c.deleted_at,
+            room.c.purged,
+            room.c.purge_lease,
+            sa.select(func.count()).where(message.c.room_id == room.c.id)
+            .scalar_subquery().label("messages_left"),
+            sa.select(func.count()).where(member.c.room_id == room.c.id)
+            .scalar_subquery().label("members_left"),
         )
+        .where(room.c.deleted_at.isnot(None))
+        .order_by(room.c.deleted_at)
+    )
+
+    async def create(self, name: str, privat: bool) -> Record | None:
+        return await self.fetch_one(self._create, room_name=name, is_privat=privat)
 
     async def by_name(self, name: str, privat: bool | None = False) -> Record | None:
-        qyery = (
-            sa.select(room, func.count(member.c.user_id).label("is_count"))
-            .join(member, member.c.room_id == room.c.id, isouter=True)
-            .where(room.c.name == name)
-            .group_by(room.c.id)
-        )
-        if not privat:
-            qyery.where(room.c.privat == sa.false)
-        return await self.database.fetch_one(qyery)
+        return await self.fetch_one(self._by_name, room_name=name)
+
+    async def version(self, name: str) -> Record | None:
+        """ id и version без подсчета участников, для If-None-Match. """
+        return await self.fetch_one(self._version, room_name=name)
 
     async def all_rooms(
         self,
@@ -62,95 +241,247 @@ class Room(Base):
         is_active: bool | None = True,
     ) -> ProjectType:
 
-        return await self.database.fetch_all(
-            sa.select(room, func.count(member.c.user_id).label("is_count"))
-            .join(member, member.c.room_id == room.c.id, isouter=True)
-            .where(room.c.privat == False, room.c.is_active == is_active)
-            .limit(limit)
-            .offset((page - 1) * limit)
-            .group_by(room.c.id)
-            .order_by(room.c.timestamp.desc())
+        return await self.fetch_all(
+            self._all_rooms, active=is_active, limit=limit, offset=(page - 1) * limit
         )
 
+    async def names(self, room_ids: list[int]) -> ProjectType:
+        return await self.fetch_all(self._names, ids=room_ids)
+
     async def update_is_active(self, room_id: int, bool_value: bool) -> Record | None:
-        return await self.database.fetch_one(
-            sa.update(room)
-            .where(room.c.id == room_id)
-            .values(is_active=bool_value)
-            .returning(room)
-        )
+        """ None, если значение уже такое. """
+        return await self.fetch_one(self._update_is_active, room_id=room_id, active=bool_value)
 
     async def delete(self, name: str) -> bool:
-        await self.database.execute(
-            sa.delete(room).where(room.c.name == name)
-        )
-        return True
+        """ Мягкое удаление, строки позже удаляет purge. """
+        return bool(await self.execute(self._delete, room_name=name))
+
+    async def claim_purge(self, lease: timedelta) -> int | None:
+        """ id удаленной комнаты, которую сейчас никто не чистит, она наша на lease. """
+        return await self.execute(self._claim_purge, lease=lease)
+
+    async def purge_messages(self, room_id: int, batch: int, lease: timedelta) -> int:
+        return await self.execute(
+            self._purge_messages, rid=room_id, batch=batch, lease=lease
+        ) or 0
+
+    async def purge_members(self, room_id: int, batch: int, lease: timedelta) -> int:
+        return await self.execute(
+            self._purge_members, rid=room_id, batch=batch, lease=lease
+        ) or 0
+
+    async def purge_room(self, room_id: int) -> None:
+        await self.execute(self._purge_room, rid=room_id)
+
+    async def purges(self) -> ProjectType:
+        return await self.fetch_all(self._purges)
 
 
 class Member(Base):
+    _create = Statement(
+        bump_version(
+            sa.insert(member)
+            .values(
+                user_id=sa.bindparam("uid"),
+                room_id=sa.bindparam("rid"),
+                read_count=sa.select(room.c.message_count)
+                .where(room.c.id == sa.bindparam("rid"))
+                .scalar_subquery(),
+            )
+            .returning(member.c.id, member.c.room_id)
+        )
+    )
+    _user_in_room = Statement(
+        sa.select(room.c.id)
+        .join(room, room.c.id == member.c.room_id)
+        .where(
+            room.c.name == sa.bindparam("room_name"),
+            member.c.user_id == sa.bindparam("uid"),
+            not_deleted,
+        )
+    )
+    _by_room_id = Statement(
+        sa.select(
+            user.c.id,
+            user.c.username,
+            user.c.firstname,
+            user.c.lastname,
+            user.c.image,
+            user.c.timestamp,
+            user.c.is_active,
+        )
+        .where(member.c.room_id == sa.bindparam("rid"))
+        .join(user, user.c.id == member.c.user_id)
+        .limit(sa.bindparam("limit"))
+        .offset(sa.bindparam("offset"))
+        .order_by(member.c.create.desc()),
+        replica=True,
+    )
+    _remove = Statement(
+        bump_version(
+            sa.delete(member)
+            .where(
+                member.c.room_id == sa.bindparam("rid"),
+                member.c.user_id == sa.bindparam("uid"),
+            )
+            .returning(member.c.id, member.c.room_id)
+        )
+    )
+
+    _read = Statement(
+        sa.update(member)
+        .where(
+            member.c.room_id == sa.bindparam("rid"),
+            member.c.user_id == sa.bindparam("uid"),
+            room.c.id == member.c.room_id,
+        )
+        .values(
+            last_read_key=sa.case(
+                (
+                    read_count >= member.c.read_count,
+                    func.coalesce(read_key, room.c.last_message_key),
+                ),
+                else_=member.c.last_read_key,
+            ),
+            read_count=func.greatest(member.c.read_count, read_count),
+        )
+        .returning(
+            member.c.last_read_key,
+            (room.c.message_count - member.c.read_count).label("unread"),
+        )
+    )
+    _my_rooms = Statement(
+        sa.select(
+            room.c.id,
+            room.c.name,
+            room.c.privat,
+            room.c.is_active,
+            room.c.last_message_key,
+            room.c.last_snippet,
+            room.c.last_activity,
+            room.c.message_count,
+            member.c.last_read_key,
+            (room.c.message_count - member.c.read_count).label("unread"),
+        )
+        .join(room, room.c.id == member.c.room_id)
+        .where(member.c.user_id == sa.bindparam("uid"), not_deleted)
+        .order_by(room.c.last_activity.desc().nulls_last(), room.c.id.desc())
+        .limit(sa.bindparam("limit"))
+        .offset(sa.bindparam("offset")),
+        replica=True,
+    )
+
     async def create(self, room_id: int, user_id: int) -> Record | bool:
         try:
-            return await self.database.execute(
-                sa.insert(member).values(user_id=user_id, room_id=room_id)
-            )
+            return await self.execute(self._create, rid=room_id, uid=user_id)
         except UniqueViolationError:
             return False
 
     async def user_in_room(self, room_name: str, user_id: int) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(room.c.id)
-            .join(room, room.c.id == member.c.room_id)
-            .where(room.c.name == room_name, member.c.user_id == user_id)
-        )
+        return await self.fetch_one(self._user_in_room, room_name=room_name, uid=user_id)
 
     async def by_room_id(self, room_id: int, page: int = 1, limit: int = LIMIT) -> ProjectType:
-        return await self.database.fetch_all(
-            sa.select(
-                user.c.id,
-                user.c.username,
-                user.c.firstname,
-                user.c.lastname,
-                user.c.image,
-                user.c.timestamp,
-                user.c.is_active,
-            )
-            .where(member.c.room_id == room_id)
-            .join(user, user.c.id == member.c.user_id)
-            .limit(limit)
-            .offset((page - 1) * limit)
-            .order_by(member.c.create.desc())
+        return await self.fetch_all(
+            self._by_room_id, rid=room_id, limit=limit, offset=(page - 1) * limit
         )
 
     async def remove(self, room_id: int, user_id: int) -> bool:
-        await self.database.execute(
-            sa.delete(member).where(
-                member.c.room_id == room_id,
-                member.c.user_id == user_id,
-            )
-        )
+        await self.execute(self._remove, rid=room_id, uid=user_id)
         return True
 
+    async def read(self, room_id: int, user_id: int, key: str | None = None) -> Record | None:
+        """
+        Отмечает прочитанным все до сообщения key включительно,
+        без key или с чужим key - до последнего. Назад указатель не двигается.
+        """
+        return await self.fetch_one(self._read, rid=room_id, uid=user_id, message_key=key)
+
+    async def my_rooms(self, user_id: int, page: int = 1, limit: int = LIMIT) -> ProjectType:
+        return await self.fetch_all(
+            self._my_rooms, uid=user_id, limit=limit, offset=(page - 1) * limit
+        )
+
 
 class Message(Base):
+    # Сообщение и сводка комнаты пишутся одним запросом: message_count и
+    # read_count участников всегда согласованы, непрочитанные не расходятся.
+    # Цена - блокировка строки комнаты до конца запроса, сообщения одной
+    # комнаты записываются по очереди. Сравнение с отдельным INSERT:
+    # python -m benchmarks.bench_hot_room.
+    _create = Statement(
+        sa.update(room)
+        .where(room.c.id == inserted.c.room_id)
+        .values(
+            last_message_key=inserted.c.key,
+            last_snippet=func.left(inserted.c.content, SNIPPET_LENGTH),
+            last_activity=inserted.c.create,
+            message_count=room.c.message_count + 1,
+        )
+        .returning(room.c.message_count)
+        .add_cte(inserted)
+        .add_cte(own_read)
+    )
+    _export = Statement(
+        sa.select(message)
+        .where(message.c.room_id == sa.bindparam("rid"))
+        .order_by(message.c.create, message.c.key),
+        replica=True,
+    )
+    _export_after = Statement(
+        sa.select(message)
+        .where(
+            message.c.room_id == sa.bindparam("rid"),
+            sa.tuple_(message.c.create, message.c.key) > sa.tuple_(
+                sa.select(message.c.create)
+                .where(message.c.key == sa.bindparam("after"))
+                .scalar_subquery(),
+                sa.bindparam("after"),
+            ),
+        )
+        .order_by(message.c.create, message.c.key),
+        replica=True,
+    )
+    _exists = Statement(
+        sa.select(message.c.key).where(
+            message.c.key == sa.bindparam("message_key"), message.c.room_id == sa.bindparam("rid")
+        ),
+        replica=True,
+    )
+    _get_all = Statement(
+        sa.select(message)
+        .where(message.c.room_id == sa.bindparam("rid"))
+        .limit(sa.bindparam("limit"))
+        .offset(sa.bindparam("offset"))
+        .order_by(message.c.create.desc()),
+        replica=True,
+    )
+
     async def create(self, key: UUID, room_id: int, user_id: int, content: str) -> int | None:
+        """ Сохраняет сообщение и обновляет сводку комнаты, возвращает message_count. """
         try:
-            return await self.database.execute(
-                sa.insert(message)
-                .values(
-                    key=key,
-                    user_id=user_id,
-                    room_id=room_id,
-                    content=content
-                )
+            return await self.execute(
+                self._create, message_key=key, uid=user_id, rid=room_id, text=content
             )
         except UniqueViolationError:
             return False
 
+    async def exists(self, room_id: int, key: str) -> bool:
+        return await self.fetch_one(self._exists, rid=room_id, message_key=key) is not None
+
     async def get_all(self, room_id: int, page: int = 1, limit: int = LIMIT) -> ProjectType:
-        return await self.database.fetch_all(
-            sa.select(message)
-            .where(message.c.room_id == room_id)
-            .limit(limit)
-            .offset((page - 1) * limit)
-            .order_by(message.c.create.desc())
+        return await self.fetch_all(
+            self._get_all, rid=room_id, limit=limit, offset=(page - 1) * limit
         )
+
+    def export(
+        self, room_id: int, after: str | None = None, batch: int = 500
+    ) -> AsyncIterator[Record]:
+        """ Все сообщения комнаты от старых к новым, после сообщения с ключом after. """
+        if after is None:
+            return self.iterate(self._export, prefetch=batch, rid=room_id)
+        return self.iterate(self._export_after, prefetch=batch, rid=room_id, after=after)
+
+
+db_room = Room(database)
+db_member = Member(database)
+db_message = Message(database)
@@ -28,3 +28,20 @@ class RoomOut(RoomName):
     privat: bool
     is_active: bool = False
     is_count: int | None = 0
+
+
+class ReadAck(BaseModel):
+    key: str | None = None
+
+
+class RoomSummary(BaseModel):
+    id: int
+    name: str
+    privat: bool
+    is_active: bool
+    last_message_key: str | None = None
+    last_snippet: str | None = None
+    last_activity: datetime | None = None
+    message_count: int = 0
+    last_read_key: str | None = None
+    unread: int = 0
@@ -0,0 +1,109 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from typing import Awaitable, Callable
+
+from db import redis
+from redis.asyncio import Redis
+from settings import (SHARD_HEARTBEAT, SHARD_NAME, SHARD_NODES, SHARD_TTL,
+                      SHARD_VNODES)
+
+logger = logging.getLogger("chats")
+RebalanceHook = Callable[["HashRing"], Awaitable[None]]
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Консистентное хеширование комнат по воркерам.
+    При добавлении или удалении воркера переезжает только ~1/N комнат.
+    """
+
+    def __init__(self, nodes: list[str], vnodes: int = SHARD_VNODES) -> None:
+        self.nodes = sorted(set(nodes))
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes)
+        )
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, room_name: str) -> str:
+        if not self._keys:
+            return SHARD_NAME
+        index = bisect.bisect(self._keys, _hash(room_name)) % len(self._keys)
+        return self._nodes[index]
+
+
+class Sharding:
+    """
+    Состав воркеров хранится в Redis: каждый воркер раз в SHARD_HEARTBEAT
+    обновляет свою метку, воркеры без метки дольше SHARD_TTL выпадают из кольца.
+    Если задан SHARD_NODES, состав фиксирован и Redis не нужен.
+    """
+
+    key = "shards"
+
+    def __init__(self, name: str = SHARD_NAME, nodes: list[str] = SHARD_NODES) -> None:
+        self.name = name
+        self.static = bool(nodes)
+        self.ring = HashRing(nodes or [name])
+        self.hooks: list[RebalanceHook] = []
+        self._redis: Redis | None = None
+        self._task: asyncio.Task | None = None
+
+    def owner(self, room_name: str) -> str:
+        return self.ring.owner(room_name)
+
+    def is_local(self, room_name: str) -> bool:
+        return self.owner(room_name) == self.name
+
+    def on_rebalance(self, hook: RebalanceHook) -> RebalanceHook:
+        self.hooks.append(hook)
+        return hook
+
+    async def start(self) -> None:
+        if self.static or (self._task and not self._task.done()):
+            return
+        self._redis = redis
+        await self.refresh()
+        self._task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        """Убирает воркер из кольца, его комнаты сразу переходят к остальным."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._redis is not None:
+            await self._redis.zrem(self.key, self.name)
+            self._redis = None
+
+    async def refresh(self) -> None:
+        if self._redis is None:
+            return
+        now = time.time()
+        async with self._redis.pipeline() as pipe:
+            pipe.zadd(self.key, {self.name: now})
+            pipe.zremrangebyscore(self.key, 0, now - SHARD_TTL)
+            pipe.zrange(self.key, 0, -1)
+            *_, nodes = await pipe.execute()
+        if sorted(nodes) != self.ring.nodes:
+            self.ring = HashRing(nodes)
+            for hook in self.hooks:
+                await hook(self.ring)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(SHARD_HEARTBEAT)
+            try:
+                await self.refresh()
+            except Exception:
+                # Воркер остается в кольце до SHARD_TTL, следующая попытка через SHARD_HEARTBEAT.
+                logger.exception("Shard %s heartbeat failed", self.name)
+
+
+sharding = Sharding()
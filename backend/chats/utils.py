@@ -1,45 +1,484 @@
+import asyncio
+import contextvars
 import json
+import logging
+import random
+import sys
+import time
 import uuid
-from typing import Any, Optional
+from collections import deque
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Optional
 
-from chats.models import Room
-from db import database
-from fastapi import Depends, WebSocket
-from settings import JWT_ACCESS_SECRET_KEY
+from chats.models import db_room
+from fastapi import Depends, WebSocket, status
+from metrics import SIZE_BUCKETS, registry
+from settings import (DRAIN_FLUSH_TIMEOUT, JWT_ACCESS_SECRET_KEY, PURGE_BATCH,
+                      PURGE_INTERVAL, PURGE_LEASE, PURGE_PAUSE,
+                      WS_HANDSHAKE_CONCURRENCY, WS_HANDSHAKE_QUEUE,
+                      WS_HANDSHAKE_TIMEOUT, WS_IDLE_CLOSE_CODE,
+                      WS_IDLE_TIMEOUT, WS_PING_INTERVAL, WS_QUEUE_CLOSE_CODE,
+                      WS_QUEUE_POLICY, WS_QUEUE_SIZE, WS_RETRY_AFTER,
+                      WS_RETRY_JITTER, WS_SHARD_CLOSE_CODE)
 from users.deps_auth import WebSocketOAuth2PasswordBearer
 from users.utils import check_token
 
-db_room = Room(database)
+logger = logging.getLogger("chats")
 ws_oauth2_scheme = WebSocketOAuth2PasswordBearer(token_url='/chat/token')
+QUEUE_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+FRAME_TYPES = ("ping", "pong", "disconnect", "delete", "read")
+PING = {"type": "ping"}
+RECONNECT = {"type": "reconnect"}
+# Служебные фреймы не вытесняются из очереди и не склеиваются:
+# от "reconnect" зависят drain и переезд комнаты на другой шард.
+CONTROL_TYPES = ("ping", "pong", "reconnect")
+# Ключ, значение и хеш в таблице словаря, без учета разреженности.
+DICT_ENTRY_SIZE = 3 * 8
+CleanupHook = Callable[[WebSocket, int], Awaitable[None]]
+Queue = deque[tuple[dict, str | None]]
+
+WS_BROADCAST = registry.histogram(
+    "ws_broadcast_duration_seconds", "Serializing a message and queueing it for the room."
+)
+WS_FANOUT = registry.histogram(
+    "ws_broadcast_recipients", "Connections a broadcast was queued for.", buckets=SIZE_BUCKETS
+)
+WS_RECEIVED = registry.counter("ws_frames_received_total", "Frames received from clients.")
+WS_SENT = registry.counter("ws_frames_sent_total", "Frames sent to clients.")
+
+
+class Session:
+    """
+    Запись о коннекте пользователя. __slots__, ленивые очередь и writer держат
+    простаивающий коннект около 300 байт вместе с ячейками реестра: deque
+    не длиннее queue_size и задача на отправку живут, только пока есть что отправить.
+    """
+
+    __slots__ = (
+        "websocket", "user_id", "username", "room_id", "connected_at", "last_seen",
+        "received", "sent", "dropped", "queue", "writer", "closing",
+    )
+
+    def __init__(self, websocket: WebSocket, room_id: int, user_id: int, username: str) -> None:
+        self.websocket = websocket
+        self.user_id = user_id
+        self.username = username
+        self.room_id = room_id
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.queue: Queue | None = None
+        self.writer: asyncio.Task | None = None
+        self.closing = False
 
 
 class ConnectionManager:
-    def __init__(self) -> None:
-        self.active_connections: dict[int, list[WebSocket]] = {}
+    def __init__(
+        self,
+        queue_size: int = WS_QUEUE_SIZE,
+        policy: str = WS_QUEUE_POLICY,
+        close_code: int = WS_QUEUE_CLOSE_CODE,
+        ping_interval: float = WS_PING_INTERVAL,
+        idle_timeout: float = WS_IDLE_TIMEOUT,
+    ) -> None:
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        # Словари вместо списков: добавление и удаление коннекта за O(1).
+        self.active_connections: dict[int, dict[WebSocket, Session]] = {}
+        self.connections: dict[WebSocket, Session] = {}
+        self.dropped: dict[int, int] = {}
+        self.queue_size = queue_size
+        self.policy = policy
+        self.close_code = close_code
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.cleanup_hooks: list[CleanupHook] = []
+        self.draining = False
+        self._reaper: asyncio.Task | None = None
 
-    async def connect(self, websocket: WebSocket, room_id: int) -> None:
-        """Создает словарь с ключом группы и значением в виде списка коннектов."""
+    async def connect(
+        self, websocket: WebSocket, room_id: int, user_id: int = 0, username: str = ""
+    ) -> Session:
+        """Создает словарь с ключом группы и значением в виде словаря коннектов."""
         await websocket.accept()
         await db_room.update_is_active(room_id, True)
-        if room_id in self.active_connections:
-            self.active_connections[room_id].append(websocket)
-        else:
-            self.active_connections[room_id] = [websocket]
+        session = Session(websocket, room_id, user_id, username)
+        self.connections[websocket] = session
+        self.active_connections.setdefault(room_id, {})[websocket] = session
+        self._start_reaper()
+        return session
 
     async def disconnect(self, websocket: WebSocket, room_id: int = 0) -> None:
         """Удаляет коннект пользователя из группы."""
-        self.active_connections[room_id].remove(websocket)
-        if room_id in self.active_connections and len(self.active_connections[room_id]) == 0:
-            await db_room.update_is_active(room_id, False)
+        session = self.connections.pop(websocket, None)
+        if session is None:
+            return
+        if session.writer is not None and not session.closing:
+            session.writer.cancel()
+        room = self.active_connections.get(session.room_id, {})
+        room.pop(websocket, None)
+        if not room:
+            self.active_connections.pop(session.room_id, None)
+            await db_room.update_is_active(session.room_id, False)
+        for hook in self.cleanup_hooks:
+            await hook(websocket, session.room_id)
+
+    def on_disconnect(self, hook: CleanupHook) -> CleanupHook:
+        """Регистрирует функцию, которая вызывается после удаления коннекта."""
+        self.cleanup_hooks.append(hook)
+        return hook
+
+    def touch(self, websocket: WebSocket) -> None:
+        """Отмечает, что от пользователя пришел фрейм."""
+        session = self.connections.get(websocket)
+        if session is not None:
+            session.last_seen = time.monotonic()
+            session.received += 1
+            WS_RECEIVED.inc()
 
     async def send_personal_message(self, message: dict, websocket: WebSocket) -> None:
         """Отправляет персональные сообщения."""
-        await websocket.send_text(f"{json.dumps(message, ensure_ascii=False, default=str)}")
+        session = self.connections.get(websocket)
+        if session is not None:
+            self._enqueue(session, message, None)
 
     async def broadcast(self, message: dict, room_id: int) -> None:
-        """Отправляет сообщения всем в группе."""
-        for connection in self.active_connections[room_id]:
-            await connection.send_text(f"{json.dumps(message, ensure_ascii=False, default=str)}")
+        """
+        Отправляет сообщения всем в группе.
+        Сообщение сериализуется один раз и кладется в очередь каждого коннекта.
+        """
+        started = time.perf_counter()
+        text = self._dumps(message)
+        sessions = list(self.active_connections.get(room_id, {}).values())
+        for session in sessions:
+            self._enqueue(session, message, text)
+        WS_BROADCAST.since(started)
+        WS_FANOUT.observe(len(sessions))
+
+    def stats(self) -> dict[int, dict[str, int]]:
+        """Глубина очередей и количество отброшенных сообщений по комнатам."""
+        result = {}
+        for room_id, sessions in self.active_connections.items():
+            depths = [len(i.queue or ()) for i in sessions.values()]
+            result[room_id] = {
+                "connections": len(depths),
+                "queued": sum(depths),
+                "max_queued": max(depths, default=0),
+                "dropped": self.dropped.get(room_id, 0),
+            }
+        return result
+
+    def memory_per_connection(self) -> float:
+        """
+        Средний размер записи коннекта в байтах: сама запись, очередь, имя
+        и две ячейки словарей реестра. Сокет принадлежит серверу и не учитывается.
+        """
+        if not self.connections:
+            return 0
+        total = sum(
+            sys.getsizeof(i) + sys.getsizeof(i.username)
+            + (sys.getsizeof(i.queue) if i.queue is not None else 0)
+            for i in self.connections.values()
+        )
+        return total / len(self.connections) + 2 * DICT_ENTRY_SIZE
+
+    def _enqueue(self, session: Session, message: dict, text: str | None) -> None:
+        """Кладет сообщение в очередь, при переполнении применяет политику."""
+        if session.closing:
+            return
+        queue = session.queue
+        if queue is None:
+            queue = session.queue = deque()
+        if len(queue) >= self.queue_size and message.get("type") not in CONTROL_TYPES:
+            if self.policy == "disconnect":
+                self._drop(session, len(queue) + 1)
+                self._close(session, self.close_code, "Slow consumer")
+                return
+            if self.policy == "coalesce":
+                self._coalesce(session, queue)
+            else:
+                self._drop_oldest(session, queue)
+        queue.append((message, text))
+        if session.writer is None:
+            # Пустой контекст: задача переживает запрос, в трассу и счетчики
+            # запросов которого иначе попадала бы ее работа.
+            session.writer = asyncio.create_task(
+                self._writer(session, queue), context=contextvars.Context()
+            )
+
+    def _drop_oldest(self, session: Session, queue: Queue) -> None:
+        """Отбрасывает самое старое сообщение, служебные фреймы остаются."""
+        for index, (message, _) in enumerate(queue):
+            if message.get("type") not in CONTROL_TYPES:
+                del queue[index]
+                self._drop(session)
+                return
+
+    def _coalesce(self, session: Session, queue: Queue) -> None:
+        """
+        Склеивает сообщения комнаты в одно со списком "messages", как в ответе
+        на "page", остальные фреймы идут за ним в прежнем порядке.
+        Самые старые сообщения сверх лимита отбрасываются.
+        """
+        messages, others = [], []
+        for message, text in queue:
+            if message.get("coalesced"):
+                messages.extend(message["messages"])
+            # Сообщения комнаты кладет broadcast, уже сериализованными.
+            elif text is not None:
+                messages.append(message)
+            else:
+                others.append((message, text))
+        if not messages:
+            self._drop_oldest(session, queue)
+            return
+        overflow = len(messages) - self.queue_size + 1
+        if overflow > 0:
+            self._drop(session, overflow)
+            messages = messages[overflow:]
+        queue.clear()
+        batch = {"room_id": session.room_id, "coalesced": True, "messages": messages}
+        queue.append((batch, None))
+        queue.extend(others)
+
+    async def drain(self, window: float = 0, flush_timeout: float = DRAIN_FLUSH_TIMEOUT) -> None:
+        """
+        Перестает принимать новые коннекты, а текущим в случайный момент
+        в пределах window отправляет "reconnect", дожидается отправки очереди
+        и закрывает сокет с кодом 1012, чтобы клиенты переподключались не все сразу.
+        """
+        self.draining = True
+        sessions = list(self.connections.values())
+        random.shuffle(sessions)
+        step = window / len(sessions) if sessions else 0
+        await asyncio.gather(
+            *(self._drain_one(i, n * step, flush_timeout) for n, i in enumerate(sessions))
+        )
+
+    async def move(self, room_id: int, shard: str) -> None:
+        """Отправляет всех участников комнаты на другой воркер."""
+        frame, reason = {"type": "reconnect", "shard": shard}, f"shard={shard}"
+        sessions = list(self.active_connections.get(room_id, {}).values())
+        await asyncio.gather(
+            *(
+                self._drain_one(i, 0, DRAIN_FLUSH_TIMEOUT, frame, WS_SHARD_CLOSE_CODE, reason)
+                for i in sessions
+            )
+        )
+
+    async def _drain_one(
+        self,
+        session: Session,
+        delay: float,
+        flush_timeout: float,
+        frame: dict = RECONNECT,
+        code: int = status.WS_1012_SERVICE_RESTART,
+        reason: str = "Reconnect",
+    ) -> None:
+        await asyncio.sleep(delay)
+        self._enqueue(session, frame, None)
+        deadline = time.monotonic() + flush_timeout
+        while session.queue and not session.closing and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if not session.closing:
+            self._close(session, code, reason)
+        await self.disconnect(session.websocket, session.room_id)
+
+    def _start_reaper(self) -> None:
+        """Одна задача на цикл событий, переживает переподключения TestClient."""
+        loop = asyncio.get_running_loop()
+        if self._reaper is None or self._reaper.done() or self._reaper.get_loop() is not loop:
+            self._reaper = loop.create_task(self._reap(), context=contextvars.Context())
+
+    async def _reap(self) -> None:
+        """
+        Раз в ping_interval отправляет "ping" молчащим коннектам
+        и закрывает те, от которых ничего не было дольше idle_timeout.
+        """
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for session in list(self.connections.values()):
+                # Ошибка на одном коннекте не должна останавливать задачу.
+                try:
+                    idle = now - session.last_seen
+                    if idle > self.idle_timeout:
+                        self._close(session, WS_IDLE_CLOSE_CODE, "Idle timeout")
+                        await self.disconnect(session.websocket, session.room_id)
+                    elif idle >= self.ping_interval:
+                        self._enqueue(session, PING, None)
+                except Exception:
+                    logger.exception("Reaping connection in room %s failed", session.room_id)
+
+    def _drop(self, session: Session, count: int = 1) -> None:
+        session.dropped += count
+        self.dropped[session.room_id] = self.dropped.get(session.room_id, 0) + count
+
+    def _close(self, session: Session, code: int, reason: str = "") -> None:
+        """Останавливает отправку и закрывает сокет, остальное делает disconnect."""
+        session.closing = True
+        session.queue = None
+        if session.writer is not None:
+            session.writer.cancel()
+        session.writer = asyncio.create_task(session.websocket.close(code, reason))
+
+    async def _writer(self, session: Session, queue: Queue) -> None:
+        """
+        Отправляет сообщения из очереди и завершается, когда она пуста.
+        Пустая очередь освобождается, следующее сообщение создаст новую.
+        """
+        try:
+            while queue:
+                message, text = queue.popleft()
+                await session.websocket.send_text(text or self._dumps(message))
+                session.sent += 1
+                WS_SENT.inc()
+            session.writer = None
+            session.queue = None
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Сокет уже не рабочий: закрываем его и убираем коннект из комнаты.
+            session.writer = None
+            self._close(session, status.WS_1011_INTERNAL_ERROR, "Send failed")
+            await self.disconnect(session.websocket, session.room_id)
+
+    @staticmethod
+    def _dumps(message: dict) -> str:
+        return json.dumps(message, ensure_ascii=False, default=str)
+
+
+class Admission:
+    """
+    Ограничивает число одновременных подключений к вебсокету на воркер.
+    Остальные ждут в очереди не дольше timeout, лишние сразу получают отказ.
+    """
+
+    def __init__(
+        self,
+        limit: int = WS_HANDSHAKE_CONCURRENCY,
+        queue_size: int = WS_HANDSHAKE_QUEUE,
+        timeout: float = WS_HANDSHAKE_TIMEOUT,
+    ) -> None:
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore, self._loop = asyncio.Semaphore(self.limit), loop
+        return self._semaphore
+
+    async def acquire(self) -> bool:
+        semaphore = self.semaphore
+        if semaphore.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+            self.active += 1
+            return True
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self.semaphore.release()
+
+    @staticmethod
+    async def reject(websocket: WebSocket, code: int = status.WS_1013_TRY_AGAIN_LATER) -> None:
+        """Закрывает сокет с подсказкой, через сколько секунд переподключиться."""
+        retry_after = WS_RETRY_AFTER + random.uniform(0, WS_RETRY_JITTER)
+        await websocket.accept()
+        await websocket.close(code, f"retry-after={retry_after:.1f}")
+
+    def stats(self) -> dict[str, int]:
+        return {"active": self.active, "waiting": self.waiting, "rejected": self.rejected}
+
+
+class RoomPurger:
+    """
+    Удаляет сообщения и участников удаленных комнат пачками в фоне,
+    затем саму комнату. Комната захватывается на lease, аренда продлевается
+    с каждой пачкой: после перезапуска или падения воркера удаление
+    продолжит любой воркер, удаленные строки не возвращаются.
+    """
+
+    def __init__(
+        self,
+        batch: int = PURGE_BATCH,
+        pause: float = PURGE_PAUSE,
+        interval: float = PURGE_INTERVAL,
+        lease: float = PURGE_LEASE,
+    ) -> None:
+        self.batch = batch
+        self.pause = pause
+        self.interval = interval
+        self.lease = timedelta(seconds=lease)
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def purge_next(self) -> bool:
+        room_id = await db_room.claim_purge(self.lease)
+        if room_id is None:
+            return False
+        for purge in (db_room.purge_messages, db_room.purge_members):
+            while await purge(room_id, self.batch, self.lease):
+                await asyncio.sleep(self.pause)
+        await db_room.purge_room(room_id)
+        return True
+
+    def backoff(self, failures: int) -> float:
+        """ Пауза после failures ошибок подряд: от interval, вдвое больше, до 10 interval. """
+        return self.interval * min(2 ** (failures - 1), 10)
+
+    async def _run(self) -> None:
+        failures = 0
+        while True:
+            try:
+                while await self.purge_next():
+                    pass
+                failures = 0
+            except Exception:
+                failures += 1
+                logger.exception("Room purge failed, %d in a row", failures)
+            assert self._wakeup is not None
+            if failures:
+                # Пробуждения не ускоряют повтор, пока база отвечает ошибкой.
+                await asyncio.sleep(self.backoff(failures))
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
 
 
 async def get_current_user(token: Optional[str] = Depends(ws_oauth2_scheme)) -> Any:
@@ -49,6 +488,13 @@ async def get_current_user(token: Optional[str] = Depends(ws_oauth2_scheme)) ->
     return await check_token(token, JWT_ACCESS_SECRET_KEY)
 
 
+def frame_kind(message: dict) -> str:
+    """Вид фрейма для метрик и логов, тип от клиента не попадает в метки как есть."""
+    if message.get("type") in FRAME_TYPES:
+        return message["type"]
+    return "page" if "page" in message else "content"
+
+
 async def is_valid_uuid(val: Any) -> bool:
     """Проверка ключа по которому сохраняется сообщение."""
     try:
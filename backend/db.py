@@ -1,12 +1,592 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+from collections.abc import Mapping
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Iterator
+
+import asyncpg
 import databases
 import sqlalchemy
-from settings import DATABASE_URL
+from databases.backends.postgres import PostgresBackend, PostgresConnection
+from metrics import SIZE_BUCKETS, Samples, registry
+from redis.asyncio import Redis as AsyncRedis
+from settings import (DATABASE_REPLICA_URLS, DATABASE_URL, DB_ACQUIRE_TIMEOUT,
+                      DB_CONN_MAX_LIFETIME, DB_CONNECT_TIMEOUT,
+                      DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE, DB_QUERY_BUDGET,
+                      DB_SLOW_QUERY_MS, DB_STATEMENT_CACHE_SIZE,
+                      DB_STATEMENT_TIMEOUT, REDIS_URL, REPLICA_CHECK_INTERVAL,
+                      REPLICA_MAX_LAG)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.sql import ClauseElement, Select
+from tracing import span
+
+DB_QUERY = registry.histogram(
+    "db_query_duration_seconds", "Query time by model statement, without waiting for the pool.",
+    ("statement", "target"),
+)
+REDIS_COMMAND = registry.histogram(
+    "redis_command_duration_seconds", "Redis round trip by command.", ("command",)
+)
+SCOPE_QUERIES = registry.histogram(
+    "db_queries_per_scope", "Queries per request or websocket message.", ("scope",), SIZE_BUCKETS
+)
+logger = logging.getLogger("db")
+CREATE_TABLES_LOCK = "SELECT pg_advisory_xact_lock(hashtext('create_tables'))"
+SCHEMA_COLUMNS = (
+    "SELECT table_name, column_name FROM information_schema.columns"
+    " WHERE table_schema = current_schema()"
+)
+
+
+class PoolTimeout(Exception):
+    """ No free connection in the pool within the acquire timeout. """
+
+
+class PooledConnection(asyncpg.Connection):
+    """
+    Remembers when it was opened, for the max lifetime. databases hands the
+    same connection to a task and the tasks it starts, query_lock keeps them
+    from running queries on it at the same time.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.opened_at = time.monotonic()
+        self.query_lock = asyncio.Lock()
+
+
+class PoolConnection(PostgresConnection):
+    """ Counts waiters and acquire latency, closes connections older than max_lifetime. """
+
+    _database: "PoolBackend"
+
+    async def acquire(self) -> None:
+        assert self._connection is None, "Connection is already acquired"
+        assert self._database._pool is not None, "DatabaseBackend is not running"
+        backend = self._database
+        backend.waiting += 1
+        started = time.perf_counter()
+        try:
+            self._connection = await self._database._pool.acquire(
+                timeout=backend.acquire_timeout or None
+            )
+        except asyncio.TimeoutError:
+            backend.timeouts += 1
+            raise PoolTimeout(f"No free database connection in {backend.acquire_timeout}s")
+        finally:
+            backend.waiting -= 1
+        backend.acquired += 1
+        backend.latency.append(time.perf_counter() - started)
+
+    async def release(self) -> None:
+        backend = self._database
+        connection = self._connection
+        if (
+            connection is not None
+            and backend.max_lifetime
+            and time.monotonic() - connection.opened_at > backend.max_lifetime
+        ):
+            # The pool opens a new one on the next acquire.
+            await connection.close()
+            backend.recycled += 1
+        await super().release()
+
+
+class PoolBackend(PostgresBackend):
+    def __init__(
+        self,
+        database_url: Any,
+        acquire_timeout: float = DB_ACQUIRE_TIMEOUT,
+        max_lifetime: float = DB_CONN_MAX_LIFETIME,
+        **options: Any,
+    ) -> None:
+        super().__init__(database_url, **options)
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.latency: deque[float] = deque(maxlen=1000)
+
+    def connection(self) -> PoolConnection:
+        return PoolConnection(self, self._dialect)
+
+    def stats(self) -> dict[str, Any]:
+        latency = sorted(self.latency)
+        size = self._pool.get_size() if self._pool else 0
+        idle = self._pool.get_idle_size() if self._pool else 0
+        return {
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "min_size": self._pool.get_min_size() if self._pool else 0,
+            "max_size": self._pool.get_max_size() if self._pool else 0,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "recycled": self.recycled,
+            "acquire_ms_p50": round(latency[len(latency) // 2] * 1000, 3) if latency else 0,
+            "acquire_ms_p99": round(latency[len(latency) * 99 // 100] * 1000, 3) if latency else 0,
+            "acquire_ms_max": round(latency[-1] * 1000, 3) if latency else 0,
+        }
+
+
+class Database(databases.Database):
+    """ databases.Database on PoolBackend, with the pool settings from settings.py. """
+
+    _backend: PoolBackend
+
+    def __init__(self, url: str, **options: Any) -> None:
+        options = {
+            "min_size": DB_POOL_MIN_SIZE,
+            "max_size": DB_POOL_MAX_SIZE,
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "connection_class": PooledConnection,
+            "server_settings": {"statement_timeout": str(int(DB_STATEMENT_TIMEOUT * 1000))},
+            **options,
+        }
+        super().__init__(url, **options)
+
+    def _get_backend(self) -> str:
+        return f"{__name__}:PoolBackend"
+
+    async def connect(self, timeout: float = DB_CONNECT_TIMEOUT) -> None:
+        """ Retries for up to timeout seconds, Postgres may start after the worker. """
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            try:
+                return await super().connect()
+            except (OSError, asyncpg.CannotConnectNowError):
+                if time.monotonic() + delay > deadline:
+                    raise
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2)
+
+    def pool_stats(self) -> dict[str, Any]:
+        return self._backend.stats()
+
+
+class Redis(AsyncRedis):
+    """ Times every command, a pipeline is timed as one "pipeline" command. """
+
+    async def execute_command(self, *args: Any, **options: Any) -> Any:
+        command = str(args[0]).lower()
+        started = time.perf_counter()
+        try:
+            with span(f"redis {command}"):
+                return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND.since(started, (command,))
+
+    def pipeline(self, transaction: bool = True, shard_hint: Any = None) -> Any:
+        pipeline = super().pipeline(transaction, shard_hint)
+        execute = pipeline.execute
+
+        async def timed(raise_on_error: bool = True) -> Any:
+            started = time.perf_counter()
+            try:
+                with span("redis pipeline"):
+                    return await execute(raise_on_error)
+            finally:
+                REDIS_COMMAND.since(started, ("pipeline",))
+
+        pipeline.execute = timed  # type: ignore[method-assign]
+        return pipeline
+
 
 metadata = sqlalchemy.MetaData()
-database = databases.Database(DATABASE_URL)
-engine = sqlalchemy.create_engine(DATABASE_URL)
+database = Database(DATABASE_URL)
+# Shared by all modules, connects on the first command.
+redis = Redis.from_url(REDIS_URL, decode_responses=True)
+primary_only: ContextVar[bool] = ContextVar("primary_only", default=False)
+query_stats: ContextVar["QueryStats | None"] = ContextVar("query_stats", default=None)
+
+REPLICA_LAG = (
+    "SELECT CASE WHEN pg_is_in_recovery() THEN COALESCE("
+    "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END AS lag"
+)
+# Only compiles the queries, Statement turns the pyformat names into $n for asyncpg.
+DIALECT = postgresql.asyncpg.dialect(paramstyle="pyformat")
+
+
+def fingerprint(sql: str) -> str:
+    """ Same for the same query whatever the values, they are $n placeholders. """
+    return hashlib.sha1(" ".join(sql.split()).encode()).hexdigest()[:12]
+
+
+def shape(value: Any) -> str:
+    """ Type and size of a bound value, the value itself is not logged. """
+    if isinstance(value, (str, bytes, list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+class Record(Mapping):
+    """
+    Row of a Statement: values by column name and as attributes, like the rows
+    of databases, on top of the asyncpg record.
+    """
+
+    __slots__ = ("_row",)
+
+    def __init__(self, row: Any) -> None:
+        self._row = row
+
+    def __getitem__(self, key: str) -> Any:
+        return self._row[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._row.keys())
+
+    def __len__(self) -> int:
+        return len(self._row)
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self._row[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __repr__(self) -> str:
+        return f"Record({dict(self)!r})"
+
+
+class Statement:
+    """
+    SQLAlchemy Core query compiled once, on the first call.
+    Values are passed by sa.bindparam names, the SQL text stays the same,
+    so asyncpg keeps it as a prepared statement in the statement cache
+    of every pool connection. replica=True lets a replica serve a SELECT:
+    for lists and history, where a read behind the last write is fine.
+    """
+
+    __slots__ = ("query", "replica", "name", "sql", "fingerprint", "params")
+
+    def __init__(self, query: ClauseElement, name: str = "query", replica: bool = False) -> None:
+        self.query = query
+        self.replica = replica and isinstance(query, Select)
+        self.name = name
+        self.sql = ""
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        """ User._by_username is named "User.by_username" in the metrics. """
+        self.name = f"{owner.__name__}.{name.lstrip('_')}"
+
+    def compile(self) -> None:
+        compiled = self.query.compile(dialect=DIALECT, compile_kwargs={"render_postcompile": True})
+        params = sorted(compiled.params.items())
+        mapping = {key: f"${i}" for i, (key, _) in enumerate(params, start=1)}
+        processors = {
+            name: bind.type.dialect_impl(DIALECT).bind_processor(DIALECT)
+            for bind, name in compiled.bind_names.items()
+        }
+        self.params = [
+            (key, value, processors.get(key), compiled.binds[key].required)
+            for key, value in params
+        ]
+        self.sql = compiled.string % mapping
+        self.fingerprint = fingerprint(self.sql)
+
+    def args(self, values: dict[str, Any]) -> list[Any]:
+        if not self.sql:
+            self.compile()
+        args = []
+        for key, default, processor, required in self.params:
+            if required and key not in values:
+                # Otherwise a misspelled name would silently be NULL.
+                raise KeyError(f"{self.name} has no value for {key}")
+            value = values.get(key, default)
+            args.append(processor(value) if processor else value)
+        return args
+
+
+async def create_tables(database: Database = database) -> None:
+    """
+    Missing tables and indexes only, existing ones are not altered:
+    a database created by an older version is migrated with "alembic upgrade head".
+    """
+    async with raw_connection(database) as connection, connection.transaction():
+        # Workers start together, concurrent IF NOT EXISTS still collide in the catalog.
+        await connection.execute(CREATE_TABLES_LOCK)
+        for table in metadata.sorted_tables:
+            ddl = [CreateTable(table, if_not_exists=True)]
+            ddl += [CreateIndex(index, if_not_exists=True) for index in table.indexes]
+            for element in ddl:
+                await connection.execute(str(element.compile(dialect=DIALECT)))
+        existing = {tuple(row) for row in await connection.fetch(SCHEMA_COLUMNS)}
+    for table in metadata.sorted_tables:
+        missing = [i.name for i in table.columns if (table.name, i.name) not in existing]
+        if missing:
+            logger.warning(
+                'Table %s has no columns %s, run "alembic upgrade head"',
+                table.name, ", ".join(missing),
+            )
+
+
+@asynccontextmanager
+async def raw_connection(
+    database: Database = database,
+) -> AsyncIterator[asyncpg.Connection]:
+    """ asyncpg connection of the current task, held until the block ends. """
+    async with database.connection() as connection:
+        raw: PooledConnection = connection.raw_connection
+        async with raw.query_lock:
+            yield raw
+
+
+class QueryStats:
+    """ Queries of one request or websocket message. """
+
+    __slots__ = ("name", "count", "seconds", "statements")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: dict[str, int] = {}
+
+    def add(self, statement: Statement, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        key = f"{statement.name}[{statement.fingerprint}]"
+        self.statements[key] = self.statements.get(key, 0) + 1
+
+    def __str__(self) -> str:
+        calls = ", ".join(
+            f"{key} x{count}" if count > 1 else key for key, count in self.statements.items()
+        )
+        return f"{self.name}: {self.count} queries in {self.seconds * 1000:.1f} ms ({calls})"
+
+
+@contextmanager
+def query_scope(name: str, budget: int | None = None) -> Iterator[QueryStats]:
+    """
+    Counts the queries made inside the block, including child tasks,
+    and logs them when there are more than budget, DB_QUERY_BUDGET by default.
+    """
+    budget = DB_QUERY_BUDGET if budget is None else budget
+    stats = QueryStats(name)
+    token = query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        query_stats.reset(token)
+        SCOPE_QUERIES.observe(stats.count, (stats.name,))
+        if budget and stats.count > budget:
+            logger.warning("Query budget %d exceeded by %s", budget, stats)
+
+
+def record_query(statement: Statement, seconds: float, args: list[Any], target: str) -> None:
+    DB_QUERY.observe(seconds, (statement.name, target))
+    stats = query_stats.get()
+    if stats is not None:
+        stats.add(statement, seconds)
+    if DB_SLOW_QUERY_MS and seconds * 1000 >= DB_SLOW_QUERY_MS:
+        logger.warning(
+            "Slow query %.1f ms %s[%s] on %s, params (%s): %s",
+            seconds * 1000, statement.name, statement.fingerprint, target,
+            ", ".join(shape(i) for i in args), " ".join(statement.sql.split()),
+        )
+
+
+class QueryScopeMiddleware:
+    """ query_scope per HTTP request, named by the route template like the metrics. """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with query_scope(scope["path"]) as stats:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                route = scope.get("route")
+                stats.name = f"{scope['method']} {getattr(route, 'path', 'unmatched')}"
+
+
+@contextmanager
+def primary() -> Iterator[None]:
+    """ Read your writes: replica=True reads inside the block go to the primary too. """
+    token = primary_only.set(True)
+    try:
+        yield
+    finally:
+        primary_only.reset(token)
+
+
+class Replicas:
+    """
+    Read-only databases picked round-robin. A background check every
+    REPLICA_CHECK_INTERVAL seconds leaves out the ones that are down
+    or lag behind the primary by more than max_lag seconds.
+    """
+
+    def __init__(self, urls: list[str], max_lag: float = REPLICA_MAX_LAG) -> None:
+        self.databases = [Database(url) for url in urls]
+        self.max_lag = max_lag
+        self.healthy: list[Database] = []
+        self.lag: dict[str, float | None] = {}
+        self._next = 0
+        self._task: asyncio.Task | None = None
+
+    def pick(self) -> Database | None:
+        if not self.healthy or primary_only.get():
+            return None
+        self._next = (self._next + 1) % len(self.healthy)
+        return self.healthy[self._next]
+
+    async def connect(self) -> None:
+        if not self.databases:
+            return
+        for replica in self.databases:
+            if not replica.is_connected:
+                try:
+                    await replica.connect(timeout=0)
+                except Exception:
+                    continue
+        await self.check()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._monitor())
+
+    async def disconnect(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.healthy = []
+        for replica in self.databases:
+            if replica.is_connected:
+                await replica.disconnect()
+
+    async def check(self) -> None:
+        healthy = []
+        for replica in self.databases:
+            try:
+                if not replica.is_connected:
+                    await replica.connect(timeout=0)
+                async with raw_connection(replica) as connection:
+                    lag = float(await connection.fetchval(REPLICA_LAG))
+            except Exception:
+                lag = None
+            self.lag[self.name(replica)] = lag
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(replica)
+        self.healthy = healthy
+
+    @staticmethod
+    def name(replica: Database) -> str:
+        return f"{replica.url.hostname}:{replica.url.port or 5432}"
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "host": self.name(replica),
+                "healthy": replica in self.healthy,
+                "lag": self.lag.get(self.name(replica)),
+                **replica.pool_stats(),
+            }
+            for replica in self.databases
+        ]
+
+    async def _monitor(self) -> None:
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+            await self.check()
+
+
+replicas = Replicas(DATABASE_REPLICA_URLS)
+
+
+def pool_samples(key: str) -> Callable[[], Samples]:
+    """ One pool_stats() value of the primary and of every replica. """
+    def collect() -> Samples:
+        yield ("primary",), database.pool_stats()[key]
+        for replica in replicas.databases:
+            yield (Replicas.name(replica),), replica.pool_stats()[key]
+    return collect
+
+
+registry.gauge("db_pool_in_use", "Connections taken from the pool.", pool_samples("in_use"),
+               ("database",))
+registry.gauge("db_pool_idle", "Idle connections.", pool_samples("idle"), ("database",))
+registry.gauge("db_pool_waiting", "Tasks waiting for a connection.", pool_samples("waiting"),
+               ("database",))
+registry.counter_callback("db_pool_acquired_total", "Connections handed out.",
+                          pool_samples("acquired"), ("database",))
+registry.counter_callback("db_pool_timeouts_total", "Acquires that hit DB_ACQUIRE_TIMEOUT.",
+                          pool_samples("timeouts"), ("database",))
+registry.counter_callback("db_pool_recycled_total", "Connections closed after max lifetime.",
+                          pool_samples("recycled"), ("database",))
+registry.gauge(
+    "db_replica_lag_seconds", "Replication lag, -1 when the replica is down.",
+    lambda: [((name,), -1 if lag is None else lag) for name, lag in replicas.lag.items()],
+    ("database",),
+)
 
 
 class Base:
-    def __init__(self, database: databases.Database):
+    def __init__(self, database: Database, replicas: Replicas = replicas):
         self.database = database
+        self.replicas = replicas
+
+    async def fetch_one(self, statement: Statement, **values: Any) -> Record | None:
+        row = await self._run("fetchrow", statement, values)
+        return Record(row) if row is not None else None
+
+    async def fetch_all(self, statement: Statement, **values: Any) -> list[Record]:
+        return [Record(row) for row in await self._run("fetch", statement, values)]
+
+    async def execute(self, statement: Statement, **values: Any) -> Any:
+        return await self._run("fetchval", statement, values)
+
+    async def iterate(
+        self, statement: Statement, prefetch: int = 50, **values: Any
+    ) -> AsyncIterator[Record]:
+        """
+        Server-side cursor, prefetch rows per round trip. The connection and the
+        transaction are held until the iteration ends or the caller stops it.
+        Recorded as one query, the time of the round trips without the caller's.
+        """
+        args = statement.args(values)
+        replica = statement.replica and self.replicas.pick()
+        target = "replica" if replica else "primary"
+        seconds = 0.0
+        async with raw_connection(replica or self.database) as connection:
+            try:
+                async with connection.transaction(readonly=True):
+                    rows = connection.cursor(statement.sql, *args, prefetch=prefetch).__aiter__()
+                    while True:
+                        started = time.perf_counter()
+                        row = await anext(rows, None)
+                        seconds += time.perf_counter() - started
+                        if row is None:
+                            break
+                        yield Record(row)
+            finally:
+                record_query(statement, seconds, args, target)
+
+    async def _run(self, method: str, statement: Statement, values: dict[str, Any]) -> Any:
+        """
+        Same connection as databases uses for the current task.
+        A replica=True statement goes to a replica when there is a healthy one.
+        """
+        args = statement.args(values)
+        replica = statement.replica and self.replicas.pick()
+        target = "replica" if replica else "primary"
+        # The span includes waiting for the pool, the metrics do not.
+        with span(f"db {statement.name}", target=target, fingerprint=statement.fingerprint):
+            async with raw_connection(replica or self.database) as connection:
+                started = time.perf_counter()
+                try:
+                    return await getattr(connection, method)(statement.sql, *args)
+                finally:
+                    record_query(statement, time.perf_counter() - started, args, target)
@@ -0,0 +1,28 @@
+"""
+Conditional GET. The ETag is built from the version column of the row, which
+is bumped by every change visible in the response, so a client holding the
+current tag gets 304 after a header comparison.
+"""
+from fastapi import Request, Response, status
+
+
+def etag(kind: str, id: int, version: int) -> str:
+    """ Weak: the body also depends on the host, avatar urls use base_url. """
+    return f'W/"{kind}{id}.{version}"'
+
+
+def not_modified(request: Request, response: Response, tag: str) -> Response | None:
+    """
+    Sets ETag on the response and returns 304 when If-None-Match has the tag.
+    no-cache lets caches keep the body, but they revalidate it on every use.
+    """
+    headers = {"ETag": tag, "Cache-Control": "private, no-cache"}
+    response.headers.update(headers)
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    # Weak comparison, as RFC 9110 requires for If-None-Match.
+    tags = {i.strip().removeprefix("W/") for i in header.split(",")}
+    if "*" in tags or tag.removeprefix("W/") in tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
@@ -0,0 +1,138 @@
+"""
+Event loop lag monitor.
+
+A heartbeat task sleeps for interval and measures how late it wakes up,
+that is the lag every coroutine on the worker sees. A watchdog thread checks
+the heartbeat: when the loop has not come back for threshold seconds, it
+takes the stack of the loop thread, which is the blocking call itself.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any
+
+from metrics import Samples, registry
+from settings import LOOP_BLOCK_THRESHOLD, LOOP_LAG_INTERVAL
+
+logger = logging.getLogger("looplag")
+QUANTILES = (0.5, 0.9, 0.99, 1.0)
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        interval: float = LOOP_LAG_INTERVAL,
+        threshold: float = LOOP_BLOCK_THRESHOLD,
+        window: int = 1200,
+    ) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        # Lags of the last window heartbeats, a minute with the default interval.
+        self.lags: deque[float] = deque(maxlen=window)
+        self.blocks: deque[dict[str, Any]] = deque(maxlen=20)
+        self.blocked = 0
+        self._beat = 0.0
+        self._reported = 0.0
+        self._pending: dict[str, Any] | None = None
+        self._thread_id = 0
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """ Called on the loop to watch, in the startup event. """
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = loop.create_task(self._heartbeat())
+        if self.threshold and (self._watchdog is None or not self._watchdog.is_alive()):
+            self._stop.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="looplag", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            # The thread wakes up within threshold / 4, a start() right after
+            # the stop must not find it alive and skip starting a new one.
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    def quantiles(self) -> dict[float, float]:
+        lags = sorted(self.lags)
+        if not lags:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: lags[min(int(len(lags) * q), len(lags) - 1)] for q in QUANTILES}
+
+    def stats(self) -> dict[str, Any]:
+        quantiles = self.quantiles()
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag_ms_p50": round(quantiles[0.5] * 1000, 3),
+            "lag_ms_p99": round(quantiles[0.99] * 1000, 3),
+            "lag_ms_max": round(quantiles[1.0] * 1000, 3),
+            "blocked": self.blocked,
+            "blocks": list(self.blocks),
+        }
+
+    async def _heartbeat(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self._beat = now
+            self.lags.append(lag)
+            block = self._pending
+            if block is not None:
+                # The watchdog saw the start of the block, the heartbeat sees its end.
+                block["blocked_ms"] = round(lag * 1000, 1)
+                self._pending = None
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or beat == self._reported:
+                continue
+            self._reported = beat
+            frame = sys._current_frames().get(self._thread_id)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            block = {"at": time.time(), "blocked_ms": round(stalled * 1000, 1), "stack": stack}
+            self.blocks.append(block)
+            self.blocked += 1
+            self._pending = block
+            logger.warning(
+                "Event loop blocked for more than %.0f ms:\n%s", stalled * 1000, "".join(stack)
+            )
+
+
+loop_monitor = LoopMonitor()
+
+
+def lag_samples() -> Samples:
+    return [((q,), lag) for q, lag in loop_monitor.quantiles().items()]
+
+
+registry.gauge(
+    "event_loop_lag_seconds", "Event loop lag over the last heartbeats by quantile.",
+    lag_samples, ("quantile",),
+)
+registry.counter_callback(
+    "event_loop_blocked_total", "Times the loop was blocked longer than LOOP_BLOCK_THRESHOLD.",
+    lambda: [((), loop_monitor.blocked)],
+)
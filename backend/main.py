@@ -1,14 +1,23 @@
 from typing import Any
 
+from admin import api_admin
+from admin.utils import install_drain_signal
 from chats import api_chats
-from db import database, engine, metadata
+from chats.sharding import sharding
+from db import (PoolTimeout, QueryScopeMiddleware, create_tables, database,
+                redis, replicas)
 from fastapi import FastAPI, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from settings import AVATAR_ROOT, AVATAR_URL, MEDIA_ROOT, MEDIA_URL
+from looplag import loop_monitor
+from metrics import CONTENT_TYPE, MetricsMiddleware, registry
+from profiler import ProfileMiddleware
+from settings import (AVATAR_ROOT, AVATAR_URL, DB_CREATE_TABLES, MEDIA_ROOT,
+                      MEDIA_URL, METRICS_ENABLED, PROFILE_DIR, SHARDING)
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.requests import Request
+from tracing import TraceMiddleware
 from users import api_auth, api_users
 
 app = FastAPI(title="Test task for MANGO FZCO", openapi_url="/api/openapi.json",)
@@ -17,7 +26,12 @@ app.mount(f"/{MEDIA_URL}", StaticFiles(directory=MEDIA_ROOT), name=MEDIA_URL)
 app.mount(f"/{AVATAR_URL}", StaticFiles(directory=AVATAR_ROOT), name=AVATAR_URL)
 
 app.state.database = database
-metadata.create_all(engine)
+if PROFILE_DIR:
+    app.add_middleware(ProfileMiddleware)
+app.add_middleware(QueryScopeMiddleware)
+app.add_middleware(TraceMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event("startup")
@@ -25,10 +39,26 @@ async def startup() -> None:
     database_ = app.state.database
     if not database_.is_connected:
         await database_.connect()
+        if DB_CREATE_TABLES:
+            await create_tables(database_)
+    await replicas.connect()
+    api_chats.manager.draining = False
+    api_chats.purger.start()
+    install_drain_signal()
+    loop_monitor.start()
+    if SHARDING:
+        await sharding.start()
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    await loop_monitor.stop()
+    await api_chats.purger.stop()
+    await sharding.stop()
+    if not api_chats.manager.draining:
+        await api_chats.manager.drain()
+    await replicas.disconnect()
+    await redis.connection_pool.disconnect()
     database_ = app.state.database
     if database_.is_connected:
         await database_.disconnect()
@@ -36,7 +66,17 @@ async def shutdown() -> None:
 
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Any, exc: Any) -> JSONResponse:
-    return JSONResponse({"detail": f"{exc.detail}"}, exc.status_code)
+    return JSONResponse(
+        {"detail": f"{exc.detail}"}, exc.status_code, headers=getattr(exc, "headers", None)
+    )
+
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Any, exc: Any) -> JSONResponse:
+    return JSONResponse(
+        {"detail": "Service Unavailable"}, status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
 
 
 @app.exception_handler(RequestValidationError)
@@ -62,6 +102,15 @@ async def main(request: Request) -> dict[str, str]:
     }
 
 
+@app.get("/metrics", include_in_schema=METRICS_ENABLED)
+async def metrics() -> Response:
+    """ Metrics of this worker in the Prometheus text format. """
+    if not METRICS_ENABLED:
+        return JSONResponse({"detail": "Not Found"}, status.HTTP_404_NOT_FOUND)
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
 app.include_router(api_auth.router, prefix="/api")
 app.include_router(api_users.router, prefix="/api")
 app.include_router(api_chats.router, prefix="/api")
+app.include_router(api_admin.router, prefix="/api")
@@ -0,0 +1,190 @@
+"""
+Metrics in the Prometheus text format, without a client library.
+
+Updating a counter or a histogram costs a dict lookup and a couple of
+additions, so instrumentation stays on in production. Gauges and counters
+that objects already keep (pool, limiter, admission) are read by callbacks
+at scrape time only. Every series has the worker pid label, a scrape
+sees only the worker that accepted it.
+"""
+import bisect
+import os
+import time
+from typing import Any, Callable, Iterable
+
+Labels = tuple[Any, ...]
+Samples = Iterable[tuple[Labels, float]]
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def escape(value: Any) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = ("worker", *labels)
+
+    def samples(self) -> Samples:
+        return ()
+
+    def render(self, worker: str) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in self.samples():
+            lines.append(f"{self.name}{format_labels(self.labels, (worker, *values))} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Samples:
+        return list(self.values.items())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: Labels = (), buckets: tuple = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label set: counts per bucket (the last one is +Inf) and the sum.
+        self.counts: dict[Labels, list[int]] = {}
+        self.sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def since(self, started: float, labels: Labels = ()) -> None:
+        """ Observes the time passed since started, a time.perf_counter() value. """
+        self.observe(time.perf_counter() - started, labels)
+
+    def render(self, worker: str) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, counts in list(self.counts.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = format_labels(self.labels, (worker, *values), f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            labels = format_labels(self.labels, (worker, *values))
+            lines.append(f"{self.name}_sum{labels} {self.sums[values]}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class Callback(Metric):
+    """ Gauge or counter whose samples are collected at scrape time. """
+
+    def __init__(
+        self, name: str, help: str, labels: Labels, collect: Callable[[], Samples], kind: str
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self) -> Samples:
+        return self.collect()
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Any:
+        """ The metric registered first under the name wins, re-imports reuse it. """
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Labels = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(
+        self, name: str, help: str, labels: Labels = (), buckets: tuple = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(
+        self, name: str, help: str, collect: Callable[[], Samples], labels: Labels = ()
+    ) -> Callback:
+        return self.register(Callback(name, help, labels, collect, "gauge"))
+
+    def counter_callback(
+        self, name: str, help: str, collect: Callable[[], Samples], labels: Labels = ()
+    ) -> Callback:
+        return self.register(Callback(name, help, labels, collect, "counter"))
+
+    def render(self) -> str:
+        worker = str(os.getpid())
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render(worker))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUEST = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.",
+    ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware, lighter than BaseHTTPMiddleware and does not buffer
+    streaming responses. The route label is the path template set by the router,
+    so /api/users/{username} is one series; unknown paths share "unmatched".
+    """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_status(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get("route")
+            labels = (scope["method"], getattr(route, "path", "unmatched"), str(status))
+            HTTP_REQUEST.since(started, labels)
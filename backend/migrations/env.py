@@ -1,7 +1,8 @@
 from logging.config import fileConfig
 
 from alembic import context
-from main import metadata
+from chats import models  # noqa: F401 registers the chats and users tables
+from db import metadata
 from settings import DATABASE_URL
 from sqlalchemy import engine_from_config, pool
 
@@ -0,0 +1,25 @@
+"""Row versions for ETags
+
+Revision ID: 2e8f4a6b9c1d
+Revises: 9c3d5e7f1a2b
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '2e8f4a6b9c1d'
+down_revision = '9c3d5e7f1a2b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('rooms', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('rooms', 'version')
+    op.drop_column('users', 'version')
@@ -0,0 +1,41 @@
+"""Room soft delete and background purge
+
+Revision ID: 4b7e2c91a0d3
+Revises: d65de44eb9f1
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '4b7e2c91a0d3'
+down_revision = 'd65de44eb9f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('rooms', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column(
+        'rooms', sa.Column('purged', sa.BigInteger(), server_default='0', nullable=False)
+    )
+    op.add_column('rooms', sa.Column('purge_lease', sa.DateTime(timezone=True), nullable=True))
+    op.drop_index('ix_rooms_name', table_name='rooms')
+    op.create_index(
+        'ix_rooms_name', 'rooms', ['name'], unique=True,
+        postgresql_where=sa.text('deleted_at IS NULL'),
+    )
+    op.create_index('ix_members_room_id', 'members', ['room_id'])
+    op.create_index('ix_messages_room_id', 'messages', ['room_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_room_id', table_name='messages')
+    op.drop_index('ix_members_room_id', table_name='members')
+    op.execute('DELETE FROM rooms WHERE deleted_at IS NOT NULL')
+    op.drop_index('ix_rooms_name', table_name='rooms')
+    op.create_index('ix_rooms_name', 'rooms', ['name'], unique=True)
+    op.drop_column('rooms', 'purge_lease')
+    op.drop_column('rooms', 'purged')
+    op.drop_column('rooms', 'deleted_at')
@@ -0,0 +1,23 @@
+"""Drop the unique index duplicating the messages primary key
+
+Revision ID: 7a1c3e5b9d2f
+Revises: 2e8f4a6b9c1d
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7a1c3e5b9d2f'
+down_revision = '2e8f4a6b9c1d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # messages_pkey already keeps key unique, the second btree only slows inserts.
+    op.execute('DROP INDEX IF EXISTS ix_messages_key')
+
+
+def downgrade() -> None:
+    op.create_index(op.f('ix_messages_key'), 'messages', ['key'], unique=True)
@@ -0,0 +1,69 @@
+"""Room summary and member read pointers
+
+Revision ID: 9c3d5e7f1a2b
+Revises: 4b7e2c91a0d3
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c3d5e7f1a2b'
+down_revision = '4b7e2c91a0d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('rooms', sa.Column('last_message_key', sa.String(), nullable=True))
+    op.add_column('rooms', sa.Column('last_snippet', sa.String(length=100), nullable=True))
+    op.add_column(
+        'rooms', sa.Column('last_activity', sa.DateTime(timezone=True), nullable=True)
+    )
+    op.add_column(
+        'rooms', sa.Column('message_count', sa.BigInteger(), server_default='0', nullable=False)
+    )
+    op.add_column('members', sa.Column('last_read_key', sa.String(), nullable=True))
+    op.add_column(
+        'members', sa.Column('read_count', sa.BigInteger(), server_default='0', nullable=False)
+    )
+    op.drop_index('ix_messages_room_id', table_name='messages')
+    op.create_index(
+        'ix_messages_room_id_create', 'messages', ['room_id', 'create', 'key']
+    )
+    # Existing history counts as read.
+    op.execute(
+        """
+        UPDATE rooms SET
+            last_message_key = last.key,
+            last_snippet = left(last.content, 100),
+            last_activity = last."create",
+            message_count = last.total
+        FROM (
+            SELECT DISTINCT ON (room_id)
+                room_id, key, content, "create",
+                count(*) OVER (PARTITION BY room_id) AS total
+            FROM messages
+            ORDER BY room_id, "create" DESC
+        ) AS last
+        WHERE rooms.id = last.room_id
+        """
+    )
+    op.execute(
+        """
+        UPDATE members SET read_count = rooms.message_count, last_read_key = rooms.last_message_key
+        FROM rooms WHERE rooms.id = members.room_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_room_id_create', table_name='messages')
+    op.create_index('ix_messages_room_id', 'messages', ['room_id'])
+    op.drop_column('members', 'read_count')
+    op.drop_column('members', 'last_read_key')
+    op.drop_column('rooms', 'message_count')
+    op.drop_column('rooms', 'last_activity')
+    op.drop_column('rooms', 'last_snippet')
+    op.drop_column('rooms', 'last_message_key')
@@ -0,0 +1,133 @@
+"""
+Sampling profiler for a single request or websocket session.
+
+A request with "X-Profile: 1" (or ?profile=1) and the admin token is
+sampled by a thread every PROFILE_INTERVAL seconds. Samples are stacks of
+the event loop thread: those inside the request are kept from the middleware
+down, the loop waiting or running other tasks meanwhile is kept under
+"(outside the request)". The result is written to PROFILE_DIR in the folded format
+of flamegraph.pl and speedscope. Without PROFILE_DIR the middleware is not
+installed at all.
+"""
+import asyncio
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Any
+from urllib.parse import parse_qs
+
+from settings import ADMIN_TOKEN, PROFILE_DIR, PROFILE_INTERVAL
+
+logger = logging.getLogger("profiler")
+OTHER = "(outside the request)"
+
+
+def label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profile:
+    def __init__(
+        self,
+        name: str,
+        root: FrameType,
+        interval: float = PROFILE_INTERVAL,
+        directory: str = PROFILE_DIR,
+    ) -> None:
+        self.name = name
+        slug = re.sub(r"[^\w.-]+", "_", name).strip("_")
+        self.path = os.path.join(
+            directory, f"{int(time.time() * 1000)}-{os.getpid()}-{slug}.folded"
+        )
+        self.root = root
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self.started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None and frame is not self.root:
+                stack.append(label(frame))
+                frame = frame.f_back
+            if frame is None:
+                stack.append(OTHER)
+            else:
+                stack.append(label(frame))
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as file:
+            file.write(self.folded())
+
+
+def requested(scope: dict) -> bool:
+    """ "X-Profile: 1" or ?profile=1, with the admin token only. """
+    if not ADMIN_TOKEN:
+        return False
+    headers = dict(scope["headers"])
+    token = headers.get(b"x-admin-token", b"").decode("latin-1")
+    if not secrets.compare_digest(token, ADMIN_TOKEN):
+        return False
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return headers.get(b"x-profile") == b"1" or query.get("profile") == ["1"]
+
+
+class ProfileMiddleware:
+    """
+    Profiles HTTP requests and websocket sessions on demand, the file name
+    of an HTTP profile is returned in X-Profile-File.
+    """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] not in ("http", "websocket") or not requested(scope):
+            await self.app(scope, receive, send)
+            return
+        name = f"{scope.get('method', 'WS')} {scope['path']}"
+        profile = Profile(name, sys._getframe())
+        path = os.path.basename(profile.path).encode()
+
+        async def send_path(message: dict) -> None:
+            if message["type"] == "http.response.start":
+                headers = [*message.get("headers", []), (b"x-profile-file", path)]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profile.start()
+        try:
+            await self.app(scope, receive, send_path)
+        finally:
+            profile.stop()
+            await asyncio.to_thread(profile.save)
+            logger.info(
+                "Profile of %s: %d samples in %.3f s, %s",
+                name, profile.samples, profile.duration, profile.path,
+            )
@@ -0,0 +1,139 @@
+import time
+from collections import OrderedDict
+from typing import Any
+
+from db import redis
+from fastapi import HTTPException, status
+from metrics import registry
+from settings import RATE_LIMIT_BACKEND, RATE_LIMITS
+from starlette.requests import Request
+
+# KEYS[1] - bucket, ARGV - capacity, refill rate per second, cost.
+# Returns seconds to wait as a string, "0" when the request is allowed.
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local retry = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(retry)
+"""
+
+
+class Rule:
+    """ "20/60" - bucket of 20 tokens that refills completely in 60 seconds. """
+
+    __slots__ = ("capacity", "rate")
+
+    def __init__(self, value: str) -> None:
+        capacity, seconds = value.split("/")
+        self.capacity = float(capacity)
+        self.rate = self.capacity / float(seconds)
+
+
+class MemoryBackend:
+    """ Buckets of the current worker, limits are per process. """
+
+    max_keys = 100_000
+
+    def __init__(self) -> None:
+        # key: (tokens, updated at), least recently used first.
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, rule: Rule, cost: float = 1) -> float:
+        now = time.monotonic()
+        tokens, ts = self.buckets.pop(key, (rule.capacity, now))
+        tokens = min(rule.capacity, tokens + (now - ts) * rule.rate)
+        retry = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            retry = (cost - tokens) / rule.rate
+        if len(self.buckets) >= self.max_keys:
+            # O(1) on every request: the least recently used bucket has had
+            # the longest time to refill, and a full bucket is the same as a missing one.
+            self.buckets.popitem(last=False)
+        self.buckets[key] = (tokens, now)
+        return retry
+
+
+class RedisBackend:
+    """ Buckets shared by all workers, one Lua call per check. """
+
+    def __init__(self) -> None:
+        self._script: Any = None
+
+    async def take(self, key: str, rule: Rule, cost: float = 1) -> float:
+        if self._script is None:
+            self._script = redis.register_script(TOKEN_BUCKET)
+        retry = await self._script(keys=[f"ratelimit:{key}"], args=[rule.capacity, rule.rate, cost])
+        return float(retry)
+
+
+class RateLimiter:
+    def __init__(self, rules: dict[str, str], backend: str = "memory") -> None:
+        self.rules = {name: Rule(value) for name, value in rules.items() if value}
+        self.backend = RedisBackend() if backend == "redis" else MemoryBackend()
+        self.allowed: dict[str, int] = {}
+        self.limited: dict[str, int] = {}
+
+    async def hit(self, name: str, key: Any) -> float:
+        """ Takes a token, returns 0 or the number of seconds to wait. """
+        rule = self.rules.get(name)
+        if rule is None:
+            return 0
+        retry = await self.backend.take(f"{name}:{key}", rule)
+        counter = self.limited if retry else self.allowed
+        counter[name] = counter.get(name, 0) + 1
+        return retry
+
+    async def check(self, name: str, key: Any) -> None:
+        """ Raises 429 with the Retry-After header. """
+        retry = await self.hit(name, key)
+        if retry:
+            raise HTTPException(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Too Many Requests",
+                headers={"Retry-After": str(int(retry) + 1)},
+            )
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            name: {"allowed": self.allowed.get(name, 0), "limited": self.limited.get(name, 0)}
+            for name in self.rules
+        }
+
+
+class RateLimit:
+    """ Dependency, limits the route by the client ip address. """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    async def __call__(self, request: Request) -> None:
+        if request.client is not None:
+            await limiter.check(self.name, request.client.host)
+
+
+limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_BACKEND)
+registry.counter_callback(
+    "ratelimit_requests_total", "Rate limited calls by rule and result.",
+    lambda: [
+        ((name, result), count)
+        for name, stats in limiter.stats().items()
+        for result, count in stats.items()
+    ],
+    ("rule", "result"),
+)
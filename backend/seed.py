@@ -0,0 +1,276 @@
+"""
+Synthetic dataset for testing at production scale.
+
+    cd backend && python -m seed --users 50000 --rooms 20000 --messages 5000000
+    cd backend && python -m seed --reset --seed 2 --skew 1.1 --avatars 0.5
+
+Rows are loaded with COPY into the tables of the real schema, the same
+arguments give the same rows. Member counts follow a Pareto distribution
+(--skew, smaller is more skewed): most rooms have a few members, some have
+thousands. Messages fall into rooms in proportion to their members, at
+random times between the creation of the room and --end. Room summaries,
+message counts and read counts are filled the way the app keeps them.
+
+Every user has the password "password". The --avatars share of users get an
+avatar: a small pool of generated images is hard linked to the unique file
+names the users.image column needs. The tables must be empty, --reset
+empties them and removes the avatars of the users it deletes.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, Iterator
+
+import asyncpg
+from db import database, raw_connection
+from passlib.hash import bcrypt
+from PIL import Image
+from settings import AVATAR_ROOT, IMPORT_BATCH, SIZES, SNIPPET_LENGTH
+
+PASSWORD = "password"
+TABLES = ("messages", "members", "rooms", "users")
+AVATAR_POOL = 16
+FIRST_NAMES = (
+    "Alex", "Maria", "Ivan", "Olga", "Omar", "Fatima", "Li", "Mei", "John", "Anna",
+    "Sergey", "Elena", "Ahmed", "Sara", "Dmitry", "Nadia",
+)
+LAST_NAMES = (
+    "Ivanov", "Smith", "Khan", "Wang", "Petrova", "Garcia", "Kim", "Novak", "Ali",
+    "Sokolov", "Brown", "Haddad", "Chen", "Orlova", "Silva", "Nasser",
+)
+WORDS = (
+    "hello", "ok", "thanks", "see", "you", "tomorrow", "the", "meeting", "is", "at",
+    "noon", "can", "we", "move", "it", "please", "check", "this", "link", "sure",
+    "привет", "да", "нет", "спасибо", "завтра", "созвон", "в", "пять", "отправил",
+    "файл", "посмотри", "готово", "deploy", "release", "fixed", "bug", "lunch", "?",
+)
+USER_COLUMNS = [
+    "id", "email", "phone", "password", "username", "firstname", "lastname", "image",
+    "timestamp", "is_active",
+]
+ROOM_COLUMNS = ["id", "name", "timestamp", "privat", "is_active"]
+MEMBER_COLUMNS = ["id", "user_id", "room_id", "create", "last_read_key", "read_count"]
+MESSAGE_COLUMNS = ["key", "user_id", "room_id", "content", "create"]
+SUMMARY_STAGE = """
+CREATE TEMPORARY TABLE rooms_seed (
+    id integer, message_count bigint, last_message_key varchar,
+    last_snippet varchar, last_activity timestamptz
+) ON COMMIT DROP
+"""
+SUMMARY_UPDATE = """
+UPDATE rooms SET message_count = s.message_count, last_message_key = s.last_message_key,
+    last_snippet = s.last_snippet, last_activity = s.last_activity
+FROM rooms_seed s WHERE rooms.id = s.id
+"""
+
+
+def letters(number: int) -> str:
+    """ Usernames are letters only: 0 -> "aaaa", 27 -> "aabb". """
+    result = ""
+    while True:
+        number, rest = divmod(number, 26)
+        result = string.ascii_lowercase[rest] + result
+        if not number:
+            return result.rjust(4, "a")
+
+
+def batches(rows: Iterable[tuple], size: int) -> Iterator[list[tuple]]:
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
+
+
+def avatar_pool(directory: str, rng: random.Random) -> list[str]:
+    """ Original and thumbnails of AVATAR_POOL images, as base64_image saves them. """
+    names = []
+    for number in range(AVATAR_POOL):
+        x, y = rng.uniform(-1.5, 0.2), rng.uniform(-0.8, 0.8)
+        image = Image.effect_mandelbrot((640, 480), (x, y, x + 0.6, y + 0.45), 80)
+        image = image.convert("RGB")
+        name = os.path.join(directory, f"pool{number}")
+        image.save(f"{name}.jpg")
+        for size in SIZES:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            thumbnail.save(f"{name}{size}.jpg")
+        names.append(name)
+    return names
+
+
+def link_avatar(source: str, filename: str) -> None:
+    name, extension = filename.split(".")
+    for suffix in ("", *SIZES):
+        target = os.path.join(AVATAR_ROOT, f"{name}{suffix}.{extension}")
+        try:
+            os.link(f"{source}{suffix}.{extension}", target)
+        except OSError:
+            shutil.copyfile(f"{source}{suffix}.{extension}", target)
+
+
+def remove_avatar(filename: str) -> None:
+    name, extension = filename.split(".")
+    for suffix in ("", *SIZES):
+        try:
+            os.remove(os.path.join(AVATAR_ROOT, f"{name}{suffix}.{extension}"))
+        except FileNotFoundError:
+            pass
+
+
+class Seeder:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.end = args.end
+        self.start = args.end - timedelta(days=args.days)
+        self.room_created: list[datetime] = []
+        self.room_members: list[list[int]] = []
+        self.stats: dict[str, Any] = {}
+
+    def key(self) -> str:
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4).hex
+
+    def moment(self, start: datetime) -> datetime:
+        return start + (self.end - start) * self.rng.random()
+
+    def users(self, pool: list[str]) -> Iterator[tuple]:
+        rng = self.rng
+        salt = "".join(rng.choices(string.ascii_letters + string.digits, k=21)) + "."
+        password = bcrypt.using(salt=salt).hash(PASSWORD)
+        for number in range(self.args.users):
+            username = f"user{letters(number)}"
+            image = None
+            if rng.random() < self.args.avatars:
+                image = f"{self.key()}.jpg"
+                link_avatar(rng.choice(pool), image)
+            yield (
+                number + 1, f"{username}@seed.test", f"7{number:010d}", password, username,
+                rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), image,
+                self.moment(self.start), True,
+            )
+
+    def rooms(self) -> Iterator[tuple]:
+        rng, users = self.rng, self.args.users
+        for number in range(self.args.rooms):
+            created = self.moment(self.start)
+            size = int(self.args.min_members * rng.paretovariate(self.args.skew))
+            self.room_created.append(created)
+            self.room_members.append(rng.sample(range(1, users + 1), min(users, size)))
+            yield number + 1, f"room{number}", created, rng.random() < self.args.private, False
+
+    def messages(self, summary: dict[int, list]) -> Iterator[tuple]:
+        """ summary collects count, last key, snippet and time of every room. """
+        rng = self.rng
+        weights = list(itertools.accumulate(len(i) for i in self.room_members))
+        for _ in range(self.args.messages):
+            index = bisect.bisect_right(weights, rng.random() * weights[-1])
+            created = self.moment(self.room_created[index])
+            content = " ".join(rng.choices(WORDS, k=rng.randint(1, 24)))
+            key = self.key()
+            room = summary.setdefault(index + 1, [0, None, None, None])
+            room[0] += 1
+            if room[3] is None or created > room[3]:
+                room[1:] = key, content[:SNIPPET_LENGTH], created
+            yield key, rng.choice(self.room_members[index]), index + 1, content, created
+
+    def members(self, summary: dict[int, list]) -> Iterator[tuple]:
+        rng, ids = self.rng, itertools.count(1)
+        for index, users in enumerate(self.room_members):
+            total = summary.get(index + 1, [0])[0]
+            for user_id in users:
+                # Most members have read everything, the rest some of the room.
+                read = total if rng.random() < 0.7 else int(total * rng.random())
+                created = self.moment(self.room_created[index])
+                yield next(ids), user_id, index + 1, created, None, read
+
+    async def copy(
+        self, connection: asyncpg.Connection, table: str, columns: list[str], rows: Iterable[tuple]
+    ) -> None:
+        started, total = time.perf_counter(), 0
+        for chunk in batches(rows, self.args.batch):
+            await connection.copy_records_to_table(table, records=chunk, columns=columns)
+            total += len(chunk)
+            print(f"{table}: {total}", end="\r", flush=True)
+        seconds = time.perf_counter() - started
+        self.stats[table] = {"rows": total, "seconds": round(seconds, 3)}
+        print(f"{table}: {total} rows in {seconds:.1f} s")
+
+    async def run(self, connection: asyncpg.Connection) -> dict[str, Any]:
+        started = time.perf_counter()
+        await connection.execute("SET synchronous_commit TO off")
+        summary: dict[int, list] = {}
+        # The pool is on the same file system as the avatars, links stay after it is removed.
+        with tempfile.TemporaryDirectory(dir=AVATAR_ROOT) as directory:
+            pool = avatar_pool(directory, self.rng) if self.args.avatars else []
+            await self.copy(connection, "users", USER_COLUMNS, self.users(pool))
+        await self.copy(connection, "rooms", ROOM_COLUMNS, self.rooms())
+        await self.copy(connection, "messages", MESSAGE_COLUMNS, self.messages(summary))
+        await self.copy(connection, "members", MEMBER_COLUMNS, self.members(summary))
+        async with connection.transaction():
+            await connection.execute(SUMMARY_STAGE)
+            await connection.copy_records_to_table(
+                "rooms_seed", records=[(i, *values) for i, values in summary.items()]
+            )
+            await connection.execute(SUMMARY_UPDATE)
+        for table in ("users", "rooms", "members"):
+            await connection.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+            )
+        await connection.execute("ANALYZE users, rooms, members, messages")
+        await connection.execute("RESET synchronous_commit")
+        self.stats["seconds"] = round(time.perf_counter() - started, 3)
+        return self.stats
+
+
+async def reset(connection: asyncpg.Connection) -> None:
+    images = await connection.fetch("SELECT image FROM users WHERE image IS NOT NULL")
+    await connection.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY")
+    for row in images:
+        remove_avatar(row["image"])
+
+
+async def main(args: argparse.Namespace) -> None:
+    await database.connect()
+    try:
+        async with raw_connection(database) as connection:
+            if args.reset:
+                await reset(connection)
+            for table in TABLES:
+                if await connection.fetchval(f"SELECT EXISTS (SELECT 1 FROM {table})"):
+                    raise SystemExit(f"Table {table} is not empty, use --reset")
+            stats = await Seeder(args).run(connection)
+    finally:
+        await database.disconnect()
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--rooms", type=int, default=20_000)
+    parser.add_argument("--messages", type=int, default=5_000_000)
+    parser.add_argument("--min-members", type=int, default=2, help="smallest room")
+    parser.add_argument("--skew", type=float, default=1.2, help="Pareto shape of room sizes")
+    parser.add_argument("--private", type=float, default=0.2, help="share of private rooms")
+    parser.add_argument("--avatars", type=float, default=0.3, help="share of users with one")
+    parser.add_argument("--days", type=int, default=365, help="history before --end")
+    parser.add_argument(
+        "--end", type=datetime.fromisoformat, default=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        help="newest possible timestamp, ISO 8601 with a time zone",
+    )
+    parser.add_argument("--batch", type=int, default=IMPORT_BATCH, help="rows per COPY")
+    parser.add_argument("--reset", action="store_true", help="empty the tables first")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""
+Production launcher: gunicorn master with uvicorn workers on uvloop and httptools.
+
+    cd backend && python server.py
+
+The master restarts a worker that died, hung for SERVER_TIMEOUT seconds or
+served SERVER_MAX_REQUESTS requests (plus jitter, so workers do not recycle
+together). A worker stopped by SIGTERM or by recycling drains its websockets
+first, graceful_timeout leaves room for DRAIN_WINDOW and DRAIN_FLUSH_TIMEOUT.
+
+Connections, rate limits and metrics are per worker, so the default is
+one worker; with more, rooms must be pinned to workers by SHARDING.
+Migrations are not run here: "alembic upgrade head" goes before server.py,
+as in the Dockerfile.
+
+With SHARDING every worker is a shard of its own: besides SERVER_PORT it
+listens on SHARD_PORT + its slot and is named "<SHARD_HOST>-<that port>". A
+restarted worker takes the slot of the dead one, so the names stay the same.
+"""
+import itertools
+from typing import Any
+
+import settings
+from gunicorn.app.base import BaseApplication
+from gunicorn.sock import TCPSocket
+from settings import (DRAIN_FLUSH_TIMEOUT, DRAIN_WINDOW, SERVER_BACKLOG,
+                      SERVER_FORWARDED_ALLOW_IPS, SERVER_HOST,
+                      SERVER_KEEPALIVE, SERVER_LIMIT_CONCURRENCY,
+                      SERVER_MAX_REQUESTS, SERVER_MAX_REQUESTS_JITTER,
+                      SERVER_PORT, SERVER_TIMEOUT, SERVER_WORKERS,
+                      SERVER_WS_MAX_SIZE, SERVER_WS_PING_INTERVAL,
+                      SERVER_WS_PING_TIMEOUT, SHARD_HOST, SHARD_PORT, SHARDING)
+from uvicorn.workers import UvicornWorker
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {
+        "loop": "uvloop",
+        "http": "httptools",
+        "ws": "websockets",
+        "lifespan": "on",
+        "limit_concurrency": SERVER_LIMIT_CONCURRENCY,
+        "ws_max_size": SERVER_WS_MAX_SIZE,
+        "ws_ping_interval": SERVER_WS_PING_INTERVAL,
+        "ws_ping_timeout": SERVER_WS_PING_TIMEOUT,
+    }
+
+
+class Server(BaseApplication):
+    def __init__(self, options: dict[str, Any]) -> None:
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        # Imported in every worker, the master stays without the app.
+        from main import app
+        return app
+
+
+def pre_fork(arbiter: Any, worker: Any) -> None:
+    """ The lowest slot no live worker holds. """
+    taken = {getattr(i, "slot", None) for i in arbiter.WORKERS.values()}
+    worker.slot = next(i for i in itertools.count() if i not in taken)
+
+
+def post_fork(arbiter: Any, worker: Any) -> None:
+    """ Gives the new worker its shard name and port. """
+    if not SHARDING:
+        return
+    port = SHARD_PORT + worker.slot
+    # The app is imported after the fork, chats.sharding reads the worker's name.
+    settings.SHARD_NAME = f"{SHARD_HOST}-{port}"
+    listener = TCPSocket((SERVER_HOST, port), arbiter.cfg, arbiter.log)
+    worker.sockets = [*worker.sockets, listener]
+
+
+OPTIONS = {
+    "bind": f"{SERVER_HOST}:{SERVER_PORT}",
+    "workers": SERVER_WORKERS,
+    "worker_class": "server.Worker",
+    "backlog": SERVER_BACKLOG,
+    "keepalive": SERVER_KEEPALIVE,
+    "forwarded_allow_ips": SERVER_FORWARDED_ALLOW_IPS,
+    "timeout": SERVER_TIMEOUT,
+    "graceful_timeout": int(DRAIN_WINDOW + DRAIN_FLUSH_TIMEOUT) + 5,
+    "max_requests": SERVER_MAX_REQUESTS,
+    "max_requests_jitter": SERVER_MAX_REQUESTS_JITTER,
+    "accesslog": None,
+    "pre_fork": pre_fork,
+    "post_fork": post_fork,
+}
+
+
+if __name__ == "__main__":
+    Server(OPTIONS).run()
@@ -1,4 +1,5 @@
 import os
+import socket
 
 from dotenv import load_dotenv
 from fastapi import status
@@ -33,6 +34,34 @@ DATABASE_URL = (f"postgresql://{POSTGRES_USER}:"
                 f"{POSTGRES_PORT}/"
                 f"{POSTGRES_DB}")
 
+# Списки и история сообщений читаются с реплик по кругу, остальное - с основной базы.
+# Реплики, отстающие дольше REPLICA_MAX_LAG секунд, пропускаются.
+DATABASE_REPLICA_URLS = [i for i in os.getenv("DATABASE_REPLICA_URLS", default="").split(",") if i]
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", default="5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", default="5"))
+
+# Сколько подготовленных запросов asyncpg хранит на каждом соединении пула.
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", default="256"))
+
+# True - таблицы создаются при старте, для разработки без миграций.
+# В production - False и "alembic upgrade head" перед запуском воркеров.
+DB_CREATE_TABLES = os.getenv("DB_CREATE_TABLES", default="True") == "True"
+# Сколько секунд стартующий воркер ждет Postgres.
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", default="30"))
+
+# Каждый воркер открывает до DB_POOL_MAX_SIZE соединений с основной базой и с
+# каждой репликой, воркеры * DB_POOL_MAX_SIZE должно быть меньше max_connections.
+# Таймауты и время жизни в секундах, 0 - отключено.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", default="2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", default="10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", default="5"))
+DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", default="30"))
+DB_CONN_MAX_LIFETIME = float(os.getenv("DB_CONN_MAX_LIFETIME", default="1800"))
+# Запросы дольше DB_SLOW_QUERY_MS пишутся в лог, как и запрос или сообщение
+# вебсокета, сделавшие больше DB_QUERY_BUDGET запросов. 0 - отключено.
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", default="200"))
+DB_QUERY_BUDGET = int(os.getenv("DB_QUERY_BUDGET", default="8"))
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 MEDIA_URL = "media"
@@ -43,6 +72,110 @@ AVATAR_ROOT = os.path.join(BASE_DIR, MEDIA_URL, AVATAR_URL)
 
 LIMIT = 15
 LIMIT_MAX = 50
+# Строк за одно обращение курсора в /chat/room/<name>/export.
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", default="500"))
+EXPORT_BATCH_MAX = int(os.getenv("EXPORT_BATCH_MAX", default="10000"))
+# Строк в одном COPY импорта сообщений, байт загруженного файла в памяти.
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", default="20000"))
+IMPORT_SPOOL_SIZE = int(os.getenv("IMPORT_SPOOL_SIZE", default="16777216"))
+# Длина превью последнего сообщения в /chat/my-rooms. Это длина колонки
+# rooms.last_snippet из миграции 9c3d5e7f1a2b, менять только новой миграцией.
+SNIPPET_LENGTH = 100
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", default="100"))
+WS_QUEUE_POLICY = os.getenv("WS_QUEUE_POLICY", default="drop_oldest")
+WS_QUEUE_CLOSE_CODE = int(os.getenv("WS_QUEUE_CLOSE_CODE", default="1013"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", default="20"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", default="60"))
+WS_IDLE_CLOSE_CODE = int(os.getenv("WS_IDLE_CLOSE_CODE", default="1001"))
+WS_HANDSHAKE_CONCURRENCY = int(os.getenv("WS_HANDSHAKE_CONCURRENCY", default="20"))
+WS_HANDSHAKE_QUEUE = int(os.getenv("WS_HANDSHAKE_QUEUE", default="500"))
+WS_HANDSHAKE_TIMEOUT = float(os.getenv("WS_HANDSHAKE_TIMEOUT", default="5"))
+WS_RETRY_AFTER = float(os.getenv("WS_RETRY_AFTER", default="2"))
+WS_RETRY_JITTER = float(os.getenv("WS_RETRY_JITTER", default="10"))
+
+# Комнату обслуживает один воркер, клиент узнает его в /chat/room/<name>/shard.
+# server.py называет каждый воркер "<SHARD_HOST>-<порт>" и открывает ему
+# отдельный порт от SHARD_PORT, nginx проксирует ?shard=<имя> на этот порт.
+SHARDING = os.getenv("SHARDING", default="False") == "True"
+SHARD_HOST = os.getenv("SHARD_HOST", default=socket.gethostname())
+SHARD_PORT = int(os.getenv("SHARD_PORT", default="8001"))
+SHARD_NAME = os.getenv("SHARD_NAME", default=SHARD_HOST)
+SHARD_NODES = [i for i in os.getenv("SHARD_NODES", default="").split(",") if i]
+SHARD_HEARTBEAT = float(os.getenv("SHARD_HEARTBEAT", default="5"))
+SHARD_TTL = float(os.getenv("SHARD_TTL", default="15"))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", default="128"))
+WS_SHARD_CLOSE_CODE = int(os.getenv("WS_SHARD_CLOSE_CODE", default="4001"))
+
+# Удаление комнаты: сообщения и участники удаляются в фоне пачками по PURGE_BATCH
+# с паузой PURGE_PAUSE секунд, комната закреплена за воркером на PURGE_LEASE секунд.
+PURGE_BATCH = int(os.getenv("PURGE_BATCH", default="1000"))
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", default="0.05"))
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", default="30"))
+PURGE_LEASE = float(os.getenv("PURGE_LEASE", default="60"))
+
+DRAIN_SIGNAL = os.getenv("DRAIN_SIGNAL", default="SIGTERM")
+DRAIN_WINDOW = float(os.getenv("DRAIN_WINDOW", default="10"))
+DRAIN_FLUSH_TIMEOUT = float(os.getenv("DRAIN_FLUSH_TIMEOUT", default="5"))
+
+# server.py, запуск в production. SERVER_WORKERS=0 - по воркеру на ядро,
+# у каждого воркера свой пул соединений, см. DB_POOL_MAX_SIZE.
+# Вебсокеты, лимиты запросов, admission и метрики живут в воркере: клиенты
+# одной комнаты на разных воркерах не видят сообщений друг друга.
+# Больше одного воркера только с SHARDING, он держит комнату на одном воркере.
+SERVER_HOST = os.getenv("SERVER_HOST", default="0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", default="8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", default="1")) or os.cpu_count() or 1
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", default="2048"))
+# Адреса, которым доверяем X-Forwarded-For, по нему лимиты узнают ip клиента.
+# За прокси на другом хосте здесь нужен адрес прокси, иначе у всех клиентов
+# будет ip прокси и общие лимиты.
+SERVER_FORWARDED_ALLOW_IPS = os.getenv("SERVER_FORWARDED_ALLOW_IPS", default="127.0.0.1")
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", default="5"))
+SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", default="30"))
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", default="20000"))
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", default="2000"))
+SERVER_LIMIT_CONCURRENCY = int(os.getenv("SERVER_LIMIT_CONCURRENCY", default="0")) or None
+SERVER_WS_MAX_SIZE = int(os.getenv("SERVER_WS_MAX_SIZE", default="1048576"))
+SERVER_WS_PING_INTERVAL = float(os.getenv("SERVER_WS_PING_INTERVAL", default="20"))
+SERVER_WS_PING_TIMEOUT = float(os.getenv("SERVER_WS_PING_TIMEOUT", default="20"))
+
+# GET /metrics в текстовом формате Prometheus, в прокси открыть только для сборщика.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", default="True") == "True"
+
+# Доля трассируемых HTTP запросов и кадров вебсокета, от 0 до 1. Последние
+# TRACE_RING_SIZE трасс отдает GET /api/admin/traces, если задан TRACE_FILE, они
+# дописываются в него строками JSON. "X-Trace: 1" с X-Admin-Token трассирует запрос.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", default="0"))
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", default="200"))
+TRACE_FILE = os.getenv("TRACE_FILE", default="")
+
+# Event loop проверяется каждые LOOP_LAG_INTERVAL секунд. Блокировка дольше
+# LOOP_BLOCK_THRESHOLD пишется в лог со стеком блокирующего вызова, 0 - без
+# сторожа. LOOP_BLOCK_FAIL=True роняет тесты, которые блокируют loop.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", default="0.05"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", default="0.1"))
+LOOP_BLOCK_FAIL = os.getenv("LOOP_BLOCK_FAIL", default="False") == "True"
+
+# "X-Profile: 1" с токеном админа пишет профиль запроса или сессии вебсокета
+# в PROFILE_DIR в формате folded stacks, пустое значение отключает профилирование.
+PROFILE_DIR = os.getenv("PROFILE_DIR", default="")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", default="0.001"))
+
+# Пустое значение отключает все маршруты /admin.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", default="")
+
+# "емкость/секунды", пустое значение отключает правило.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", default="memory")
+RATE_LIMITS = {
+    "auth.login.ip": os.getenv("RATE_LIMIT_LOGIN_IP", default="30/60"),
+    "auth.login.user": os.getenv("RATE_LIMIT_LOGIN_USER", default="20/60"),
+    "auth.refresh.ip": os.getenv("RATE_LIMIT_REFRESH_IP", default="30/60"),
+    "users.signup.ip": os.getenv("RATE_LIMIT_SIGNUP_IP", default="10/60"),
+    "ws.content": os.getenv("RATE_LIMIT_WS_CONTENT", default="20/10"),
+    "ws.page": os.getenv("RATE_LIMIT_WS_PAGE", default="10/10"),
+}
+WS_RATE_LIMIT_STRIKES = int(os.getenv("WS_RATE_LIMIT_STRIKES", default="10"))
 
 ALLOWED_TYPES = ("jpeg", "jpg", "png", "gif")
 SIZES = [400, 100, 50]
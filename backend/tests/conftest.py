@@ -6,8 +6,9 @@ import pytest
 import sqlalchemy
 from db import metadata
 from fastapi.testclient import TestClient
+from looplag import loop_monitor
 from main import app
-from settings import DATABASE_URL, TEST_HOST, TESTS_ROOT
+from settings import DATABASE_URL, LOOP_BLOCK_FAIL, TEST_HOST, TESTS_ROOT
 
 
 @dataclasses.dataclass
@@ -26,6 +27,18 @@ def create_test_database() -> Generator:
     metadata.drop_all(engine)
 
 
+@pytest.fixture(autouse=True)
+def loop_not_blocked() -> Generator:
+    """ With LOOP_BLOCK_FAIL=True a test that blocks the event loop fails. """
+    blocked = loop_monitor.blocked
+    yield
+    if LOOP_BLOCK_FAIL and loop_monitor.blocked != blocked:
+        block = loop_monitor.blocks[-1]
+        pytest.fail(
+            f"Event loop blocked for {block['blocked_ms']} ms:\n" + "".join(block["stack"])
+        )
+
+
 @pytest.fixture
 def client() -> Generator:
     """ We connect to the database. """
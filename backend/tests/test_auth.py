@@ -1,8 +1,10 @@
+import asyncio
 import os
 from pathlib import Path
 from typing import Any
 
 from fastapi import status
+from ratelimit import MemoryBackend, Rule
 from settings import AVATAR_ROOT
 from tests.conftest import TEST_HOST, Cache
 
@@ -100,6 +102,25 @@ def test_get_user(client: Any, user_one: dict, user_other: dict) -> None:
     assert user_other["email"] in response.json()["email"]
 
 
+def test_user_etag(client: Any, user_one: dict) -> None:
+    username = user_one["username"]
+    response = client.get(f"/api/users/{username}")
+    etag = response.headers["ETag"]
+    response = client.get(f"/api/users/{username}", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+
+    headers = {**Cache.headers, "If-None-Match": etag}
+    response = client.get("/api/users/me", headers=headers)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    response = client.put(f"/api/users/{username}", json={"firstname": "etag"}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    response = client.get("/api/users/me", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+
+
 def test_post_token_refresh(client: Any, host: Any) -> None:
     response = client.post("/api/auth/refresh", json=Cache.refresh_token)
     assert response.status_code == status.HTTP_200_OK
@@ -141,3 +162,32 @@ def test_put_user_update(client: Any, user_one: dict, image: str) -> None:
     for p in Path(AVATAR_ROOT).glob("*.png"):
         p.unlink()
     assert len(os.listdir(AVATAR_ROOT)) - 1 == 0
+
+
+def test_post_login_rate_limit(client: Any, host: Any) -> None:
+    host.host = "127.0.0.200"
+    data = {"username": "ratelimit", "password": "incorrect"}
+    for _ in range(20):
+        response = client.post("/api/auth/login", data=data)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    response = client.post("/api/auth/login", data=data)
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert "Retry-After" in response.headers
+
+
+def test_memory_backend_lru(mocker: Any) -> None:
+    mocker.patch.object(MemoryBackend, "max_keys", 3)
+    backend = MemoryBackend()
+    rule = Rule("2/60")
+
+    async def run() -> list[float]:
+        retries = [await backend.take(key, rule) for key in ("a", "b", "a", "c", "d")]
+        retries.append(await backend.take("a", rule))
+        return retries
+
+    retries = asyncio.run(run())
+    # "b" was used least recently, "a" kept its spent tokens.
+    assert list(backend.buckets) == ["c", "d", "a"]
+    assert retries[:5] == [0, 0, 0, 0, 0]
+    assert retries[5] > 0
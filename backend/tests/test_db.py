@@ -0,0 +1,172 @@
+import asyncio
+import os
+from typing import Any
+
+import pytest
+import sqlalchemy as sa
+from chats.models import Room, room
+from db import (DB_QUERY, Base, Database, PoolTimeout, Record, Replicas,
+                Statement, create_tables, primary, query_scope, raw_connection)
+from fastapi.encoders import jsonable_encoder
+from settings import BASE_DIR, DATABASE_URL, SNIPPET_LENGTH
+from users.models import User, user
+
+
+def test_statement() -> None:
+    statement = Statement(
+        sa.select(user.c.id, user.c.username.label("name")).where(
+            user.c.username == sa.bindparam("username"),
+            user.c.is_active == sa.bindparam("active", True),
+        ),
+        name="User.test",
+    )
+    assert not statement.replica
+    assert statement.args({"username": "one"}) == [True, "one"]
+    with pytest.raises(KeyError, match="User.test has no value for username"):
+        statement.args({"user_name": "one"})
+    assert statement.sql.split("WHERE")[1].split() == [
+        "users.username", "=", "$2", "AND", "users.is_active", "=", "$1"
+    ]
+
+    async def run() -> None:
+        database = Database(DATABASE_URL, min_size=1, max_size=1)
+        await database.connect()
+        try:
+            async with raw_connection(database) as connection:
+                args = statement.args({"username": "missing"})
+                row = await connection.fetchrow(statement.sql, *args)
+        finally:
+            await database.disconnect()
+        assert row is None
+
+    asyncio.run(run())
+
+
+def test_record() -> None:
+    row: dict[str, Any] = {"id": 1, "name": "one", "image": None}
+    record = Record(row)
+    assert (record.id, record["name"], record.image) == (1, "one", None)
+    assert dict(record) == row
+    assert list(record) == ["id", "name", "image"]
+    assert jsonable_encoder(record) == row
+    with pytest.raises(AttributeError):
+        record.missing
+
+
+def test_replica_routing(user_one: dict, mocker: Any) -> None:
+    """ Set REPLICA_TEST_URLS to run against two real replicas. """
+    urls = os.getenv("REPLICA_TEST_URLS", default=f"{DATABASE_URL},{DATABASE_URL}")
+
+    async def run() -> None:
+        database = Database(DATABASE_URL)
+        replicas = Replicas(urls.split(","))
+        db_user, db_room = User(database, replicas), Room(database, replicas)
+        await database.connect()
+        await replicas.connect()
+        try:
+            assert len(replicas.healthy) == 2
+            assert {id(replicas.pick()) for _ in range(4)} == {id(i) for i in replicas.databases}
+            pick = mocker.spy(replicas, "pick")
+            # Reads stay on the primary unless the statement allows a replica.
+            assert await db_user.by_username(user_one["username"])
+            assert pick.call_count == 0
+            await db_room.all_rooms(is_active=False)
+            assert pick.call_count == 1 and pick.spy_return is not None
+            with primary():
+                assert replicas.pick() is None
+                await db_room.all_rooms(is_active=False)
+
+            replicas.max_lag = -1
+            await replicas.check()
+            assert replicas.healthy == []
+            assert await db_room.all_rooms(is_active=False) is not None
+        finally:
+            await replicas.disconnect()
+            await database.disconnect()
+
+    asyncio.run(run())
+
+
+def test_pool_timeout() -> None:
+    async def run() -> None:
+        database = Database(DATABASE_URL, min_size=1, max_size=1, acquire_timeout=0.1)
+        held, done = asyncio.Event(), asyncio.Event()
+
+        async def hold() -> None:
+            async with database.connection():
+                held.set()
+                await done.wait()
+
+        await database.connect()
+        task = asyncio.create_task(hold())
+        try:
+            await held.wait()
+            assert database.pool_stats()["in_use"] == 1
+            with pytest.raises(PoolTimeout):
+                await database.fetch_val("SELECT 1")
+            done.set()
+            await task
+            assert await database.fetch_val("SELECT 1") == 1
+            stats = database.pool_stats()
+            assert stats["timeouts"] == 1
+            assert stats["waiting"] == 0
+            assert stats["acquired"] == 2
+        finally:
+            done.set()
+            await database.disconnect()
+
+    asyncio.run(run())
+
+
+def test_create_tables_drift(caplog: Any) -> None:
+    async def run() -> None:
+        database = Database(DATABASE_URL, min_size=1, max_size=1)
+        await database.connect()
+        try:
+            await database.execute("ALTER TABLE users RENAME COLUMN version TO version_old")
+            try:
+                await create_tables(database)
+            finally:
+                await database.execute("ALTER TABLE users RENAME COLUMN version_old TO version")
+            await create_tables(database)
+        finally:
+            await database.disconnect()
+
+    caplog.set_level("WARNING", logger="db")
+    asyncio.run(run())
+    warnings = [i.getMessage() for i in caplog.records if i.name == "db"]
+    assert warnings == ['Table users has no columns version, run "alembic upgrade head"']
+
+
+def test_snippet_length() -> None:
+    path = os.path.join(BASE_DIR, "migrations", "versions", "9c3d5e7f1a2b_room_summary.py")
+    with open(path) as file:
+        source = file.read()
+    assert room.c.last_snippet.type.length == SNIPPET_LENGTH
+    assert f"sa.String(length={SNIPPET_LENGTH})" in source
+    assert f"left(last.content, {SNIPPET_LENGTH})" in source
+
+
+def test_iterate_recorded() -> None:
+    statement = Statement(
+        sa.select(
+            sa.func.generate_series(sa.cast(1, sa.Integer), sa.cast(sa.bindparam("n"), sa.Integer))
+            .label("n")
+        ),
+        name="Test.series",
+    )
+
+    async def run() -> None:
+        database = Database(DATABASE_URL, min_size=1, max_size=1)
+        await database.connect()
+        try:
+            with query_scope("export", budget=0) as stats:
+                rows = [i.n async for i in Base(database).iterate(statement, prefetch=2, n=5)]
+        finally:
+            await database.disconnect()
+        assert rows == [1, 2, 3, 4, 5]
+        assert stats.count == 1
+        assert list(stats.statements) == [f"Test.series[{statement.fingerprint}]"]
+
+    asyncio.run(run())
+    assert sum(DB_QUERY.counts[("Test.series", "primary")]) == 1
@@ -0,0 +1,90 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+from fastapi import status
+from looplag import LoopMonitor
+from profiler import Profile
+
+
+def test_trace(client: Any, user_one: dict, mocker: Any) -> None:
+    mocker.patch("tracing.ADMIN_TOKEN", "token")
+    mocker.patch("admin.utils.ADMIN_TOKEN", "token")
+    headers = {"X-Admin-Token": "token"}
+    username = user_one["username"]
+    response = client.get(f"/api/users/{username}", headers={**headers, "X-Trace": "1"})
+    trace_id = response.headers["X-Trace-Id"]
+
+    response = client.get("/api/admin/traces", params={"name": "/api/users/"}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    trace = response.json()[0]
+    assert trace["trace_id"] == trace_id
+    assert trace["name"] == "GET /api/users/{username}"
+    assert [i["name"] for i in trace["spans"]][1:] == ["db User.by_username"]
+
+
+def test_loop_monitor() -> None:
+    def block() -> None:
+        time.sleep(0.3)
+
+    async def run() -> None:
+        monitor = LoopMonitor(interval=0.01, threshold=0.1)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.05)
+            block()
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.stop()
+        assert monitor.blocked == 1
+        stats = monitor.stats()
+        assert stats["lag_ms_max"] >= 200
+        assert stats["blocks"][0]["blocked_ms"] >= 200
+        assert "in block" in stats["blocks"][0]["stack"][-1]
+
+    asyncio.run(run())
+
+
+def test_loop_monitor_restart() -> None:
+    async def run() -> None:
+        monitor = LoopMonitor(interval=0.01, threshold=0.1)
+        monitor.start()
+        await monitor.stop()
+        monitor.start()
+        try:
+            assert monitor._watchdog is not None and monitor._watchdog.is_alive()
+            await asyncio.sleep(0.05)
+            time.sleep(0.3)
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.stop()
+        assert monitor.blocked == 1
+        assert monitor._watchdog is None
+
+    asyncio.run(run())
+
+
+def test_profile(tmp_path: Path) -> None:
+    def busy() -> int:
+        return sum(range(3_000_000))
+
+    async def run() -> Profile:
+        profile = Profile("GET /busy", sys._getframe(), interval=0.001, directory=str(tmp_path))
+        profile.start()
+        try:
+            await asyncio.sleep(0.01)
+            busy()
+        finally:
+            profile.stop()
+        return profile
+
+    profile = asyncio.run(run())
+    profile.save()
+    assert Path(profile.path).parent == tmp_path
+    folded = Path(profile.path).read_text().splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in folded) == profile.samples
+    assert any(
+        line.startswith("run (test_observability.py") and "busy (" in line for line in folded
+    )
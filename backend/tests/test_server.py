@@ -0,0 +1,99 @@
+import asyncio
+import importlib
+import os
+import re
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+import server
+import settings
+import yaml
+from settings import SERVER_HOST, SHARD_HOST, SHARD_PORT
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+
+def test_worker_shards(mocker: Any) -> None:
+    mocker.patch("server.SHARDING", True)
+    mocker.patch.object(settings, "SHARD_NAME", settings.SHARD_NAME)
+    tcp_socket = mocker.patch("server.TCPSocket")
+    arbiter = SimpleNamespace(WORKERS={}, cfg=object(), log=object())
+    for pid in range(3):
+        worker = SimpleNamespace(sockets=["shared"])
+        server.pre_fork(arbiter, worker)
+        arbiter.WORKERS[pid] = worker
+    assert [i.slot for i in arbiter.WORKERS.values()] == [0, 1, 2]
+
+    # The worker in slot 1 died, its replacement gets the same slot and name.
+    del arbiter.WORKERS[1]
+    worker = SimpleNamespace(sockets=["shared"])
+    server.pre_fork(arbiter, worker)
+    server.post_fork(arbiter, worker)
+    assert worker.slot == 1
+    assert settings.SHARD_NAME == f"{SHARD_HOST}-{SHARD_PORT + 1}"
+    tcp_socket.assert_called_once_with((SERVER_HOST, SHARD_PORT + 1), arbiter.cfg, arbiter.log)
+    assert worker.sockets == ["shared", tcp_socket.return_value]
+
+
+@pytest.mark.parametrize("workers, expected", [(None, 1), ("3", 3), ("0", os.cpu_count())])
+def test_options(monkeypatch: Any, workers: str | None, expected: int) -> None:
+    if workers is None:
+        monkeypatch.delenv("SERVER_WORKERS", raising=False)
+    else:
+        monkeypatch.setenv("SERVER_WORKERS", workers)
+    monkeypatch.setenv("SERVER_PORT", "8123")
+    try:
+        importlib.reload(settings)
+        options = importlib.reload(server).OPTIONS
+    finally:
+        monkeypatch.undo()
+        importlib.reload(settings)
+        importlib.reload(server)
+    assert options["workers"] == expected
+    assert options["bind"] == f"{SERVER_HOST}:8123"
+    assert options["worker_class"] == "server.Worker"
+    assert options["graceful_timeout"] > settings.DRAIN_WINDOW + settings.DRAIN_FLUSH_TIMEOUT
+
+
+def test_forwarded_ips(monkeypatch: Any) -> None:
+    monkeypatch.setenv("SERVER_FORWARDED_ALLOW_IPS", "10.0.0.2")
+    try:
+        importlib.reload(settings)
+        options = importlib.reload(server).OPTIONS
+    finally:
+        monkeypatch.undo()
+        importlib.reload(settings)
+        importlib.reload(server)
+    clients = []
+
+    async def app(scope: dict, receive: Any, send: Any) -> None:
+        clients.append(scope["client"][0])
+
+    # The same middleware uvicorn workers put in front of the app.
+    proxy = ProxyHeadersMiddleware(app, options["forwarded_allow_ips"])  # type: ignore[arg-type]
+    for client in ("10.0.0.2", "10.0.0.3"):
+        scope = {
+            "type": "http",
+            "scheme": "http",
+            "client": (client, 40000),
+            "headers": [(b"x-forwarded-for", b"203.0.113.7")],
+        }
+        asyncio.run(proxy(scope, None, None))  # type: ignore[arg-type]
+    assert clients == ["203.0.113.7", "10.0.0.3"]
+
+
+def test_compose_trusts_nginx() -> None:
+    compose = yaml.safe_load((Path(__file__).parents[2] / "infra/docker-compose.yml").read_text())
+    services = compose["services"]
+    nginx = services["nginx"]["networks"]["default"]["ipv4_address"]
+    assert f"SERVER_FORWARDED_ALLOW_IPS={nginx}" in services["backend"]["environment"]
+
+
+def test_nginx_shard_ports() -> None:
+    conf = (Path(__file__).parents[2] / "infra/nginx.conf").read_text()
+    [pattern] = re.findall(r'"~(\^backend-.*\$)"', conf)
+    ports = range(SHARD_PORT, SHARD_PORT + 8)
+    assert all(re.match(pattern, f"backend-{port}") for port in ports)
+    for shard in ("backend-5432", "backend-6379", "backend-80", "backend-8001/x", "db-8001"):
+        assert not re.match(pattern, shard)
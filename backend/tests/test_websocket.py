@@ -1,9 +1,43 @@
+import asyncio
+import contextvars
+import json
+import logging
+import uuid
 from typing import Any
 
+import pytest
+from chats.api_chats import purger
+from chats.models import db_room
+from chats.sharding import HashRing, Sharding
+from chats.utils import (PING, QUEUE_POLICIES, RECONNECT, Admission,
+                         ConnectionManager, RoomPurger)
 from fastapi import status
+from settings import WS_IDLE_CLOSE_CODE, WS_QUEUE_CLOSE_CODE
 from tests.conftest import Cache
 
 
+class SlowWebSocket:
+    """ A client that reads nothing until unblock is set. """
+
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.sent: list[dict] = []
+        self.closed: tuple[int, str] | None = None
+        self.unblock = asyncio.Event()
+
+    async def accept(self) -> None:
+        pass
+
+    async def send_text(self, data: str) -> None:
+        if self.fail:
+            raise RuntimeError("Connection lost")
+        await self.unblock.wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        self.closed = (code, reason)
+
+
 def test_post_create_room(client: Any, room: dict, room_privat: dict) -> None:
     response = client.post("/api/chat/room", json=room, headers=Cache.headers)
     assert response.status_code == status.HTTP_201_CREATED
@@ -57,6 +91,24 @@ def test_post_add_user_in_chat(
         assert len(response.json()) == 2
 
 
+def test_room_etag(client: Any, room: dict) -> None:
+    room_name = room["name"]
+    response = client.get(f"/api/chat/room/{room_name}", headers=Cache.headers)
+    etag = response.headers["ETag"]
+    headers = {**Cache.headers, "If-None-Match": etag}
+    response = client.get(f"/api/chat/room/{room_name}", headers=headers)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    with client.websocket_connect(f"/api/chat/ws/{room_name}", headers=Cache.headers) as ws:
+        ws.send_json({"page": 1})
+        ws.receive_json()
+        response = client.get(f"/api/chat/room/{room_name}", headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["is_active"] is True
+        assert response.headers["ETag"] != etag
+        ws.send_json({"type": "disconnect"})
+
+
 def test_get_all_rooms(client: Any, room: dict) -> None:
     response = client.get("/api/chat/rooms", headers=Cache.headers)
     assert response.status_code == status.HTTP_200_OK
@@ -76,3 +128,396 @@ def test_delete_room(client: Any, room_privat: dict) -> None:
 
     response = client.get(f"/api/chat/room/{room_name}", headers=Cache.headers)
     assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    response = client.delete(f"/api/chat/room/{room_name}", headers=Cache.headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    response = client.post("/api/chat/room", json=room_privat, headers=Cache.headers)
+    assert response.status_code == status.HTTP_201_CREATED
+
+    response = client.delete(f"/api/chat/room/{room_name}", headers=Cache.headers)
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_room_purge(client: Any, room_privat: dict, mocker: Any) -> None:
+    mocker.patch("admin.utils.ADMIN_TOKEN", "token")
+    mocker.patch.object(purger, "wake")
+    headers = {"X-Admin-Token": "token"}
+    # lease=0: the room of a failed purge can be claimed again at once.
+    room_purger = RoomPurger(batch=2, pause=0, lease=0)
+    while client.portal.call(room_purger.purge_next):
+        pass
+
+    def purging() -> list[dict]:
+        response = client.get("/api/admin/purge", headers=headers)
+        return [i for i in response.json() if i["id"] == room_id]
+
+    room_name = room_privat["name"]
+    response = client.post("/api/chat/room", json=room_privat, headers=Cache.headers)
+    room_id = response.json()["id"]
+    with client.websocket_connect(f"/api/chat/ws/{room_name}", headers=Cache.headers) as ws:
+        for content in ("one", "two", "three"):
+            ws.send_json({"content": content})
+            assert ws.receive_json()["accepted"] is True
+        ws.send_json({"type": "disconnect"})
+    client.delete(f"/api/chat/room/{room_name}", headers=Cache.headers)
+    [deleted] = purging()
+    assert (deleted["messages_left"], deleted["purged"]) == (3, 0)
+    assert deleted["members_left"] >= 1
+
+    # Interrupted after the messages, the next run resumes with the members.
+    purge_members = mocker.patch.object(db_room, "purge_members", side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        client.portal.call(room_purger.purge_next)
+    [deleted] = purging()
+    assert (deleted["messages_left"], deleted["purged"]) == (0, 3)
+    assert deleted["members_left"] >= 1
+
+    mocker.stop(purge_members)
+    assert client.portal.call(room_purger.purge_next) is True
+    assert purging() == []
+
+
+def test_purger_backoff(mocker: Any, caplog: Any) -> None:
+    async def run() -> None:
+        room_purger = RoomPurger(interval=0.01)
+        purge_next = mocker.patch.object(
+            room_purger, "purge_next", side_effect=[ConnectionError, ConnectionError, False]
+        )
+        room_purger.start()
+        while purge_next.call_count < 3:
+            await asyncio.sleep(0.01)
+        await room_purger.stop()
+
+    with caplog.at_level(logging.ERROR, logger="chats"):
+        asyncio.run(run())
+    assert [i.getMessage() for i in caplog.records] == [
+        "Room purge failed, 1 in a row", "Room purge failed, 2 in a row"
+    ]
+    assert all(i.exc_info for i in caplog.records)
+    assert [RoomPurger(interval=30).backoff(i) for i in (1, 2, 3, 4, 5)] == [30, 60, 120, 240, 300]
+
+
+def test_websocket_broadcast(client: Any, room: dict) -> None:
+    room_name = room["name"]
+    with client.websocket_connect(f"/api/chat/ws/{room_name}", headers=Cache.headers) as ws:
+        ws.send_json({"content": "hello"})
+        data = ws.receive_json()
+        assert data["accepted"] is True
+        assert data["content"] == "hello"
+
+        ws.send_json({"page": 1})
+        data = ws.receive_json()
+        assert data["messages"][0]["content"] == "hello"
+        ws.send_json({"type": "disconnect"})
+
+
+def test_my_rooms_unread(client: Any, room: dict) -> None:
+    room_name = room["name"]
+    response = client.get("/api/chat/my-rooms", headers=Cache.headers)
+    assert response.status_code == status.HTTP_200_OK
+    summary = response.json()[0]
+    assert summary["name"] == room_name
+    assert summary["last_snippet"] == "hello"
+    assert summary["unread"] == 0
+
+    response = client.get("/api/chat/my-rooms", headers=Cache.headers_other)
+    summary = response.json()[0]
+    assert summary["unread"] == summary["message_count"] == 1
+
+    response = client.post(f"/api/chat/room/{room_name}/read", json={}, headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"last_read_key": summary["last_message_key"], "unread": 0}
+
+
+def test_export_room(client: Any, room: dict) -> None:
+    room_name = room["name"]
+    response = client.get(f"/api/chat/room/{room_name}/export", headers=Cache.headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(i) for i in response.text.splitlines()]
+    assert [i["content"] for i in lines] == ["hello"]
+
+    params = {"after": lines[-1]["key"]}
+    response = client.get(
+        f"/api/chat/room/{room_name}/export", params=params, headers=Cache.headers
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.text == ""
+
+    for after in ("unknown", str(uuid.uuid4())):
+        response = client.get(
+            f"/api/chat/room/{room_name}/export", params={"after": after}, headers=Cache.headers
+        )
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        assert response.json() == {"detail": "Message not found"}
+
+
+def test_admin_import(client: Any, room: dict, mocker: Any) -> None:
+    mocker.patch("admin.utils.ADMIN_TOKEN", "token")
+    headers = {"X-Admin-Token": "token"}
+    user_id = client.get("/api/users/me", headers=Cache.headers).json()["id"]
+    summary = client.get("/api/chat/my-rooms", headers=Cache.headers).json()[0]
+    rows = [
+        {"room_id": summary["id"], "user_id": user_id, "content": "imported"},
+        {"room_id": summary["id"], "user_id": user_id, "content": "old",
+         "create": "2000-01-01T00:00:00+00:00"},
+        {"room_id": summary["id"], "user_id": user_id, "content": "again",
+         "key": summary["last_message_key"]},
+        {"room_id": 0, "user_id": user_id, "content": "no room"},
+    ]
+    body = "\n".join(json.dumps(i) for i in rows) + "\nnot json\n"
+    response = client.post("/api/admin/import", content=body, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    stats = response.json()
+    assert (stats["read"], stats["imported"], stats["duplicates"], stats["invalid"]) == (5, 2, 1, 2)
+
+    response = client.get("/api/chat/my-rooms", headers=Cache.headers)
+    imported = response.json()[0]
+    assert imported["message_count"] == summary["message_count"] + 2
+    assert imported["last_snippet"] == "imported"
+    assert imported["unread"] == 0
+
+    body = f"room_id,user_id,content\n{summary['id']},{user_id},from csv\n"
+    response = client.post(
+        "/api/admin/import", params={"format": "csv"}, content=body, headers=headers
+    )
+    assert response.json()["imported"] == 1
+
+
+def test_metrics(client: Any, room: dict) -> None:
+    client.get(f"/api/chat/room/{room['name']}", headers=Cache.headers)
+    response = client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert 'route="/api/chat/room/{name}",status="200"' in text
+    assert 'statement="Room.version"' in text
+    assert "ws_frames_sent_total" in text
+    assert 'db_pool_in_use{worker=' in text
+
+
+def test_query_budget(client: Any, room: dict, mocker: Any, caplog: Any) -> None:
+    mocker.patch("db.DB_QUERY_BUDGET", 2)
+    with caplog.at_level(logging.WARNING, logger="db"):
+        client.get(f"/api/chat/room/{room['name']}", headers=Cache.headers)
+    assert "Query budget 2 exceeded by GET /api/chat/room/{name}: 3 queries" in caplog.text
+    assert "Room.by_name" in caplog.text
+
+
+@pytest.mark.parametrize("policy", QUEUE_POLICIES)
+def test_queue_policy(policy: str, mocker: Any) -> None:
+    mocker.patch("chats.utils.db_room.update_is_active")
+    expected = {
+        "drop_oldest": [{"n": 3}, {"n": 4}, {"n": 5}],
+        "coalesce": [
+            {"room_id": 1, "coalesced": True, "messages": [{"n": 3}, {"n": 4}]}, {"n": 5}
+        ],
+        "disconnect": [],
+    }
+
+    async def run() -> None:
+        manager = ConnectionManager(queue_size=3, policy=policy, ping_interval=60)
+        websocket = SlowWebSocket()
+        session = await manager.connect(websocket, 1)  # type: ignore[arg-type]
+        for n in range(6):
+            await manager.broadcast({"n": n}, 1)
+        assert len(session.queue or ()) <= 3
+        websocket.unblock.set()
+        await asyncio.sleep(0.01)
+        assert websocket.sent == expected[policy]
+        if policy == "disconnect":
+            assert websocket.closed == (WS_QUEUE_CLOSE_CODE, "Slow consumer")
+            assert manager.dropped[1] == 4
+        else:
+            assert websocket.closed is None
+            assert manager.dropped[1] == 3
+            assert session.writer is None
+            assert session.queue is None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("policy", ["drop_oldest", "coalesce"])
+def test_queue_control_frames(policy: str, mocker: Any) -> None:
+    mocker.patch("chats.utils.db_room.update_is_active")
+    expected = {
+        "drop_oldest": [PING, {"n": 3}, {"n": 4}, {"n": 5}, RECONNECT],
+        "coalesce": [
+            {"room_id": 1, "coalesced": True, "messages": [{"n": 3}, {"n": 4}]}, PING,
+            {"n": 5}, RECONNECT,
+        ],
+    }
+
+    async def run() -> None:
+        manager = ConnectionManager(queue_size=3, policy=policy, ping_interval=60)
+        websocket = SlowWebSocket()
+        session = await manager.connect(websocket, 1)  # type: ignore[arg-type]
+        for n in range(3):
+            await manager.broadcast({"n": n}, 1)
+        manager._enqueue(session, PING, None)
+        for n in range(3, 6):
+            await manager.broadcast({"n": n}, 1)
+        manager._enqueue(session, RECONNECT, None)
+        websocket.unblock.set()
+        await asyncio.sleep(0.01)
+        assert websocket.sent == expected[policy]
+
+    asyncio.run(run())
+
+
+def test_tasks_context(mocker: Any) -> None:
+    mocker.patch("chats.utils.db_room.update_is_active")
+    request = contextvars.ContextVar("request", default="")
+    seen = []
+
+    class ContextWebSocket(SlowWebSocket):
+        async def send_text(self, data: str) -> None:
+            seen.append(request.get())
+
+    async def run() -> None:
+        manager = ConnectionManager(ping_interval=0.01)
+        websocket = ContextWebSocket()
+        request.set("handshake")
+        await manager.connect(websocket, 1)  # type: ignore[arg-type]
+        await manager.broadcast({"n": 0}, 1)
+        await asyncio.sleep(0.05)
+        assert manager._reaper is not None
+        manager._reaper.cancel()
+
+    asyncio.run(run())
+    # The broadcast and at least one ping of the reaper.
+    assert len(seen) >= 2
+    assert set(seen) == {""}
+
+
+def test_send_failure_disconnects(mocker: Any) -> None:
+    mocker.patch("chats.utils.db_room.update_is_active")
+
+    async def run() -> None:
+        manager = ConnectionManager()
+        websocket = SlowWebSocket(fail=True)
+        await manager.connect(websocket, 1)  # type: ignore[arg-type]
+        await manager.broadcast({"n": 0}, 1)
+        await asyncio.sleep(0.01)
+        assert websocket.closed == (status.WS_1011_INTERNAL_ERROR, "Send failed")
+        assert manager.connections == {}
+        assert manager.active_connections == {}
+
+    asyncio.run(run())
+
+
+def test_registry(mocker: Any) -> None:
+    update_is_active = mocker.patch("chats.utils.db_room.update_is_active")
+
+    async def run() -> None:
+        manager = ConnectionManager()
+        closed: list[tuple[Any, int]] = []
+
+        @manager.on_disconnect
+        async def hook(websocket: Any, room_id: int) -> None:
+            closed.append((websocket, room_id))
+
+        sockets = [SlowWebSocket() for _ in range(4)]
+        for n, websocket in enumerate(sockets):
+            session = await manager.connect(
+                websocket, n % 2, user_id=n, username=f"user{n}"  # type: ignore[arg-type]
+            )
+            assert (session.room_id, session.user_id, session.username) == (n % 2, n, f"user{n}")
+        assert {room: len(i) for room, i in manager.active_connections.items()} == {0: 2, 1: 2}
+        assert manager.stats()[0] == {"connections": 2, "queued": 0, "max_queued": 0, "dropped": 0}
+        assert manager.memory_per_connection() > 0
+        assert all(i.queue is None for i in manager.connections.values())
+
+        await manager.disconnect(sockets[0])  # type: ignore[arg-type]
+        await manager.disconnect(sockets[0])  # type: ignore[arg-type]
+        assert list(manager.active_connections[0]) == [sockets[2]]
+        await manager.disconnect(sockets[2])  # type: ignore[arg-type]
+        assert list(manager.active_connections) == [1]
+        assert list(manager.connections) == sockets[1::2]
+        assert closed == [(sockets[0], 0), (sockets[2], 0)]
+        # The room is marked inactive once, when its last connection leaves.
+        assert update_is_active.await_args_list[-1].args == (0, False)
+        assert [i.args for i in update_is_active.await_args_list].count((0, False)) == 1
+
+    asyncio.run(run())
+
+
+def test_reaper(mocker: Any, caplog: Any) -> None:
+    mocker.patch("chats.utils.db_room.update_is_active")
+
+    async def run() -> None:
+        manager = ConnectionManager(ping_interval=0.02, idle_timeout=0.1)
+        failed: list[Any] = []
+
+        @manager.on_disconnect
+        async def hook(websocket: Any, room_id: int) -> None:
+            if not failed:
+                failed.append(websocket)
+                raise RuntimeError("Hook failed")
+
+        sockets = [SlowWebSocket() for _ in range(3)]
+        for websocket in sockets:
+            websocket.unblock.set()
+            await manager.connect(websocket, 1)  # type: ignore[arg-type]
+        await asyncio.sleep(0.05)
+        assert all(PING in websocket.sent for websocket in sockets)
+
+        # The last client keeps talking, the others stay silent past idle_timeout.
+        for _ in range(20):
+            manager.touch(sockets[2])  # type: ignore[arg-type]
+            await asyncio.sleep(0.01)
+        assert [i.closed for i in sockets] == [(WS_IDLE_CLOSE_CODE, "Idle timeout")] * 2 + [None]
+        assert list(manager.connections) == [sockets[2]]
+        assert failed and manager._reaper is not None and not manager._reaper.done()
+
+    with caplog.at_level(logging.ERROR, logger="chats"):
+        asyncio.run(run())
+    assert "Reaping connection in room 1 failed" in caplog.text
+
+
+def test_admission() -> None:
+    async def run() -> None:
+        admission = Admission(limit=1, queue_size=1, timeout=0.05)
+        assert await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        assert admission.stats() == {"active": 1, "waiting": 1, "rejected": 0}
+        # The queue is full: rejected at once, the waiter times out.
+        assert not await admission.acquire()
+        assert not await waiter
+        assert admission.stats() == {"active": 1, "waiting": 0, "rejected": 2}
+
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        admission.release()
+        assert await waiter
+        assert admission.stats() == {"active": 1, "waiting": 0, "rejected": 2}
+
+        websocket = SlowWebSocket()
+        await admission.reject(websocket)  # type: ignore[arg-type]
+        assert websocket.closed is not None
+        code, reason = websocket.closed
+        assert code == status.WS_1013_TRY_AGAIN_LATER
+        assert reason.startswith("retry-after=")
+
+    asyncio.run(run())
+
+
+def test_hash_ring() -> None:
+    rooms = [f"room{i}" for i in range(2000)]
+    nodes = ["backend-8001", "backend-8002", "backend-8003"]
+    ring = HashRing(nodes)
+    owners = {name: ring.owner(name) for name in rooms}
+    # Every worker builds the same ring from the names, in any order.
+    assert owners == {name: HashRing(nodes[::-1]).owner(name) for name in rooms}
+    assert set(owners.values()) == set(nodes)
+
+    # A new worker takes about a quarter of the rooms, the rest stay where they were.
+    bigger = HashRing([*nodes, "backend-8004"])
+    moved = [name for name in rooms if bigger.owner(name) != owners[name]]
+    assert {bigger.owner(name) for name in moved} == {"backend-8004"}
+    assert 0.15 < len(moved) / len(rooms) < 0.35
+
+    sharding = Sharding("backend-8002", nodes)
+    assert [sharding.is_local(i) for i in rooms] == [owners[i] == "backend-8002" for i in rooms]
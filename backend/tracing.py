@@ -0,0 +1,187 @@
+"""
+Request tracing without a collector.
+
+A sampled HTTP request or websocket frame becomes a trace, span() blocks
+inside it (database, Redis, bcrypt, images) become its child spans. Finished
+traces are kept in a ring for GET /api/admin/traces and appended to
+TRACE_FILE as JSON lines. Outside a sampled trace span() only reads a contextvar.
+"""
+import itertools
+import json
+import os
+import random
+import secrets
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import IO, Any, Iterator
+
+from settings import (ADMIN_TOKEN, TRACE_FILE, TRACE_RING_SIZE,
+                      TRACE_SAMPLE_RATE)
+
+
+class Trace:
+    __slots__ = ("id", "started_at", "start", "spans", "ids")
+
+    def __init__(self) -> None:
+        self.id = os.urandom(8).hex()
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+        self.ids = itertools.count(1)
+
+    def to_dict(self) -> dict[str, Any]:
+        root = next(i for i in self.spans if i.parent is None)
+        return {
+            "trace_id": self.id,
+            "name": root.name,
+            "started_at": self.started_at,
+            "duration_ms": round(root.duration * 1000, 3),
+            "spans": [i.to_dict() for i in sorted(self.spans, key=lambda i: i.start)],
+        }
+
+
+class Span:
+    __slots__ = ("trace", "id", "parent", "name", "attrs", "start", "duration")
+
+    def __init__(self, trace: Trace, parent: int | None, name: str, attrs: dict) -> None:
+        self.trace = trace
+        self.id = next(trace.ids)
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration = 0.0
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self.start
+        # list.append is atomic, spans may finish in threadpool threads.
+        self.trace.spans.append(self)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.start) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            **self.attrs,
+        }
+
+
+current: ContextVar[Span | None] = ContextVar("span", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Span | None]:
+    """ Child span of the current one, nothing when the request is not traced. """
+    parent = current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, parent.id, name, attrs)
+    token = current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.reset(token)
+        child.finish()
+
+
+class Tracer:
+    def __init__(
+        self,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        ring_size: int = TRACE_RING_SIZE,
+        path: str = TRACE_FILE,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.ring: deque[dict[str, Any]] = deque(maxlen=ring_size)
+        self.path = path
+        self._file: IO[str] | None = None
+
+    @contextmanager
+    def trace(self, name: str, force: bool = False) -> Iterator[Span | None]:
+        """ Root span of a new trace if sampled, inside a trace it is a plain span. """
+        if current.get() is not None:
+            with span(name) as child:
+                yield child
+            return
+        if not force and (not self.sample_rate or random.random() >= self.sample_rate):
+            yield None
+            return
+        root = Span(Trace(), None, name, {})
+        token = current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            current.reset(token)
+            root.finish()
+            self.save(root.trace)
+
+    def save(self, trace: Trace) -> None:
+        data = trace.to_dict()
+        self.ring.append(data)
+        if self.path:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(json.dumps(data, default=str) + "\n")
+
+    def traces(self, limit: int, min_ms: float = 0, name: str = "") -> list[dict[str, Any]]:
+        """ Newest first. """
+        result = []
+        for data in reversed(self.ring):
+            if data["duration_ms"] >= min_ms and name in data["name"]:
+                result.append(data)
+                if len(result) >= limit:
+                    break
+        return result
+
+
+tracer = Tracer()
+
+
+def forced(headers: list[tuple[bytes, bytes]]) -> bool:
+    """ "X-Trace: 1" traces the request regardless of sampling, with the admin token only. """
+    if not ADMIN_TOKEN:
+        return False
+    values = dict(headers)
+    token = values.get(b"x-admin-token", b"").decode("latin-1")
+    return values.get(b"x-trace") == b"1" and secrets.compare_digest(token, ADMIN_TOKEN)
+
+
+class TraceMiddleware:
+    """ Trace per sampled HTTP request, the trace id is returned in X-Trace-Id. """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with tracer.trace(scope["path"], forced(scope["headers"])) as root:
+            if root is None:
+                await self.app(scope, receive, send)
+                return
+            attrs, trace_id = root.attrs, root.trace.id.encode()
+
+            async def send_trace_id(message: dict) -> None:
+                if message["type"] == "http.response.start":
+                    headers = [*message.get("headers", []), (b"x-trace-id", trace_id)]
+                    message = {**message, "headers": headers}
+                    attrs["status"] = message["status"]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_trace_id)
+            finally:
+                route = scope.get("route")
+                root.name = f"{scope['method']} {getattr(route, 'path', 'unmatched')}"
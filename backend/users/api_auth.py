@@ -1,28 +1,32 @@
 from typing import Any
 
-from db import database
+from db import redis
 from fastapi import APIRouter, Depends, status
 from fastapi.responses import JSONResponse, RedirectResponse
-from redis import Redis
-from settings import JWT_REFRESH_SECRET_KEY, REDIS_URL
+from ratelimit import RateLimit, limiter
+from settings import JWT_REFRESH_SECRET_KEY
 from starlette.requests import Request
 from users import utils
 from users.deps_auth import OAuth2PasswordRequestForm as OAuth2Form
-from users.models import User
+from users.models import db_user
 from users.schemas import TokenRefresh, TokenSchema, UserOut
 
 router = APIRouter(prefix='/auth', tags=["auth"])
-db_redis = Redis.from_url(REDIS_URL, decode_responses=True)
-db_user = User(database)
 
 
-@router.post("/login", response_model=TokenSchema, status_code=status.HTTP_200_OK)
+@router.post(
+    "/login",
+    response_model=TokenSchema,
+    status_code=status.HTTP_200_OK,
+    dependencies=[Depends(RateLimit("auth.login.ip"))],
+)
 async def login(request: Request, user: OAuth2Form = Depends()) -> Any:
     """
     Authorization by phone and password, issues a token.
     Stores ip address and refresh token in Redis (Max 10 for user).
     {username: [{ip: refresh_token}]}.
     """
+    await limiter.check("auth.login.user", user.username)
 
     user_cls = await db_user.password_by_username(user.username)
     if not user_cls:
@@ -35,7 +39,12 @@ async def login(request: Request, user: OAuth2Form = Depends()) -> Any:
         return await utils.redis_count_token_and_save(user.username, request.client.host)
 
 
-@router.post('/refresh', response_model=TokenSchema, status_code=status.HTTP_200_OK)
+@router.post(
+    '/refresh',
+    response_model=TokenSchema,
+    status_code=status.HTTP_200_OK,
+    dependencies=[Depends(RateLimit("auth.refresh.ip"))],
+)
 async def refresh_token(request: Request, token: TokenRefresh) -> Any:
     """
     Validates the user's IP address and refresh token against a database entry.
@@ -53,4 +62,4 @@ async def refresh_token(request: Request, token: TokenRefresh) -> Any:
 @router.post("/logout", status_code=status.HTTP_404_NOT_FOUND)
 async def logout(user: UserOut = Depends(utils.get_current_user)) -> None:
     """ Removes all user tokens. """
-    db_redis.delete(user.username)
+    await redis.delete(user.username)
@@ -1,20 +1,26 @@
 from typing import Any
 
-from db import database
-from fastapi import APIRouter, Depends, status
+from asyncpg import Record
+from etag import etag, not_modified
+from fastapi import APIRouter, Depends, Response, status
 from fastapi.responses import JSONResponse
+from ratelimit import RateLimit
 from settings import NOT_FOUND
 from starlette.requests import Request
 from users import utils
-from users.models import User
+from users.models import db_user
 from users.schemas import UserCreate, UserOut, UserUpdate
 
 router = APIRouter(prefix='/users', tags=["users"])
-db_user = User(database)
 PROTECTED = Depends(utils.get_current_user)
 
 
-@router.post("/signup", response_model=UserOut, status_code=status.HTTP_201_CREATED)
+@router.post(
+    "/signup",
+    response_model=UserOut,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(RateLimit("users.signup.ip"))],
+)
 async def create_user(request: Request, user: UserCreate) -> Any:
 
     if await db_user.is_email(user.email):
@@ -39,15 +45,24 @@ async def create_user(request: Request, user: UserCreate) -> Any:
 
 
 @router.get('/me', response_model=UserOut, status_code=status.HTTP_200_OK)
-async def me(request: Request, user: UserOut = PROTECTED) -> Any:
+async def me(request: Request, response: Response, user: Record = PROTECTED) -> Any:
     """ Get details of currently logged in user. """
-    return await utils.path_image(request, user)
+    return (
+        not_modified(request, response, etag("u", user.id, user.version))
+        or await utils.path_image(request, user)
+    )
 
 
 @router.get("/{username}", response_model=UserOut, status_code=status.HTTP_200_OK)
-async def user_id(request: Request, username: str) -> dict | JSONResponse:
+async def user_id(request: Request, response: Response, username: str) -> Any:
     """ User profile. Available to all users. """
-    return await utils.path_image(request, await db_user.by_username(username)) or NOT_FOUND
+    user = await db_user.by_username(username)
+    if not user:
+        return NOT_FOUND
+    return (
+        not_modified(request, response, etag("u", user.id, user.version))
+        or await utils.path_image(request, user)
+    )
 
 
 @router.put("/{username}", response_model=UserOut, status_code=status.HTTP_200_OK)
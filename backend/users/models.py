@@ -1,6 +1,6 @@
 import sqlalchemy as sa
 from asyncpg import Record
-from db import Base, metadata
+from db import Base, Statement, database, metadata
 from sqlalchemy.sql import func
 from users.schemas import UserCreate
 
@@ -15,63 +15,80 @@ user = sa.Table(
     sa.Column("lastname", sa.String(150), nullable=False),
     sa.Column("image", sa.String(200), unique=True),
     sa.Column("timestamp", sa.DateTime(timezone=True), default=func.now()),
-    sa.Column("is_active", sa.Boolean, default=True)
+    sa.Column("is_active", sa.Boolean, default=True),
+    # ETag of the profile, bumped by every update.
+    sa.Column("version", sa.Integer, nullable=False, server_default="1"),
 )
 
 
 class User(Base):
+    _by_username = Statement(
+        sa.select(
+            user.c.id,
+            user.c.username,
+            user.c.firstname,
+            user.c.lastname,
+            user.c.image,
+            user.c.phone,
+            user.c.email,
+            user.c.timestamp,
+            user.c.is_active,
+            user.c.version,
+        ).where(user.c.username == sa.bindparam("name"))
+    )
+    _is_email = Statement(sa.select(user.c.id).where(user.c.email == sa.bindparam("value")))
+    _is_username = Statement(sa.select(user.c.id).where(user.c.username == sa.bindparam("value")))
+    _is_phone = Statement(sa.select(user.c.id).where(user.c.phone == sa.bindparam("value")))
+    _password_by_username = Statement(
+        sa.select(user.c.password).where(user.c.username == sa.bindparam("name"))
+    )
+    _create = Statement(
+        sa.insert(user).values(
+            username=sa.bindparam("new_username"),
+            firstname=sa.bindparam("new_firstname"),
+            lastname=sa.bindparam("new_lastname"),
+            phone=sa.bindparam("new_phone"),
+            email=sa.bindparam("new_email"),
+            password=sa.bindparam("new_password"),
+            is_active=True,
+        ).returning(user)
+    )
+
     async def by_username(self, username: str) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(
-                user.c.id,
-                user.c.username,
-                user.c.firstname,
-                user.c.lastname,
-                user.c.image,
-                user.c.phone,
-                user.c.email,
-                user.c.timestamp,
-                user.c.is_active,
-            ).where(user.c.username == username)
-        )
+        return await self.fetch_one(self._by_username, name=username)
 
     async def is_email(self, email: str) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(user.c.id).where(user.c.email == email)
-        )
+        return await self.fetch_one(self._is_email, value=email)
 
     async def is_username(self, username: str) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(user.c.id).where(user.c.username == username)
-        )
+        return await self.fetch_one(self._is_username, value=username)
 
     async def is_phone(self, phone: str) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(user.c.id).where(user.c.phone == phone)
-        )
+        return await self.fetch_one(self._is_phone, value=phone)
 
     async def password_by_username(self, username: str) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(user.c.password).where(user.c.username == username)
-        )
+        return await self.fetch_one(self._password_by_username, name=username)
 
     async def create(self, user_obj: UserCreate) -> Record:
-        return await self.database.fetch_one(
-            sa.insert(user).values(
-                username=user_obj.username,
-                firstname=user_obj.firstname,
-                lastname=user_obj.lastname,
-                phone=user_obj.phone,
-                email=user_obj.email,
-                password=user_obj.password,
-                is_active=True,
-            ).returning(user)
+        return await self.fetch_one(
+            self._create,
+            new_username=user_obj.username,
+            new_firstname=user_obj.firstname,
+            new_lastname=user_obj.lastname,
+            new_phone=user_obj.phone,
+            new_email=user_obj.email,
+            new_password=user_obj.password,
         )
 
     async def update(self, username: str, user_obj: dict) -> Record | None:
-        return await self.database.fetch_one(
+        # The columns differ from call to call, the statement is compiled every time.
+        query = (
             sa.update(user)
             .where(user.c.username == username)
-            .values(user_obj)
+            .values(**user_obj, version=user.c.version + 1)
             .returning(user)
         )
+        return await self.fetch_one(Statement(query, name="User.update"))
+
+
+db_user = User(database)
@@ -8,22 +8,20 @@ from uuid import uuid4
 import aiofiles
 import settings
 from asyncpg import Record
-from db import database
+from db import redis
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.hash import bcrypt
 from PIL import Image
 from pydantic import ValidationError
-from redis import Redis
 from settings import (ALLOWED_TYPES, AVATAR_ROOT, AVATAR_URL, INVALID_FILE,
-                      INVALID_TYPE, MEDIA_URL, REDIS_URL, SIZES)
+                      INVALID_TYPE, MEDIA_URL, SIZES)
 from starlette.requests import Request
-from users.models import User
+from tracing import span
+from users.models import db_user
 from users.schemas import TokenPayload
 
-db_user = User(database)
-db_redis = Redis.from_url(REDIS_URL, decode_responses=True)
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/auth/login",
     scheme_name="JWT"
@@ -32,12 +30,14 @@ oauth2_scheme = OAuth2PasswordBearer(
 
 async def get_hashed_password(password: str) -> str:
     """ Hashes the user's password. """
-    return bcrypt.hash(password)
+    with span("bcrypt.hash"):
+        return bcrypt.hash(password)
 
 
 async def verify_password(password: str, hashed_pass: str) -> bool:
     """ Validates a hashed user password. """
-    return bcrypt.verify(password, hashed_pass)
+    with span("bcrypt.verify"):
+        return bcrypt.verify(password, hashed_pass)
 
 
 async def _get_token(sub: str, secret: str, expire_minutes: int) -> str:
@@ -86,9 +86,9 @@ async def check_token(token: str, secret: str, refresh_host: str = '') -> Any:
         if datetime.fromtimestamp(token_data.exp) < datetime.now():
             raise exception
         if refresh_host:
-            if db_redis.hmget(token_data.sub, refresh_host)[0] == token:
+            if (await redis.hmget(token_data.sub, refresh_host))[0] == token:
                 return token_data.sub
-            db_redis.hdel(token_data.sub, refresh_host)
+            await redis.hdel(token_data.sub, refresh_host)
             raise exception
 
     except (JWTError, ValidationError):
@@ -104,9 +104,9 @@ async def redis_count_token_and_save(username: str, host: str) -> dict[str, str]
     access_token = await create_access_token(username)
     refresh_token = await create_refresh_token(username)
 
-    if len(db_redis.hgetall(username)) > 10:
-        db_redis.delete(username)
-    db_redis.hmset(username, {host: refresh_token})
+    if await redis.hlen(username) > 10:
+        await redis.delete(username)
+    await redis.hset(username, mapping={host: refresh_token})
 
     return {"access_token": access_token, "refresh_token": refresh_token}
 
@@ -120,10 +120,11 @@ async def image_delete(filename: str | None = None) -> None:
     if filename:
         filename, extension = filename.split(".")
 
-        for size in SIZES:
-            image_path = os.path.join(AVATAR_ROOT, f"{filename}{size}.{extension}")
-            if os.path.isfile(image_path):
-                os.remove(image_path)
+        with span("image.delete"):
+            for size in SIZES:
+                image_path = os.path.join(AVATAR_ROOT, f"{filename}{size}.{extension}")
+                if os.path.isfile(image_path):
+                    os.remove(image_path)
 
 
 async def base64_image(base64_data: str, extension: str = "jpg") -> str:
@@ -141,13 +142,15 @@ async def base64_image(base64_data: str, extension: str = "jpg") -> str:
     filename = f"{uuid4()}"
     image_path = os.path.join(AVATAR_ROOT, f"{filename}.{extension}")
     try:
-        async with aiofiles.open(image_path, "wb") as buffer:
-            await buffer.write(base64.b64decode(base64_data))
+        with span("image.decode", chars=len(base64_data)):
+            async with aiofiles.open(image_path, "wb") as buffer:
+                await buffer.write(base64.b64decode(base64_data))
 
         for size in SIZES:
-            image = Image.open(image_path, mode="r")
-            image.thumbnail((size, size))
-            image.save(os.path.join(AVATAR_ROOT, f"{filename}{size}.{extension}"))
+            with span("image.thumbnail", size=size):
+                image = Image.open(image_path, mode="r")
+                image.thumbnail((size, size))
+                image.save(os.path.join(AVATAR_ROOT, f"{filename}{size}.{extension}"))
 
     except (Exception, TypeError, binascii.Error, ValueError):
         raise HTTPException(status.HTTP_418_IM_A_TEAPOT, INVALID_FILE)